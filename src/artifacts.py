@@ -0,0 +1,137 @@
+import json
+import os
+from hashlib import blake2b
+
+import numpy as np
+import pandas as pd
+
+from processing import shingle_batch
+from signature import MinhashEngine, generate_hashfunctions, load_hash
+from storage import ShingleStore
+
+# On-disk cache of pre-processed shingles and signatures, for parameter sweeps which index the same csv file
+# many times (see lsh_analysis.py and LSH.create_index(..., cache=...)).
+# - shingles are keyed by the content of the csv file and the pre-processing options, so a changed file is
+#   shingled again
+# - hash functions are drawn once per (hashtype, draw) and kept, so every sweep uses the same seeds. A signature
+#   of length M is the first M columns of a signature of any larger length with the same family
+# - signatures are keyed by the shingles and the seeds of the hash functions. Signatures for a smaller M are
+#   sliced from the cached ones, for a larger M only the missing columns are computed
+# One-permutation hashes (OPHhash) depend on M as a whole, so they are drawn and cached per M.
+# Layout of the cache directory:
+#   shingles/<key>/shingles.npy, offsets.npy       ShingleStore of a csv file
+#   hashes/<hashtype>_<draw>.json                  stored hash functions of a family (OPHhash_<draw>_<M>.json)
+#   signatures/<key>.npy, <key>.json               signature matrix and the hash functions of its columns
+
+
+# hexadecimal digest of a number of strings
+def _digest(*parts):
+    return blake2b("\0".join(str(part) for part in parts).encode(), digest_size=16).hexdigest()
+
+
+# saves an array so that an interrupted write never leaves a partial file
+def _save_array(path, values):
+    with open(path + '.tmp', 'wb') as output:
+        np.save(output, values)
+    os.replace(path + '.tmp', path)
+
+
+def _save_json(path, value):
+    with open(path + '.tmp', 'w') as output:
+        json.dump(value, output)
+    os.replace(path + '.tmp', path)
+
+
+class ArtifactCache:
+    # Parameters:
+    # - directory       directory of the cache. default: ./data/cache
+    def __init__(self, directory='./data/cache'):
+        self.directory = directory
+        for subdirectory in ['shingles', 'hashes', 'signatures']:
+            os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+        # digests of the csv files, recomputed when their size or modification time changes
+        self.digests = {}
+
+    # content digest of a csv file in ./data
+    def file_digest(self, filename):
+        path = './data/%s' % filename
+        stat = os.stat(path)
+        cached = self.digests.get(path)
+        if cached is None or cached[0] != (stat.st_size, stat.st_mtime_ns):
+            digest = blake2b(digest_size=16)
+            with open(path, 'rb') as csv_file:
+                for block in iter(lambda: csv_file.read(2**20), b""):
+                    digest.update(block)
+            cached = ((stat.st_size, stat.st_mtime_ns), digest.hexdigest())
+            self.digests[path] = cached
+        return cached[1]
+
+    # key of the shingles of a csv file pre-processed with _filter (a partial of processing.shingle_hashes)
+    def shingle_key(self, filename, _filter):
+        return _digest(self.file_digest(filename), _filter.func.__name__, _filter.args,
+                       sorted(_filter.keywords.items()))
+
+    # Returns the ShingleStore of the articles of a csv file pre-processed with _filter (memory-mapped if cached)
+    def shingles(self, filename, _filter):
+        path = os.path.join(self.directory, 'shingles', self.shingle_key(filename, _filter))
+        if not os.path.exists(os.path.join(path, 'offsets.npy')):
+            articles = pd.read_csv('./data/%s' % filename)['article'].to_list()
+            store = ShingleStore.from_sets(shingle_batch(articles, _filter))
+            os.makedirs(path, exist_ok=True)
+            _save_array(os.path.join(path, 'shingles.npy'), store.shingles)
+            # written last: marks the entry as complete
+            _save_array(os.path.join(path, 'offsets.npy'), store.offsets)
+        return ShingleStore(np.load(os.path.join(path, 'shingles.npy'), mmap_mode='r'),
+                            np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r'))
+
+    # Returns the first M hash functions of a family, drawing (and storing) more functions when needed
+    # Parameters:
+    # - M               number of hash functions
+    # - hashtype        either "Xorhash" or "Linconhash" or "MD5hash" or "OPHhash"
+    # - draw            number of the family, e.g. to average over several independent draws. default: 0
+    def hashfunctions(self, M, hashtype="Xorhash", draw=0):
+        name = '%s_%s_%s.json' % (hashtype, draw, M) if hashtype == "OPHhash" else '%s_%s.json' % (hashtype, draw)
+        path = os.path.join(self.directory, 'hashes', name)
+        stored = []
+        if os.path.exists(path):
+            with open(path, 'r') as hash_file:
+                stored = json.load(hash_file)
+        if len(stored) < M:
+            stored += [hashfunc.store() for hashfunc in generate_hashfunctions(M - len(stored), hashtype)]
+            _save_json(path, stored)
+        return [load_hash(hashfunc) for hashfunc in stored[:M]]
+
+    # Returns the signature matrix of the articles of a csv file pre-processed with _filter
+    # Parameters:
+    # - filename        name of the csv file
+    # - _filter         pre-processing function (a partial of processing.shingle_hashes)
+    # - hashfunctions   list of hash functions, e.g. from hashfunctions()
+    # Returns:
+    # - (number of documents x len(hashfunctions)) uint64 signature matrix
+    def signatures(self, filename, _filter, hashfunctions):
+        key = self.shingle_key(filename, _filter)
+        stored = [hashfunc.store() for hashfunc in hashfunctions]
+        if getattr(hashfunctions[0], 'ONE_PASS', False):
+            key = _digest(key, *stored)
+        else:
+            key = _digest(key, stored[0])
+        path = os.path.join(self.directory, 'signatures', key)
+
+        columns = []
+        if os.path.exists(path + '.json'):
+            with open(path + '.json', 'r') as columns_file:
+                columns = json.load(columns_file)
+        common = min(len(columns), len(stored))
+        if columns[:common] != stored[:common]:
+            columns = []
+        if len(columns) >= len(stored):
+            return np.load(path + '.npy', mmap_mode='r')[:, :len(stored)]
+
+        # compute the missing columns only
+        store = self.shingles(filename, _filter)
+        matrix = MinhashEngine(hashfunctions[len(columns):]).signature_matrix(store, parallel=True)
+        if columns:
+            matrix = np.hstack([np.load(path + '.npy', mmap_mode='r')[:, :len(columns)], matrix])
+        _save_array(path + '.npy', matrix)
+        _save_json(path + '.json', stored)
+        return matrix
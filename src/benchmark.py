@@ -0,0 +1,300 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from lsh import LSH
+from processing import shingle_batch, to_shingles
+from signature import generate_signature_matrix
+from storage import ShingleStore
+from usersettings import usersettings
+from workers import close_pool
+
+# Reproducible benchmark of every stage of the pipeline on a synthetic corpus
+# The corpus is generated from news_articles_small.csv: original articles (the csv articles, and for larger
+# corpora articles composed of random sentences of it) plus near-duplicates made by replacing some words of
+# an original, like lsh_analysis.generate_mutated_queries does. The same size, duplicate rate and seed always
+# give the same corpus. Every stage is timed for each thread count (usersettings["threads"]), the results
+# are written as JSON which can be compared with the JSON of an earlier run.
+
+# version of the JSON results
+RESULT_VERSION = 1
+# stages in the order they run, with the unit of their throughput
+STAGES = [
+    ("to_shingles", "docs"),
+    ("shingle_batch", "docs"),
+    ("generate_signature_matrix", "docs"),
+    ("index_gen", "docs"),
+    ("store_index", "docs"),
+    ("load_index", "docs"),
+    ("query", "queries"),
+    ("query_batch", "queries"),
+    ("get_all_similar_pairs", "docs")
+]
+
+
+# replaces random words of a document by random words of the vocabulary
+def mutate(doc, mutations, vocabulary, rng):
+    words = doc.split()
+    for _ in range(mutations):
+        words[rng.randrange(len(words))] = rng.choice(vocabulary)
+    return " ".join(words)
+
+
+# Generates a synthetic corpus
+# Parameters:
+# - size            number of documents
+# - duplicate_rate  fraction of the documents that is a near-duplicate of another document of the corpus
+# - mutations       number of words replaced in a near-duplicate. default: 5
+# - seed            seed of the random generator. default: 0
+# - source          csv file in ./data the articles are taken from
+# Returns:
+# - list of document texts (in random order)
+def generate_corpus(size, duplicate_rate, mutations=5, seed=0, source='news_articles_small.csv'):
+    assert 0 <= duplicate_rate < 1
+    rng = random.Random(seed)
+    articles = pd.read_csv('./data/%s' % source)['article'].dropna().to_list()
+    vocabulary = sorted(set(word for article in articles for word in article.split()))
+    duplicates = int(round(size * duplicate_rate))
+    originals = size - duplicates
+
+    docs = rng.sample(articles, min(originals, len(articles)))
+    if originals > len(docs):
+        # compose further originals of random sentences, as long as a random article
+        sentences = [sentence for article in articles for sentence in article.split(". ")]
+        lengths = [len(article) for article in articles]
+        for _ in range(originals - len(docs)):
+            length = rng.choice(lengths)
+            doc = []
+            while sum(map(len, doc)) < length:
+                doc.append(rng.choice(sentences))
+            docs.append(". ".join(doc))
+    # a near-duplicate may be based on another near-duplicate, which gives clusters of similar documents
+    for _ in range(duplicates):
+        docs.append(mutate(rng.choice(docs), mutations, vocabulary, rng))
+    rng.shuffle(docs)
+    return docs
+
+
+# peak resident set size in MB of this process and of its terminated child processes (e.g. finished pools)
+def peak_rss():
+    scale = 1 if platform.system() == "Darwin" else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 2**20)
+
+
+# Runs all stages once with the current usersettings["threads"]
+# Parameters:
+# - docs            list of document texts
+# - queries         list of query texts
+# - M, r, hashtype  parameters of the index
+# - sim             minimum similarity of the queries and of get_all_similar_pairs
+# - index_file      name of the index file in ./data the index is stored to
+# Returns:
+# - seconds taken by every stage, and the number of near-duplicate pairs found
+def run_stages(docs, queries, M, r, hashtype, sim, index_file):
+    seconds = {}
+    lsh = LSH()
+
+    t = time.perf_counter()
+    for doc in docs:
+        to_shingles(doc, stopword_start=True, filter_punctuation=True, remove_capitalization=True)
+    seconds["to_shingles"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    store = ShingleStore.from_sets(shingle_batch(docs, lsh._filter))
+    seconds["shingle_batch"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    signatures, hashfunctions = generate_signature_matrix(store, M, hashtype)
+    seconds["generate_signature_matrix"] = time.perf_counter() - t
+
+    # only bands the signatures computed above (see LSH.band_index)
+    t = time.perf_counter()
+    lsh.band_index(store, signatures, hashfunctions, r)
+    seconds["index_gen"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    lsh.store_index(index_file, "binary")
+    seconds["store_index"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    lsh = LSH(index_file)
+    seconds["load_index"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    for query in queries:
+        lsh.query(query, sim)
+    seconds["query"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    lsh.query_batch(queries, sim)
+    seconds["query_batch"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    pairs = lsh.get_all_similar_pairs(sim, output=None)
+    seconds["get_all_similar_pairs"] = time.perf_counter() - t
+    return seconds, len(pairs)
+
+
+# Runs all stages repeat times with the given number of threads, in a fresh process (see benchmark)
+# Returns:
+# - the fastest time of every stage, the number of near-duplicate pairs, and the peak RSS in MB of the process
+#   and of its worker processes during these runs only
+def _run_configuration(docs, queries, M, r, hashtype, sim, index_file, thread_count, repeat):
+    usersettings["threads"] = thread_count
+    best = None
+    for _ in range(repeat):
+        seconds, pairs = run_stages(docs, queries, M, r, hashtype, sim, index_file)
+        best = seconds if best is None else {stage: min(best[stage], seconds[stage]) for stage in best}
+    # terminated (and joined) workers are counted in the peak RSS of the children
+    close_pool()
+    return best, pairs, peak_rss()
+
+
+# Benchmarks all stages for every thread count
+# Parameters:
+# - docs            number of documents of the synthetic corpus
+# - duplicate_rate  fraction of near-duplicates in the corpus
+# - threads         list of thread counts to run the stages with
+# - repeat          number of runs per thread count, the fastest time of every stage is reported
+# - M, r, hashtype  parameters of the index
+# - sim             minimum similarity of the queries and of get_all_similar_pairs
+# - queries         number of (mutated) queries
+# - mutations       number of words replaced in near-duplicates and queries
+# - seed            seed of the corpus and the queries
+# Returns:
+# - a dictionary with the machine, the configuration, the corpus and the results of every thread count
+def benchmark(docs=2000, duplicate_rate=0.1, threads=(1, 2, 4), repeat=3, M=100, r=5, hashtype="Xorhash",
+              sim=0.8, queries=100, mutations=5, seed=0):
+    config = {'docs': docs, 'duplicate_rate': duplicate_rate, 'threads': list(threads), 'repeat': repeat, 'M': M,
+              'r': r, 'hashtype': hashtype, 'sim': sim, 'queries': queries, 'mutations': mutations, 'seed': seed}
+    t = time.perf_counter()
+    corpus = generate_corpus(docs, duplicate_rate, mutations, seed)
+    rng = random.Random(seed + 1)
+    vocabulary = sorted(set(word for doc in corpus[:100] for word in doc.split()))
+    query_docs = [mutate(doc, mutations, vocabulary, rng) for doc in rng.sample(corpus, min(queries, len(corpus)))]
+    corpus_seconds = time.perf_counter() - t
+    print("Generated a corpus of", len(corpus), "documents in", corpus_seconds, "sec")
+
+    index_file = 'benchmark_%s.lsh' % os.getpid()
+    runs = []
+    try:
+        for thread_count in threads:
+            # every thread count runs in a new (spawned) process, so the peak RSS is the one of this thread count
+            # and not the largest of all earlier runs (ru_maxrss is a lifetime maximum)
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                best, pairs, (rss, children_rss) = executor.submit(
+                    _run_configuration, corpus, query_docs, M, r, hashtype, sim, index_file, thread_count,
+                    repeat).result()
+            stages = {}
+            for stage, unit in STAGES:
+                items = len(query_docs) if unit == "queries" else len(corpus)
+                stages[stage] = {'seconds': best[stage], 'items': items, 'unit': unit,
+                                 'throughput': items / best[stage] if best[stage] else None}
+                if runs:
+                    baseline = runs[0]['stages'][stage]['seconds']
+                    stages[stage]['speedup'] = baseline / best[stage] if best[stage] else None
+            runs.append({'threads': thread_count, 'stages': stages, 'pairs': pairs,
+                         'total_seconds': sum(best.values()), 'peak_rss_mb': rss, 'children_peak_rss_mb': children_rss})
+            print("Threads: %s, total: %.3f sec, peak RSS: %.1f MB" % (thread_count, sum(best.values()), rss))
+    finally:
+        if os.path.exists('./data/%s' % index_file):
+            os.remove('./data/%s' % index_file)
+
+    return {
+        'version': RESULT_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': machine_info(),
+        'config': config,
+        'corpus': {'docs': len(corpus), 'duplicates': int(round(docs * duplicate_rate)),
+                   'queries': len(query_docs), 'seconds': corpus_seconds},
+        'runs': runs
+    }
+
+
+# platform, CPU count, Python and numpy versions and the git revision of the code
+def machine_info():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        revision = None
+    return {'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__, 'revision': revision}
+
+
+# Compares two benchmark results stage by stage, for the thread counts they have in common
+# Returns:
+# - a list of (threads, stage, seconds before, seconds now, speedup)
+def compare(previous, current):
+    if previous['config'] != current['config']:
+        print("Warning: the runs were made with different configurations")
+    before = {run['threads']: run['stages'] for run in previous['runs']}
+    rows = []
+    for run in current['runs']:
+        if run['threads'] not in before:
+            continue
+        for stage, _ in STAGES:
+            if stage in before[run['threads']] and stage in run['stages']:
+                old = before[run['threads']][stage]['seconds']
+                new = run['stages'][stage]['seconds']
+                rows.append((run['threads'], stage, old, new, old / new if new else None))
+    return rows
+
+
+def print_results(result):
+    print("%-8s %-26s %10s %14s %8s" % ("threads", "stage", "seconds", "throughput", "speedup"))
+    for run in result['runs']:
+        for stage, unit in STAGES:
+            values = run['stages'][stage]
+            print("%-8s %-26s %10.4f %10.1f %-3s %8s" % (
+                run['threads'], stage, values['seconds'], values['throughput'] or 0, unit[0] + "/s",
+                "%.2fx" % values['speedup'] if values.get('speedup') else "-"))
+
+
+def print_comparison(rows):
+    print("%-8s %-26s %10s %10s %8s" % ("threads", "stage", "before", "now", "speedup"))
+    for threads, stage, old, new, speedup in rows:
+        print("%-8s %-26s %10.4f %10.4f %8s" % (threads, stage, old, new, "%.2fx" % speedup if speedup else "-"))
+    if rows:
+        print("Geometric mean speedup: %.2fx" % statistics.geometric_mean([row[4] for row in rows if row[4]]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark all stages on a synthetic corpus')
+    parser.add_argument('--docs', type=int, default=2000, help='number of documents of the corpus')
+    parser.add_argument('--duplicates', type=float, default=0.1, help='fraction of near-duplicates in the corpus')
+    parser.add_argument('--mutations', type=int, default=5, help='words replaced in near-duplicates and queries')
+    parser.add_argument('--threads', default='1,2,4', help='comma-separated thread counts')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per thread count, the fastest is reported')
+    parser.add_argument('--M', type=int, default=100)
+    parser.add_argument('--r', type=int, default=5)
+    parser.add_argument('--hashtype', default='Xorhash')
+    parser.add_argument('--sim', type=float, default=0.8)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json', help='file the JSON results are written to')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    result = benchmark(args.docs, args.duplicates, [int(t) for t in args.threads.split(',')], args.repeat, args.M,
+                       args.r, args.hashtype, args.sim, args.queries, args.mutations, args.seed)
+    with open(args.output, 'w') as output:
+        json.dump(result, output, indent=2)
+    print_results(result)
+    print("Results written to", args.output)
+
+    if args.compare:
+        with open(args.compare, 'r') as previous:
+            print_comparison(compare(json.load(previous), result))
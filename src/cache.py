@@ -0,0 +1,92 @@
+import sys
+import time
+from collections import OrderedDict
+from hashlib import blake2b
+
+from processing import shingle_array
+
+# default memory bound of a cache, in bytes
+MAX_BYTES = 64 * 2**20
+
+
+# estimated memory of a cached result in bytes: a number, or a tuple (or list) of them (nested)
+def _result_bytes(result):
+    if isinstance(result, (tuple, list)):
+        return sys.getsizeof(result) + sum(_result_bytes(item) for item in result)
+    return sys.getsizeof(result)
+
+
+# Cache of query results with LRU eviction and an optional time to live
+# Memory is bounded by the number of results and by their estimated size (a result of a query can hold
+# thousands of document IDs), the least recently used results are evicted until both bounds hold.
+# Entries are keyed by a digest of the (normalized) shingles of the query and the query options, so a
+# resubmitted document hits the cache whatever its whitespace, capitalization or punctuation was (as far as
+# the pre-processing of the index removes those). The owner clears the cache whenever its index changes.
+class QueryCache:
+    # Parameters:
+    # - maxsize         maximum number of cached results, the least recently used result is evicted first
+    # - ttl             number of seconds a result stays valid. default: no expiry
+    # - maxbytes        maximum estimated size of all cached results in bytes, larger results are never cached.
+    #                   default: MAX_BYTES
+    def __init__(self, maxsize=1024, ttl=None, maxbytes=MAX_BYTES):
+        assert maxsize > 0 and maxbytes > 0
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        # {key: (time stored, result, estimated size)}
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # key of the shingles of a query together with the query options (e.g. sim and info)
+    @staticmethod
+    def key(shingles, *options):
+        return blake2b(shingle_array(shingles).astype('<u8').tobytes(), digest_size=16).digest(), options
+
+    # Returns the cached result of a key, or None if it isn't cached (or expired)
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+            del self.entries[key]
+            self.bytes -= entry[2]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, result):
+        size = _result_bytes(result)
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[2]
+        if size > self.maxbytes:
+            return
+        self.entries[key] = (time.monotonic(), result, size)
+        self.bytes += size
+        while len(self.entries) > self.maxsize or self.bytes > self.maxbytes:
+            self.bytes -= self.entries.popitem(last=False)[1][2]
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Returns a dictionary with the number of cached results, their estimated size in bytes, hits, misses,
+    # evictions and the hit rate
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
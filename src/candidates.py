@@ -0,0 +1,263 @@
+import os
+
+import numpy as np
+
+from storage import BandTable
+
+# policies for buckets larger than the configured maximum bucket size
+# - "skip"          generate no pairs from the bucket at all
+# - "sample"        only pair a random sample of max_bucket documents of the bucket
+OVERSIZED_POLICIES = ["skip", "sample"]
+
+
+# Flattens the band tables of an index into the members of all buckets with at least two documents
+# Buckets of all bands are numbered consecutively, so (band, bucket key) becomes a single bucket number
+# Parameters:
+# - index           list of band tables (dictionaries or BandTables)
+# - deleted         ids of removed documents, which are left out of the buckets
+# Returns:
+# - (sizes, members): bucket j owns members[starts[j]:starts[j]+sizes[j]], sorted by document id
+def bucket_members(index, deleted=()):
+    sizes = []
+    members = []
+    for band in index:
+        if isinstance(band, BandTable):
+            _, offsets, postings = band.arrays()
+            sizes.append(np.diff(offsets))
+            members.append(np.asarray(postings, dtype=np.int64))
+        else:
+            sizes.append(np.fromiter((len(bucket) for bucket in band.values()), dtype=np.int64, count=len(band)))
+            members.append(np.fromiter((doc for bucket in band.values() for doc in bucket),
+                                       dtype=np.int64, count=int(sizes[-1].sum())))
+    sizes = np.concatenate(sizes + [np.empty(0, dtype=np.int64)])
+    members = np.concatenate(members + [np.empty(0, dtype=np.int64)])
+
+    buckets = np.repeat(np.arange(len(sizes)), sizes)
+    if len(deleted):
+        alive = ~np.isin(members, np.fromiter(deleted, dtype=np.int64, count=len(deleted)))
+        members, buckets = members[alive], buckets[alive]
+        sizes = np.bincount(buckets, minlength=len(sizes))
+
+    # sort on (bucket, document) and drop buckets which can't produce a pair
+    members = members[np.lexsort((members, buckets))]
+    keep = np.repeat(sizes >= 2, sizes)
+    return sizes[sizes >= 2], members[keep]
+
+
+# Applies the oversized bucket policy
+# Returns:
+# - (sizes, members, number of pairs that won't be generated from the oversized buckets)
+def _limit_buckets(sizes, members, max_bucket, policy, rng):
+    oversized = sizes > max_bucket
+    if not oversized.any():
+        return sizes, members, 0
+
+    skipped = int((sizes[oversized] * (sizes[oversized] - 1) // 2).sum())
+    starts = np.cumsum(sizes) - sizes
+    keep = np.ones(len(members), dtype=bool)
+    if policy == "skip":
+        keep[np.repeat(oversized, sizes)] = False
+        return sizes[~oversized], members[keep], skipped
+
+    for start, size in zip(starts[oversized], sizes[oversized]):
+        # drop a random subset: the remaining documents stay sorted
+        keep[start + rng.choice(size, size - max_bucket, replace=False)] = False
+    skipped -= int(oversized.sum()) * (max_bucket * (max_bucket - 1) // 2)
+    return np.where(oversized, max_bucket, sizes), members[keep], skipped
+
+
+# Generates all pairs (i, j) with i < j of documents sharing a bucket
+# Buckets of the same size are handled together: their members form a matrix and the pairs are
+# taken with a single triangular index, so no Python code runs per pair or per bucket.
+# A bucket with more than chunk_size pairs is split into ranges of rows of its triangle instead
+# (row i pairs member i with members i+1 .. size-1), so no more than chunk_size pairs (or a single row)
+# are generated at once
+# Parameters:
+# - sizes, members  buckets as returned by bucket_members
+# - chunk_size      maximum number of pairs generated at once
+# Returns:
+# - a generator of (first, second) document id arrays, pairs may be repeated
+def _bucket_pairs(sizes, members, chunk_size):
+    starts = np.cumsum(sizes) - sizes
+    for size in np.unique(sizes):
+        rows = starts[sizes == size]
+        if size * (size - 1) // 2 > chunk_size:
+            for start in rows:
+                yield from _large_bucket_pairs(members[start:start+size], chunk_size)
+            continue
+        first, second = np.triu_indices(size, 1)
+        per_chunk = max(1, chunk_size // len(first))
+        for i in range(0, len(rows), per_chunk):
+            block = members[rows[i:i+per_chunk, None] + np.arange(size)]
+            yield block[:, first].ravel(), block[:, second].ravel()
+
+
+# Generates the pairs of a single bucket in ranges of rows of at most chunk_size pairs (at least one row)
+def _large_bucket_pairs(bucket, chunk_size):
+    size = len(bucket)
+    # pairs generated by all rows before row i
+    before = np.concatenate([[0], np.cumsum(np.arange(size - 1, 0, -1))])
+    row = 0
+    while row < size - 1:
+        end = max(row + 1, int(np.searchsorted(before, before[row] + chunk_size, 'right')) - 1)
+        end = min(end, size - 1)
+        counts = size - 1 - np.arange(row, end)
+        first = np.repeat(np.arange(row, end), counts)
+        second = np.arange(len(first)) - np.repeat(np.cumsum(counts) - counts, counts) + first + 1
+        yield bucket[first], bucket[second]
+        row = end
+
+
+# Finds all candidate pairs of an index: pairs of documents sharing a bucket in at least one band
+# Parameters:
+# - index           list of band tables (dictionaries or BandTables)
+# - max_bucket      maximum bucket size, larger buckets are handled according to oversized. default: no limit
+# - oversized       "skip" or "sample", see OVERSIZED_POLICIES. default: skip
+# - chunk_size      maximum number of pairs generated at once, bounds the memory used before de-duplication
+# - seed            seed for sampling oversized buckets
+# - deleted         ids of removed documents, which are never part of a pair
+# Returns:
+# - (first, second, skipped): sorted and de-duplicated document id arrays with first < second, and the
+#   number of bucket pairs that were not generated because of max_bucket (a pair can be counted in
+#   multiple bands, or still be found through another band)
+def candidate_pairs(index, max_bucket=None, oversized="skip", chunk_size=2**20, seed=None, deleted=()):
+    assert oversized in OVERSIZED_POLICIES
+    sizes, members = bucket_members(index, deleted)
+    skipped = 0
+    if max_bucket is not None:
+        sizes, members, skipped = _limit_buckets(sizes, members, max_bucket, oversized,
+                                                 np.random.default_rng(seed))
+
+    # pairs are encoded as a single integer (first << 32 | second) so they can be de-duplicated with np.unique,
+    # which is applied whenever enough pairs have been gathered to keep memory bounded
+    keys = []
+    gathered = 0
+    for first, second in _bucket_pairs(sizes, members, chunk_size):
+        keys.append(np.unique(_pair_keys(first, second)))
+        gathered += len(keys[-1])
+        if gathered > 4 * chunk_size:
+            keys = [np.unique(np.concatenate(keys))]
+            gathered = len(keys[0])
+    keys = np.unique(np.concatenate(keys + [np.empty(0, dtype=np.uint64)]))
+    return (*_split_keys(keys), skipped)
+
+
+# Finds the pairs of documents of which a probe key (see lsh.probe_signatures) hits the bucket of another document
+# Parameters:
+# - index           list of band tables (dictionaries or BandTables)
+# - keys            (documents x probes x bands) array of probe keys
+# - valid           (documents x probes x bands) boolean array, False for probes that don't exist
+# - docs            document ids of the rows of keys
+# - max_bucket      buckets larger than this are not probed. default: no limit
+# - deleted         ids of removed documents, which are never part of a pair
+# Returns:
+# - (first, second): sorted and de-duplicated document id arrays with first < second
+def probe_pairs(index, keys, valid, docs, max_bucket=None, deleted=()):
+    pair_keys = [np.empty(0, dtype=np.uint64)]
+    for i, band in enumerate(index):
+        table_keys, offsets, postings = band.arrays() if isinstance(band, BandTable) else \
+            BandTable.pack(band, "md5" if keys.dtype.kind == "S" else "mix64")
+        if len(table_keys) == 0:
+            continue
+        probe, owners = keys[:, :, i][valid[:, :, i]], docs[np.nonzero(valid[:, :, i])[0]]
+        pos = np.minimum(np.searchsorted(table_keys, probe), len(table_keys) - 1)
+        found = table_keys[pos] == probe
+        pos, owners = pos[found], owners[found]
+        sizes = offsets[pos + 1] - offsets[pos]
+        if max_bucket is not None:
+            pos, owners, sizes = pos[sizes <= max_bucket], owners[sizes <= max_bucket], sizes[sizes <= max_bucket]
+        # every member of every hit bucket, paired with the document that probed it
+        members = np.asarray(postings, dtype=np.int64)[np.repeat(offsets[pos] - np.cumsum(sizes) + sizes, sizes) +
+                                                       np.arange(int(sizes.sum()))]
+        owners = np.repeat(owners, sizes)
+        keep = members != owners
+        first, second = np.minimum(members, owners)[keep], np.maximum(members, owners)[keep]
+        pair_keys.append(np.unique(_pair_keys(first, second)))
+    first, second = _split_keys(np.unique(np.concatenate(pair_keys)))
+    if len(deleted):
+        deleted = np.fromiter(deleted, dtype=np.int64, count=len(deleted))
+        alive = ~(np.isin(first, deleted) | np.isin(second, deleted))
+        first, second = first[alive], second[alive]
+    return first, second
+
+
+# Merges lists of pairs
+# Parameters:
+# - pairs           (first, second) document id arrays with first < second
+# Returns:
+# - (first, second): sorted and de-duplicated document id arrays of all pairs
+def union_pairs(*pairs):
+    keys = [np.empty(0, dtype=np.uint64)] + [_pair_keys(first, second) for first, second in pairs]
+    return _split_keys(np.unique(np.concatenate(keys)))
+
+
+# encodes pairs of document ids as single integers (first << 32 | second), which sort like the pairs
+def _pair_keys(first, second):
+    return (first.astype(np.uint64) << np.uint64(32)) | second.astype(np.uint64)
+
+
+def _split_keys(keys):
+    return (keys >> np.uint64(32)).astype(np.int64), (keys & np.uint64(2**32 - 1)).astype(np.int64)
+
+
+# Splits the range of document ids into partitions of about the same number of candidate pairs, counting
+# every pair in a partition by its first (smallest) document
+# Returns:
+# - array of the document id at which every partition starts, followed by the end of the last partition
+def _partition_bounds(sizes, members, pairs_per_partition):
+    if len(members) == 0:
+        return np.array([0, 1], dtype=np.int64)
+    # a member at position p of a bucket of size s is the first document of s - 1 - p pairs of the bucket
+    starts = np.cumsum(sizes) - sizes
+    positions = np.arange(len(members)) - np.repeat(starts, sizes)
+    cumulative = np.cumsum(np.bincount(members, weights=np.repeat(sizes, sizes) - 1 - positions))
+    partitions = max(1, int(np.ceil(cumulative[-1] / pairs_per_partition)))
+    ends = np.searchsorted(cumulative, np.arange(1, partitions) * cumulative[-1] / partitions) + 1
+    return np.unique(np.concatenate([[0], ends, [len(cumulative)]])).astype(np.int64)
+
+
+# Finds all candidate pairs like candidate_pairs, but spills them to one file per partition of first document
+# ids instead of keeping them in memory, so memory stays bounded whatever the number of pairs.
+# Reading the partitions in order (read_partition) gives all pairs sorted by (first, second).
+# Parameters:
+# - index, max_bucket, oversized, chunk_size, seed, deleted: see candidate_pairs (pass a seed when sampling
+#   oversized buckets, so the same pairs are generated again when resuming)
+# - directory           directory the partition files are written to
+# - pairs_per_partition approximate number of pairs (before de-duplication) per partition
+# - bounds              partition bounds of an earlier run to reuse (when resuming). default: computed
+# - start               number of partitions to leave out (already handled when resuming). default: 0
+# Returns:
+# - (bounds, files, skipped): the document id at which every partition starts (and the end of the last one),
+#   the partition files and the number of pairs not generated because of max_bucket
+def spill_candidate_pairs(index, directory, pairs_per_partition=2**22, max_bucket=None, oversized="skip",
+                          chunk_size=2**20, seed=None, deleted=(), bounds=None, start=0):
+    assert oversized in OVERSIZED_POLICIES
+    sizes, members = bucket_members(index, deleted)
+    skipped = 0
+    if max_bucket is not None:
+        sizes, members, skipped = _limit_buckets(sizes, members, max_bucket, oversized,
+                                                 np.random.default_rng(seed))
+    if bounds is None:
+        bounds = _partition_bounds(sizes, members, pairs_per_partition)
+    bounds = np.asarray(bounds, dtype=np.int64)
+    files = [os.path.join(directory, 'partition%05d.u64' % i) for i in range(len(bounds) - 1)]
+    for name in files[start:]:
+        open(name, 'wb').close()
+
+    for first, second in _bucket_pairs(sizes, members, chunk_size):
+        keys = np.unique(_pair_keys(first, second))
+        # keys are sorted by first document, so every partition is a contiguous range of them
+        splits = np.searchsorted(keys, _pair_keys(bounds, np.zeros(len(bounds), dtype=np.int64)))
+        for i in range(start, len(files)):
+            if splits[i + 1] > splits[i]:
+                with open(files[i], 'ab') as output:
+                    keys[splits[i]:splits[i + 1]].tofile(output)
+    return bounds, files, skipped
+
+
+# Reads a partition file of spill_candidate_pairs
+# Returns:
+# - (first, second): sorted and de-duplicated document id arrays of the candidate pairs of the partition
+def read_partition(name):
+    return _split_keys(np.unique(np.fromfile(name, dtype=np.uint64)))
+
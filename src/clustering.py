@@ -0,0 +1,120 @@
+import numpy as np
+
+from candidates import OVERSIZED_POLICIES, _limit_buckets, _pair_keys, _split_keys, bucket_members
+from instrumentation import NULL_STATS
+from jaccard import verify_pairs
+
+# Clustering of near-duplicates: instead of listing every near-duplicate pair, documents are merged into clusters
+# (connected components of the near-duplicate pairs) with a union-find structure while the buckets are scanned.
+# A bucket of k copies of one article then costs about k - 1 Jaccard computations instead of k * (k - 1) / 2:
+# pairs of documents that already are in the same cluster are never verified.
+# The buckets are scanned in rounds, all buckets at once: in round i, the i-th document (pivot) of every bucket
+# is verified against the following documents of the bucket that are in another cluster, then the similar
+# pairs are merged. Pairs found in several buckets (or bands) in a round are verified once, and a bucket is
+# done as soon as its remaining documents are all in one cluster.
+
+
+# Disjoint sets of documents 0 .. n-1, the root of every set is its smallest document id
+class UnionFind:
+    def __init__(self, n):
+        self.parent = np.arange(n, dtype=np.int64)
+        self.components = n
+
+    # Returns the roots of an array of documents, and points the documents directly at their roots
+    def find(self, docs):
+        roots = self.parent[docs]
+        while True:
+            up = self.parent[roots]
+            if (up == roots).all():
+                break
+            roots = up
+        self.parent[docs] = roots
+        return roots
+
+    def _root(self, doc):
+        parent = self.parent
+        while parent[doc] != doc:
+            # path halving
+            parent[doc] = parent[parent[doc]]
+            doc = parent[doc]
+        return doc
+
+    # Merges the sets of the pairs (first[i], second[i])
+    def union(self, first, second):
+        for a, b in zip(np.asarray(first).tolist(), np.asarray(second).tolist()):
+            a, b = self._root(a), self._root(b)
+            if a != b:
+                self.parent[max(a, b)] = min(a, b)
+                self.components -= 1
+
+    # Returns the root (smallest document id) of the set of every document
+    def labels(self):
+        return self.find(np.arange(len(self.parent)))
+
+
+# Clusters the documents of an index: documents end up in the same cluster when they are connected by
+# candidate pairs with a similarity above treshold
+# Parameters:
+# - index           list of band tables (dictionaries or BandTables)
+# - docs            ShingleStore or list of shingle sets of the documents
+# - treshold        minimum similarity
+# - representative  verify a candidate against the representative (smallest document id) of every other
+#                   cluster in its bucket, instead of against all documents of the bucket. Verifies fewer
+#                   pairs, but can miss a merge when a document is similar to a cluster member that isn't
+#                   the representative (the clusters are then finer). default: False
+# - max_bucket, oversized, seed, deleted: see candidates.candidate_pairs
+# - stats           Stats object recording verified_pairs, clustered_pairs (pairs that weren't verified
+#                   because both documents were in the same cluster already) and skipped_pairs
+# Returns:
+# - (labels, verified): the cluster id (smallest document id of its cluster) of every document, -1 for
+#   removed documents, and the number of verified pairs
+def cluster_documents(index, docs, treshold, representative=False, max_bucket=None, oversized="skip", seed=None,
+                      deleted=(), stats=NULL_STATS):
+    assert oversized in OVERSIZED_POLICIES
+    sizes, members = bucket_members(index, deleted)
+    skipped = 0
+    if max_bucket is not None:
+        sizes, members, skipped = _limit_buckets(sizes, members, max_bucket, oversized, np.random.default_rng(seed))
+
+    clusters = UnionFind(len(docs))
+    total = int((sizes * (sizes - 1) // 2).sum())
+    verified = 0
+    pivot = np.zeros(len(sizes), dtype=np.int64)
+    while len(sizes):
+        starts = np.cumsum(sizes) - sizes
+        buckets = np.repeat(np.arange(len(sizes)), sizes)
+        positions = np.arange(len(members)) - starts[buckets]
+        roots = clusters.find(members)
+        # drop the buckets of which the documents from the pivot on are all in one cluster
+        rest = positions >= pivot[buckets]
+        busy = np.minimum.reduceat(np.where(rest, roots, len(docs)), starts) != \
+            np.maximum.reduceat(np.where(rest, roots, -1), starts)
+        if not busy.all():
+            keep = busy[buckets]
+            members, roots, positions = members[keep], roots[keep], positions[keep]
+            sizes, pivot = sizes[busy], pivot[busy]
+            starts = np.cumsum(sizes) - sizes
+            buckets = np.repeat(np.arange(len(sizes)), sizes)
+            if len(sizes) == 0:
+                break
+
+        pivots = (starts + pivot)[buckets]
+        pending = (positions > pivot[buckets]) & (roots != roots[pivots])
+        if representative:
+            first, second = roots[pivots][pending], roots[pending]
+            first, second = np.minimum(first, second), np.maximum(first, second)
+        else:
+            first, second = members[pivots][pending], members[pending]
+        first, second = _split_keys(np.unique(_pair_keys(first, second)))
+        verified += len(first)
+        first, second, _ = verify_pairs(docs, first, second, treshold, stats=stats)
+        clusters.union(first, second)
+        pivot += 1
+
+    labels = clusters.labels()
+    if len(deleted):
+        labels[np.fromiter(deleted, dtype=np.int64, count=len(deleted))] = -1
+    stats.count("verified_pairs", verified)
+    stats.count("clustered_pairs", total - verified)
+    stats.count("skipped_pairs", skipped)
+    return labels, verified
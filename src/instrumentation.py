@@ -0,0 +1,177 @@
+import cProfile
+import io
+from functools import wraps
+import pstats
+import time
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+# Instrumentation of the pipeline: timers per stage, counters and histograms, e.g. to find out whether
+# pre-processing, minhashing, band hashing, candidate generation or verification makes a run slow.
+# Instrumented code records into a Stats object. When instrumentation is disabled it records into NULL_STATS,
+# of which every method does nothing, so the cost is one method call per stage (never per document).
+# Only the coordinating process is measured: work done in pool workers shows up in the timer of the stage
+# that waits for it, but not in the profile.
+
+# rates derived from counters: (name, numerator, denominator)
+RATES = [
+    ("query_hit_rate", "query_results", "query_candidates"),
+    ("pair_hit_rate", "similar_pairs", "candidate_pairs"),
+    ("cache_hit_rate", "cache_hits", "queries")
+]
+
+
+# Decorator timing a method as a stage of the stats of its object (self.stats)
+def timed(name):
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.stats.stage(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Histogram of non-negative values in power-of-two buckets: bucket i holds the values in [2**(i-1), 2**i),
+# bucket 0 the zeros
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = np.zeros(0, dtype=np.int64)
+
+    def observe(self, values):
+        values = np.asarray(values, dtype=np.int64).ravel()
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.total += int(values.sum())
+        self.min = int(values.min()) if self.min is None else min(self.min, int(values.min()))
+        self.max = int(values.max()) if self.max is None else max(self.max, int(values.max()))
+        buckets = np.bincount(np.ceil(np.log2(values + 1)).astype(np.int64))
+        if len(buckets) > len(self.buckets):
+            self.buckets = np.pad(self.buckets, (0, len(buckets) - len(self.buckets)))
+        self.buckets[:len(buckets)] += buckets
+
+    # Returns:
+    # - a dictionary with count, min, max, mean and the non-empty buckets {upper bound (exclusive): count}
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else None,
+            'buckets': {str(2**i if i else 1): int(n) for i, n in enumerate(self.buckets.tolist()) if n}
+        }
+
+
+# Records timers, counters and histograms, and optionally profiles the timed stages with cProfile
+class Stats:
+    enabled = True
+
+    # Parameters:
+    # - hooks           list of callbacks hook(event, name, value), called for every "stage" (value: seconds),
+    #                   "count" (value: increment) and "observe" (value: array of values) record
+    # - profile         profile all stages with cProfile (see profile_report). default: False
+    def __init__(self, hooks=(), profile=False):
+        self.hooks = list(hooks)
+        self.profiler = cProfile.Profile() if profile else None
+        self.depth = 0
+        self.timers = {}
+        self.counters = {}
+        self.histograms = {}
+
+    # Times a stage: with stats.stage("minhash"): ...
+    # Nested stages are timed separately, the profiler runs while the outermost stage runs
+    @contextmanager
+    def stage(self, name):
+        if self.profiler is not None and self.depth == 0:
+            self.profiler.enable()
+        self.depth += 1
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - t
+            self.depth -= 1
+            if self.profiler is not None and self.depth == 0:
+                self.profiler.disable()
+            timer = self.timers.setdefault(name, {'calls': 0, 'seconds': 0.0})
+            timer['calls'] += 1
+            timer['seconds'] += seconds
+            for hook in self.hooks:
+                hook("stage", name, seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+        for hook in self.hooks:
+            hook("count", name, n)
+
+    # adds values (a number or an array) to a histogram
+    def observe(self, name, values):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        self.histograms[name].observe(values)
+        for hook in self.hooks:
+            hook("observe", name, values)
+
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+        self.histograms = {}
+        if self.profiler is not None:
+            self.profiler = cProfile.Profile()
+
+    # Returns:
+    # - a dictionary with the timers, counters, histograms and the rates derived from the counters (see RATES)
+    def as_dict(self):
+        rates = {name: self.counters[numerator] / self.counters[denominator]
+                 for name, numerator, denominator in RATES
+                 if self.counters.get(denominator) and numerator in self.counters}
+        return {
+            'timers': {name: dict(timer) for name, timer in self.timers.items()},
+            'counters': dict(self.counters),
+            'histograms': {name: histogram.as_dict() for name, histogram in self.histograms.items()},
+            'rates': rates
+        }
+
+    # Returns the profile of the stages as text, sorted by the given pstats key
+    def profile_report(self, sort="cumulative", limit=30):
+        assert self.profiler is not None, "profiling is not enabled"
+        output = io.StringIO()
+        pstats.Stats(self.profiler, stream=output).sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+    # Writes the profile of the stages to a file, which can be loaded with pstats (or e.g. snakeviz)
+    def dump_profile(self, filename):
+        assert self.profiler is not None, "profiling is not enabled"
+        self.profiler.dump_stats(filename)
+
+
+# Stats which record nothing, used when instrumentation is disabled
+class NullStats:
+    enabled = False
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def count(self, name, n=1):
+        pass
+
+    def observe(self, name, values):
+        pass
+
+    def reset(self):
+        pass
+
+    # Returns:
+    # - an empty dictionary, nothing is recorded
+    def as_dict(self):
+        return {}
+
+
+_NULL_STAGE = nullcontext()
+NULL_STATS = NullStats()
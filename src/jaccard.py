@@ -1,6 +1,21 @@
+import numpy as np
+
+from instrumentation import NULL_STATS
+from processing import shingle_array
+from storage import ShingleStore
+from usersettings import usersettings
+from workers import array_handle, get_pool, open_array
+
+# candidate pairs verified per task of the verification pool
+VERIFY_CHUNK = 8192
 
 # computes Jaccard similarity based on two documents represented as sets of shingles
+# (or sorted uint64 shingle arrays, as stored in a binary index)
 def compute_jaccard(doc1, doc2):
+    if isinstance(doc1, np.ndarray) or isinstance(doc2, np.ndarray):
+        doc1, doc2 = shingle_array(doc1), shingle_array(doc2)
+        intersection = np.intersect1d(doc1, doc2, assume_unique=True).size
+        return intersection / (len(doc1) + len(doc2) - intersection)
     intersection = doc1.intersection(doc2)
     union = doc1.union(doc2)
     return len(intersection)/len(union)
@@ -12,6 +27,179 @@ def pairwise_jaccard(docs, buckets, _print=False):
             if key1 < key2:
                 jaccard_sim = compute_jaccard(value1, value2)
                 # increase bucket count for range in which computed similarity falls
-                buckets[min(jaccard_sim // 0.1 * 0.1, 0.9)] += 1
+                buckets[min(int(jaccard_sim * 10), 9) / 10] += 1
                 if _print and jaccard_sim > 0.8:
                     print('Pair has similarity higher than 0.8: (%s, %s)' % (key1, key2))
+
+
+# positions of the concatenated ranges [starts[i], starts[i] + lengths[i]) of an array
+def _ranges(starts, lengths):
+    ends = np.cumsum(lengths)
+    return np.repeat(starts - ends + lengths, lengths) + np.arange(ends[-1] if len(ends) else 0)
+
+
+# Jaccard similarities of document pairs (first[i], second[i]), all computed at once
+# The shingles of every pair are tagged with the pair number: key = pair << 40 | top 40 bits of the shingle.
+# The keys of the second documents are then globally sorted, so a single searchsorted finds the matching
+# shingle of every shingle of the first documents without building any sets.
+# Parameters:
+# - store           ShingleStore containing the documents
+# - first, second   document id arrays (at most 2**24 pairs)
+# - other           ShingleStore containing the second documents. default: store
+# Returns:
+# - float array of similarities, 0 if both documents are empty
+def pairs_jaccard(store, first, second, other=None):
+    other = store if other is None else other
+    sizes1 = store.offsets[first + 1] - store.offsets[first]
+    sizes2 = other.offsets[second + 1] - other.offsets[second]
+    values1 = store.shingles[_ranges(store.offsets[first], sizes1)]
+    values2 = other.shingles[_ranges(other.offsets[second], sizes2)]
+    intersection = _overlaps(values1, sizes1, values2, sizes2)
+    union = sizes1 + sizes2 - intersection
+    return np.divide(intersection, union, out=np.zeros(len(first)), where=union > 0)
+
+
+# Sizes of the intersections of pairs of sorted shingle arrays, given as the concatenated shingles of the
+# first and of the second arrays of all pairs and the size of every array
+def _overlaps(values1, sizes1, values2, sizes2):
+    pairs = np.arange(len(sizes1), dtype=np.uint64) << np.uint64(40)
+    keys1 = np.repeat(pairs, sizes1) | (values1 >> np.uint64(24))
+    keys2 = np.repeat(pairs, sizes2) | (values2 >> np.uint64(24))
+
+    found = np.zeros(len(values1), dtype=bool)
+    if len(values2):
+        pos = np.minimum(np.searchsorted(keys2, keys1), len(values2) - 1)
+        same_key = keys2[pos] == keys1
+        found = same_key & (values2[pos] == values1)
+        # a shingle of the second document sharing its top 40 bits with another one (very rare): check all of them
+        for i in np.nonzero(same_key & ~found)[0]:
+            end = np.searchsorted(keys2, keys1[i], 'right')
+            found[i] = (values2[pos[i]:end] == values1[i]).any()
+
+    return np.bincount(np.repeat(np.arange(len(sizes1)), sizes1), weights=found,
+                       minlength=len(sizes1)).astype(np.int64)
+
+
+# Drops pairs that can't have a similarity above treshold, looking at their sizes and the starts (prefixes) of
+# their shingle arrays only (size and prefix filtering as in AllPairs/PPJoin, with the shingle hashes as the
+# global order of the shingles, so the prefixes are the starts of the stored sorted arrays)
+# - size filter:    the similarity is at most |small| / |large|, and the overlap must reach
+#                   required = the smallest integer above treshold / (1 + treshold) * (|A| + |B|)
+# - prefix filter:  a pair reaching the required overlap shares a shingle within the first
+#                   |A| - required + 1 shingles of A and |B| - required + 1 shingles of B. Up to the smaller of
+#                   the last shingles v of both prefixes, the overlap is counted, and the count stops there:
+#                   the overlap is at most (overlap up to v) + min(shingles of A above v, shingles of B above v)
+# Parameters:
+# - store, first, second, treshold, other: see pairs_jaccard
+# Returns:
+# - (first, second, pruned by size, pruned by prefix): the remaining pairs and the number of dropped pairs
+def prefilter_pairs(store, first, second, treshold, other=None):
+    other = store if other is None else other
+    sizes1 = store.offsets[first + 1] - store.offsets[first]
+    sizes2 = other.offsets[second + 1] - other.offsets[second]
+    # rounded down for floating point errors, so a pair is never dropped wrongly
+    required = np.maximum(np.floor(treshold * (sizes1 + sizes2) / (1 + treshold) - 1e-9).astype(np.int64) + 1, 1)
+    small, large = np.minimum(sizes1, sizes2), np.maximum(sizes1, sizes2)
+    keep = (small >= treshold * large - 1e-9) & (required <= small)
+    pruned_size = len(first) - int(keep.sum())
+    first, second, sizes1, sizes2, required = first[keep], second[keep], sizes1[keep], sizes2[keep], required[keep]
+
+    prefix1, prefix2 = sizes1 - required + 1, sizes2 - required + 1
+    values1 = store.shingles[_ranges(store.offsets[first], prefix1)]
+    values2 = other.shingles[_ranges(other.offsets[second], prefix2)]
+    last = np.minimum(values1[np.cumsum(prefix1) - 1], values2[np.cumsum(prefix2) - 1]) if len(first) else \
+        np.empty(0, dtype=np.uint64)
+    below1 = values1 <= np.repeat(last, prefix1)
+    below2 = values2 <= np.repeat(last, prefix2)
+    counted1 = np.bincount(np.repeat(np.arange(len(first)), prefix1), weights=below1, minlength=len(first))
+    counted2 = np.bincount(np.repeat(np.arange(len(first)), prefix2), weights=below2, minlength=len(first))
+    counted1, counted2 = counted1.astype(np.int64), counted2.astype(np.int64)
+    overlap = _overlaps(values1[below1], counted1, values2[below2], counted2)
+    keep = overlap + np.minimum(sizes1 - counted1, sizes2 - counted2) >= required
+    return first[keep], second[keep], pruned_size, len(first) - int(keep.sum())
+
+
+# Verifies candidate pairs in the current process, see verify_pairs (which spreads larger numbers of pairs over
+# the pool of workers.py)
+# Parameters:
+# - store, other    ShingleStores of the first and second documents (other=None: store)
+# - first, second, treshold, prefilter: see verify_pairs
+# Returns:
+# - (first, second, similarities, pruned by size, pruned by prefix): the pairs with a similarity above treshold
+#   and the numbers of pairs dropped by prefilter_pairs
+def filter_pairs(store, other, first, second, treshold, prefilter):
+    pruned = (0, 0)
+    if prefilter:
+        first, second, *pruned = prefilter_pairs(store, first, second, treshold, other)
+    sims = pairs_jaccard(store, first, second, other)
+    keep = sims > treshold
+    return first[keep], second[keep], sims[keep], pruned[0], pruned[1]
+
+
+# Verifies a chunk of pairs in a worker of the persistent pool (see workers.py)
+def _verify_task(task):
+    handles, chunk = task[0], task[1:]
+    blocks = []
+    try:
+        return _verify_shared(handles, blocks, chunk)
+    finally:
+        # the views of the blocks are released when _verify_shared returns
+        for shm in blocks:
+            shm.close()
+
+
+def _verify_shared(handles, blocks, chunk):
+    store, other = [None if handle is None else ShingleStore(*(open_array(part, blocks) for part in handle))
+                    for handle in handles]
+    return filter_pairs(store, other, *chunk)
+
+
+# Verifies candidate pairs and keeps the ones with a similarity above the threshold
+# Chunks of VERIFY_CHUNK pairs are spread over the persistent pool of usersettings["threads"] workers
+# (see workers.py), a single chunk is verified in the current process. The stores are passed to the workers
+# by file (memory-mapped stores) or through shared memory, they are never pickled
+# Parameters:
+# - docs            ShingleStore or list of shingle sets
+# - first, second   candidate document id arrays
+# - treshold        minimum similarity
+# - other           ShingleStore containing the second documents (e.g. a batch of queries). default: docs
+# - prefilter       drop pairs by their sizes and prefixes before computing similarities (see prefilter_pairs),
+#                   which never changes the result. default: True
+# - stats           Stats object recording the number of pairs dropped by size (pruned_by_size) and by prefix
+#                   (pruned_by_prefix), see instrumentation.py. default: nothing is recorded
+# Returns:
+# - (first, second, similarities) arrays of the pairs with a similarity above treshold
+def verify_pairs(docs, first, second, treshold, other=None, prefilter=True, stats=NULL_STATS):
+    if isinstance(docs, ShingleStore):
+        store, ids = docs, None
+    else:
+        # only convert the documents that are part of a pair, pairs then refer to positions in ids
+        ids = np.unique(np.concatenate([first, second]) if other is None else first)
+        store = ShingleStore.from_sets([docs[doc_id] for doc_id in ids.tolist()])
+        first = np.searchsorted(ids, first)
+        second = np.searchsorted(ids, second) if other is None else second
+
+    chunks = [(first[i:i+VERIFY_CHUNK], second[i:i+VERIFY_CHUNK], treshold, prefilter)
+              for i in range(0, len(first), VERIFY_CHUNK)]
+    if len(chunks) <= 1 or usersettings["threads"] <= 1:
+        results = [filter_pairs(store, other, *chunk) for chunk in chunks]
+    else:
+        blocks = []
+        try:
+            handles = tuple(None if part is None else (array_handle(part.shingles, blocks),
+                                                       array_handle(part.offsets, blocks))
+                            for part in (store, other))
+            results = get_pool().map(_verify_task, [(handles, *chunk) for chunk in chunks])
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+    results.append((np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0), 0, 0))
+    first, second, sims, pruned_size, pruned_prefix = zip(*results)
+    first, second, sims = np.concatenate(first), np.concatenate(second), np.concatenate(sims)
+    stats.count("pruned_by_size", sum(pruned_size))
+    stats.count("pruned_by_prefix", sum(pruned_prefix))
+    if ids is not None:
+        first = ids[first]
+        second = ids[second] if other is None else second
+    return first, second, sims
@@ -0,0 +1,138 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import numpy as np
+import pandas as pd
+
+# Client and load generator for the query server (server.py)
+
+
+# Client keeping one HTTP connection to the query server open, over TCP or a Unix socket
+class LSHClient:
+    def __init__(self, host="127.0.0.1", port=8000, path=None):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        if self.path:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    # Sends a request
+    # Returns:
+    # - (HTTP status, decoded JSON response)
+    async def request(self, method, target, body=None):
+        if self.writer is None:
+            await self.connect()
+        data = json.dumps(body).encode() if body is not None else b""
+        self.writer.write(("%s %s HTTP/1.1\r\nHost: lsh\r\nContent-Type: application/json\r\n"
+                           "Content-Length: %s\r\n\r\n" % (method, target, len(data))).encode() + data)
+        await self.writer.drain()
+        head = (await self.reader.readuntil(b"\r\n\r\n")).decode('latin-1').split("\r\n")
+        status = int(head[0].split(" ")[1])
+        headers = {line.split(":", 1)[0].strip().lower(): line.split(":", 1)[1].strip()
+                   for line in head[1:] if ":" in line}
+        response = json.loads(await self.reader.readexactly(int(headers['content-length'])))
+        if headers.get('connection', '').lower() == 'close':
+            await self.close()
+        return status, response
+
+    # Returns the (status, response) of a query, see server.py
+    async def query(self, query, sim=0.8, info=False):
+        return await self.request("POST", "/query", {'query': query, 'sim': sim, 'info': info})
+
+    async def stats(self):
+        return (await self.request("GET", "/stats"))[1]
+
+
+# Queries the server once, without asyncio
+# Returns:
+# - the list of document IDs similar to the query
+def query_server(query, sim=0.8, host="127.0.0.1", port=8000, path=None):
+    async def run():
+        client = LSHClient(host, port, path)
+        try:
+            status, response = await client.query(query, sim)
+        finally:
+            await client.close()
+        if status != 200:
+            raise RuntimeError('Query failed with status %s: %s' % (status, response.get('error')))
+        return response['results']
+    return asyncio.run(run())
+
+
+# Sends requests queries from concurrency connections at once, as fast as the server answers them
+# Parameters:
+# - queries         list of query texts, drawn at random
+# - requests        total number of queries to send
+# - concurrency     number of connections querying at the same time
+# - sim             minimum similarity of the queries
+# Returns:
+# - a dictionary with the throughput, latency percentiles (in milliseconds) and the count of every status
+async def generate_load(queries, requests, concurrency, sim=0.8, host="127.0.0.1", port=8000, path=None,
+                        seed=None):
+    rng = random.Random(seed)
+    order = [rng.choice(queries) for _ in range(requests)]
+    latencies = []
+    statuses = {}
+
+    async def worker(texts):
+        client = LSHClient(host, port, path)
+        try:
+            for text in texts:
+                t = time.perf_counter()
+                try:
+                    status, _ = await client.query(text, sim)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    status = 'connection error'
+                    await client.close()
+                latencies.append(time.perf_counter() - t)
+                statuses[status] = statuses.get(status, 0) + 1
+        finally:
+            await client.close()
+
+    t = time.perf_counter()
+    await asyncio.gather(*[worker(order[i::concurrency]) for i in range(concurrency)])
+    elapsed = time.perf_counter() - t
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'seconds': elapsed,
+        'throughput': requests / elapsed,
+        'p50': float(np.percentile(latencies, 50)),
+        'p95': float(np.percentile(latencies, 95)),
+        'p99': float(np.percentile(latencies, 99)),
+        'max': float(latencies.max()),
+        'statuses': statuses
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate query load on a running query server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix', help='connect to this Unix socket instead of a TCP port')
+    parser.add_argument('--csv', default='news_articles_small.csv', help='csv file in ./data to draw queries from')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--sim', type=float, default=0.8)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    queries = pd.read_csv('./data/%s' % args.csv)['article'].to_list()
+    result = asyncio.run(generate_load(queries, args.requests, args.concurrency, args.sim, args.host, args.port,
+                                       args.unix, args.seed))
+    print(json.dumps(result, indent=2))
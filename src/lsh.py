@@ -1,15 +1,133 @@
 import json
+import os
+from itertools import combinations
+import random
+import tempfile
 import time
-from collections import defaultdict
+from collections import deque
 from functools import partial
 from hashlib import md5
+from multiprocessing import Pool
 
-import pandas as pd
+import numpy as np
 
-from jaccard import compute_jaccard
-from processing import to_shingles
-from signature import (Linconhash, generate_signature_matrix, load_hash,
-                       shingles_to_signature)
+from cache import MAX_BYTES, QueryCache
+from candidates import candidate_pairs, probe_pairs, read_partition, spill_candidate_pairs, union_pairs
+from clustering import cluster_documents
+from instrumentation import NULL_STATS, Stats, timed
+from jaccard import VERIFY_CHUNK, filter_pairs, verify_pairs
+from processing import fmix64, shingle_array, shingle_batch, shingle_hashes
+from signature import EMPTY, MinhashEngine, generate_hashfunctions, load_hash
+from storage import (BandTable, IndexBuilder, ShingleStore, band_tables, bucket_arrays,
+                     is_binary_index, read_index, write_index)
+from usersettings import usersettings
+
+# pandas is only imported by the methods that read or write csv files (import pandas as pd inside them),
+# so loading an index and querying it doesn't pay for importing it (see query.py)
+
+# initial value of the band key hash
+MIX_SEED = np.uint64(0x9e3779b97f4a7c15)
+
+
+# Returns the 64-bit "mix64" keys of all bands of all signatures, computed in one vectorized pass:
+# key = fmix64(...fmix64(fmix64(MIX_SEED ^ v1) ^ v2)... ^ vr) over the r minhashes v1..vr of the band
+# Collisions: as fmix64 is a bijection, bands that only differ in their last minhash never collide (so r = 1
+# is collision-free). Other distinct bands collide with a probability of about 2**-64 per pair. A collision
+# only adds a false candidate, which is rejected by the Jaccard verification, so results are never affected.
+# Returns:
+# - (number of signatures x M // r) uint64 array
+def band_hashes(signatures, r):
+    signatures = np.asarray(signatures, dtype=np.uint64)
+    bands = signatures.shape[1] // r
+    rows = signatures[:, :bands * r].reshape(len(signatures), bands, r)
+    keys = np.full((len(signatures), bands), MIX_SEED, dtype=np.uint64)
+    for j in range(r):
+        keys = fmix64(keys ^ rows[:, :, j])
+    return keys
+
+
+# Returns the band keys of all bands of all signatures, of the given type (see storage.BAND_KEYS)
+def band_keys(signatures, r, bandkey):
+    if bandkey == "md5":
+        return band_digests(signatures, r)
+    return band_hashes(signatures, r)
+
+
+# Returns the raw MD5 digests of all bands of all signatures, the band keys of indexes created before
+# mix64 keys were introduced
+# Returns:
+# - (number of signatures x M // r) array of 16-byte digests
+def band_digests(signatures, r):
+    bands = signatures.shape[1] // r
+    keys = np.empty((len(signatures), bands), dtype="S16")
+    big_endian = np.asarray(signatures, dtype='>u8')
+    for doc in range(len(signatures)):
+        for i in range(bands):
+            keys[doc, i] = md5(big_endian[doc, i*r:(i+1)*r].tobytes()).digest()
+    return keys
+
+
+# perturbations of a band of r minhashes probed by multi-probe queries: every single position, then every pair
+# of positions
+# Returns:
+# - (number of perturbations x r) boolean array, True for the perturbed positions
+def perturbations(r):
+    pairs = list(combinations(range(r), 2))
+    masks = np.zeros((r + len(pairs), r), dtype=bool)
+    masks[np.arange(r), np.arange(r)] = True
+    for i, (j, k) in enumerate(pairs):
+        masks[r + i, [j, k]] = True
+    return masks
+
+
+# Multi-probe LSH: signatures of the neighbouring buckets of every band of a set of documents. A perturbed
+# position takes the runner-up (second smallest) hash of the document instead of its minhash, which is the
+# minhash of a similar document lacking the shingle holding the minimum. For every band the perturbations with
+# the smallest gaps between runner-up and minhash are probed first, as those are the most likely to be the
+# minhash of a similar document.
+# Parameters:
+# - signatures      (documents x M) signature matrix
+# - runner_ups      (documents x M) runner-up matrix (see MinhashEngine.runner_up)
+# - r               minhashes per band
+# - probes          number of probes per band
+# Returns:
+# - (rows, valid): (documents * probes x bands * r) matrix of which the band keys are the probe keys (row
+#   d * probes + t holds probe t of every band of document d), and a (documents x probes x bands) boolean
+#   array which is False for probes that don't exist (positions without a runner-up)
+def probe_signatures(signatures, runner_ups, r, probes):
+    n = len(signatures)
+    bands = signatures.shape[1] // r
+    sig = np.asarray(signatures, dtype=np.uint64)[:, :bands * r].reshape(n, bands, r)
+    alt = np.asarray(runner_ups, dtype=np.uint64)[:, :bands * r].reshape(n, bands, r)
+    masks = perturbations(r)
+    probes = min(probes, len(masks))
+    missing = alt == EMPTY
+    gaps = np.where(missing, 0, alt - sig).astype(np.float64)
+    scores = gaps @ masks.T
+    scores[(missing.astype(np.int64) @ masks.T) > 0] = np.inf
+    order = np.argsort(scores, axis=2, kind='stable')[:, :, :probes]
+    valid = np.take_along_axis(scores, order, 2) < np.inf
+    rows = np.where(masks[order], alt[:, :, None, :], sig[:, :, None, :])
+    return rows.transpose(0, 2, 1, 3).reshape(n * probes, bands * r), valid.transpose(0, 2, 1)
+
+
+# pre-processing filter, minhash engine and rows per band of the stream_index workers
+_stream_worker = None
+
+
+def _init_stream_worker(_filter, hashfunctions, r):
+    global _stream_worker
+    _stream_worker = (_filter, MinhashEngine(hashfunctions), r)
+
+
+# Pre-processes and signs a chunk of articles in a stream_index worker
+# Returns:
+# - (signatures, sorted shingle arrays, band keys) of the chunk
+def _stream_chunk(articles):
+    _filter, engine, r = _stream_worker
+    shingles = [shingle_array(_filter(article)) for article in articles]
+    signatures = engine.signature_matrix(shingles)
+    return signatures, shingles, band_hashes(signatures, r)
 
 # Class which takes care of creating an index and allows to search given a query
 # or to find all near-duplicate pairs
@@ -17,62 +135,295 @@ class LSH():
     # Constructor: a filename of a previously created index may be passed to load it
     # if no filename is passed, an empty index is created
     def __init__(self, filename=None) -> None:
-        self.docs = []
+        self.docs = ShingleStore.from_sets([])
+        self.signatures = None
         self.index = None
         self.M = None
         self.r = None
         self.hashfunctions = None
-        self._filter = partial(to_shingles, stopword_start=True,
-                               filter_punctuation=True, remove_capitalization=True) # define pre-processing techniques to be used while generating shingles
+        self.engine = None
+        self.bandkey = "mix64"
+        self.shinglehash = "mix64"
+        self.deleted = set()
+        self.cache = None
+        self.stats = NULL_STATS
         if filename:
             self.load_index(filename)
 
-    # Loads a previously created index
+    # Enables a cache of query results: repeated queries (same shingles after pre-processing, same sim) are
+    # answered without any band lookups or Jaccard computations. The cache is cleared whenever the index changes.
+    # Parameters:
+    # - maxsize         maximum number of cached results (least recently used results are evicted). default: 1024
+    # - ttl             number of seconds a cached result stays valid. default: no expiry
+    # - maxbytes        maximum estimated size of the cached results in bytes. default: cache.MAX_BYTES
+    def enable_cache(self, maxsize=1024, ttl=None, maxbytes=MAX_BYTES):
+        self.cache = QueryCache(maxsize, ttl, maxbytes)
+
+    # Enables instrumentation: timers of every stage (pre-processing, minhashing, band hashing, candidate
+    # generation, verification, storing/loading), counters (documents, queries, candidates, results, bytes read
+    # and written) and histograms (shingles per document, bucket sizes per band, candidates per query), see
+    # instrumentation.py. Without instrumentation nothing is recorded.
+    # Parameters:
+    # - hooks           list of callbacks hook(event, name, value) called for every record
+    # - profile         also profile the stages with cProfile (stats.profile_report()). default: False
+    # Returns:
+    # - the Stats object (also self.stats), stats.as_dict() returns everything recorded
+    def enable_stats(self, hooks=(), profile=False):
+        self.stats = Stats(hooks, profile)
+        return self.stats
+
+    def disable_stats(self):
+        self.stats = NULL_STATS
+
+    # records the sizes of the buckets of every band (instrumentation only)
+    def _record_buckets(self):
+        if not self.stats.enabled:
+            return
+        for i, band in enumerate(self.index):
+            sizes = np.diff(band.arrays()[1]) if isinstance(band, BandTable) else [len(bucket) for bucket in band.values()]
+            self.stats.observe("bucket_size[band %s]" % i, sizes)
+
+    # clears cached query results, called by every method that changes the index
+    def _index_changed(self):
+        if self.cache is not None:
+            self.cache.clear()
+
+    # pre-processing techniques to be used while generating shingles, with the shingle hash of the index
+    @property
+    def _filter(self):
+        return partial(shingle_hashes, stopword_start=True, filter_punctuation=True,
+                       remove_capitalization=True, shinglehash=self.shinglehash)
+
+    # Loads a previously created index, either in the binary format or as JSON
+    # The arrays of a binary index are memory-mapped: they are only read from disk when a query touches them
     # Parameters:
     # - filename        name of a previously created index file
+    @timed("load_index")
     def load_index(self, filename):
-        with open('./data/%s' % filename, 'r') as index_file:
+        self._index_changed()
+        path = './data/%s' % filename
+        # binary indexes are memory-mapped, so not all of these bytes are read right away
+        self.stats.count("bytes_read", os.path.getsize(path))
+        if is_binary_index(path):
+            header, blocks = read_index(path)
+            self.M = header['M']
+            self.r = header['r']
+            self.bandkey = header['bandkey']
+            self.shinglehash = header.get('shinglehash', 'md5')
+            self.index = band_tables(blocks)
+            self.docs = ShingleStore(blocks['shingles'], blocks['shingle_offsets'])
+            self.signatures = blocks['signatures'] if len(blocks['signatures']) == len(self.docs) else None
+            self.deleted = set(blocks['deleted'].tolist()) if 'deleted' in blocks else set()
+            self.hashfunctions = [load_hash(hashfunc) for hashfunc in header['hashfunctions']]
+            self.engine = MinhashEngine(self.hashfunctions)
+            self._record_buckets()
+            return
+
+        with open(path, 'r') as index_file:
             index_dict = json.load(index_file)
             self.M = index_dict['M']
             self.r = index_dict['r']
-            self.index = index_dict['index']
-            self.docs = [set(doc) for doc in index_dict['docs']]
+            # JSON object keys are strings: mix64 keys are converted back to ints
+            self.bandkey = index_dict.get('bandkey', 'md5')
+            self.shinglehash = index_dict.get('shinglehash', 'md5')
+            convert = int if self.bandkey == "mix64" else str
+            self.index = [BandTable(*BandTable.pack({convert(key): bucket for key, bucket in band.items()}, self.bandkey))
+                          for band in index_dict['index']]
+            self.docs = ShingleStore.from_sets(index_dict['docs'])
+            self.signatures = np.array(index_dict['signatures'], dtype=np.uint64) if 'signatures' in index_dict else None
+            self.deleted = set(index_dict.get('deleted', []))
             self.hashfunctions = [load_hash(hashfunc)
                                   for hashfunc in index_dict['hashfunctions']]
+            self.engine = MinhashEngine(self.hashfunctions)
+        self._record_buckets()
 
-    # Stores the created index into a JSON file
+    # Stores the created index into a file
     # Parameters:
     # - filename        name of the index file to be created
-    def store_index(self, filename):
+    # - fmt             "binary" or "json", by default JSON is only used for filenames ending in .json
+    @timed("store_index")
+    def store_index(self, filename, fmt=None):
+        if fmt is None:
+            fmt = "json" if filename.endswith('.json') else "binary"
+        assert fmt in ["binary", "json"]
+        hashfunctions = [hashfunc.store() for hashfunc in self.hashfunctions]
+        if fmt == "binary":
+            write_index('./data/%s' % filename, self.M, self.r, hashfunctions,
+                        self.signatures, self.docs, self.index, self.deleted, self.bandkey, self.shinglehash)
+            self.stats.count("bytes_written", os.path.getsize('./data/%s' % filename))
+            return
+
         with open('./data/%s' % filename, 'w') as output:
             index_dict = {
                 'M': self.M,
                 'r': self.r,
-                'index': self.index,
-                'docs': [list(doc) for doc in self.docs],
-                'hashfunctions': [hashfunc.store() for hashfunc in self.hashfunctions]
+                'index': [{key: list(bucket) for key, bucket in band.items()} for band in self.index],
+                'docs': [shingle_array(doc).tolist() for doc in self.docs],
+                'hashfunctions': hashfunctions,
+                'bandkey': self.bandkey,
+                'shinglehash': self.shinglehash,
+                'deleted': sorted(self.deleted)
             }
+            if self.signatures is not None:
+                index_dict['signatures'] = self.signatures.tolist()
             json.dump(index_dict, output)
+        self.stats.count("bytes_written", os.path.getsize('./data/%s' % filename))
 
     # Creates an index of a collection given a csv file containing the documents
     # Parameters:
     # - filename        name of the csv file containing the documents
     # - M               length of each signature
     # - r               minhashes per band
-    # - hashtype        either "Xorhash" or "Linconhash" or "MD5hash", determines the Minhash algorithm. default: Xorhash
+    # - hashtype        either "Xorhash" or "Linconhash" or "MD5hash" or "OPHhash" (one-permutation hashing,
+    #                   a single pass per document for any M), determines the Minhash algorithm. default: Xorhash
+    # - cache           an ArtifactCache (see artifacts.py): the shingles and signatures are taken from the cache,
+    #                   so indexing the same file again with other values of M or r only bands the signatures.
+    #                   default: no cache
+    # - draw            number of the cached family of hash functions to use (only with a cache). default: 0
     # M must be a multiple of r.
-    def create_index(self, filename, M, r, hashtype="Xorhash"):
+    def create_index(self, filename, M, r, hashtype="Xorhash", cache=None, draw=0):
         # assert M % r == 0
+        if cache is not None:
+            self.shinglehash = "mix64"
+            hashfunctions = cache.hashfunctions(M, hashtype, draw)
+            with self.stats.stage("minhash"):
+                signatures = cache.signatures(filename, self._filter, hashfunctions)
+            self.band_index(cache.shingles(filename, self._filter), signatures, hashfunctions, r)
+            return
+        import pandas as pd
         articles = pd.read_csv('./data/%s' % filename)
-        articles['article'] = articles['article'].apply(self._filter)
-        doclist = articles.set_index('News_ID')['article'].to_list()
-        self.docs = doclist
-        # print(len(doclist), "docs")
+        self.build_index(articles['article'].to_list(), M, r, generate_hashfunctions(M, hashtype))
 
-        siglist, self.hashfunctions = generate_signature_matrix(doclist, M, hashtype)
+    # Creates an index of a list of documents with the given hash functions, e.g. to build several
+    # indexes (shards) that share their hash functions
+    # Parameters:
+    # - documents       list of document texts
+    # - M               length of each signature
+    # - r               minhashes per band
+    # - hashfunctions   list of M hash functions (see signature.generate_hashfunctions)
+    @timed("build_index")
+    def build_index(self, documents, M, r, hashfunctions):
+        self.shinglehash = "mix64"
+        with self.stats.stage("pre_processing"):
+            self.docs = ShingleStore.from_sets(shingle_batch(documents, self._filter))
+        self.stats.count("documents", len(documents))
+        if self.stats.enabled:
+            self.stats.observe("shingles_per_doc", np.diff(self.docs.offsets))
+
+        with self.stats.stage("minhash"):
+            siglist = MinhashEngine(hashfunctions).signature_matrix(self.docs, parallel=True)
+        self.band_index(self.docs, siglist, hashfunctions, r)
+
+    # Creates an index of documents of which the shingles and signatures are already computed, e.g. to band
+    # the same signatures with different values of r
+    # Parameters:
+    # - docs            ShingleStore of the documents, pre-processed with self._filter
+    # - signatures      (number of documents x M) signature matrix
+    # - hashfunctions   list of the M hash functions of the signatures
+    # - r               minhashes per band
+    def band_index(self, docs, signatures, hashfunctions, r):
+        self.docs = docs
+        self.hashfunctions = hashfunctions
+        self.engine = MinhashEngine(self.hashfunctions)
+        self.signatures = signatures
         self.r = r
-        self.M = M
-        self.index = self.index_gen(siglist)
+        self.M = len(hashfunctions)
+        self.bandkey = "mix64"
+        with self.stats.stage("band_hashing"):
+            self.index = self.index_gen(signatures)
+        self._record_buckets()
+        self.deleted = set()
+        self._index_changed()
+
+    # Adds documents to an existing (created or loaded) index, using the hash functions of the index
+    # Parameters:
+    # - documents       list of document texts
+    # Returns:
+    # - the document IDs assigned to the new documents
+    @timed("add_documents")
+    def add_documents(self, documents):
+        if self.index is None:
+            print('An index must be created/loaded before adding documents.')
+            return []
+        with self.stats.stage("pre_processing"):
+            shingles = shingle_batch(documents, self._filter)
+        self.stats.count("documents", len(documents))
+        if self.stats.enabled:
+            self.stats.observe("shingles_per_doc", [len(doc) for doc in shingles])
+        with self.stats.stage("minhash"):
+            siglist = self.engine.signature_matrix(shingles, parallel=True)
+        start = len(self.docs)
+        self.docs.extend(shingles)
+        if self.signatures is not None:
+            self.signatures = np.concatenate([self.signatures, siglist])
+        with self.stats.stage("band_hashing"):
+            self.index_gen(siglist, start, self.index)
+        self._index_changed()
+        return list(range(start, start + len(documents)))
+
+    # Removes documents from the index: they are marked as deleted (tombstones) and no longer returned by
+    # queries or get_all_similar_pairs. Their space is only reclaimed by compact().
+    # Parameters:
+    # - doc_ids         IDs of the documents to remove
+    # Raises ValueError (before removing anything) when an ID is not in the index
+    def remove_documents(self, doc_ids):
+        doc_ids = list(doc_ids)
+        for doc_id in doc_ids:
+            if not 0 <= doc_id < len(self.docs):
+                raise ValueError('document %s is not in the index' % doc_id)
+        self.deleted.update(doc_ids)
+        self._index_changed()
+
+    # Reclaims the space of removed documents: they are dropped from all buckets and their shingles are cleared,
+    # and documents added with add_documents are merged into the sorted band arrays
+    # Document IDs stay the same, removed IDs are never reused
+    @timed("compact")
+    def compact(self):
+        deleted = np.fromiter(self.deleted, dtype=np.int64, count=len(self.deleted))
+        for i, band in enumerate(self.index):
+            keys, offsets, postings = band.arrays() if isinstance(band, BandTable) else \
+                BandTable.pack(band, self.bandkey)
+            if len(deleted):
+                keys = np.repeat(keys, np.diff(offsets))
+                alive = ~np.isin(postings, deleted)
+                # a stable sort on the keys keeps the documents of every bucket sorted
+                keys, offsets, postings = bucket_arrays(keys[alive], postings[alive])
+            self.index[i] = BandTable(keys, offsets, postings)
+        if len(deleted):
+            self.docs = ShingleStore.from_sets([doc if i not in self.deleted else set()
+                                                for i, doc in enumerate(self.docs)])
+        self._index_changed()
+
+    # Creates an index of a csv file that doesn't fit in memory: the file is read in chunks which are
+    # pre-processed and signed by a pool of workers, while the signatures, shingles and band entries are
+    # written to disk. The created index is stored in the binary format and loaded (memory-mapped) afterwards.
+    # Parameters:
+    # - filename        name of the csv file containing the documents
+    # - output          name of the index file to be created
+    # - M               length of each signature
+    # - r               minhashes per band
+    # - hashtype        either "Xorhash" or "Linconhash" or "MD5hash" or "OPHhash" (one-permutation hashing,
+    #                   a single pass per document for any M), determines the Minhash algorithm. default: Xorhash
+    # - chunksize       number of articles read and processed at once. default: 10000
+    @timed("stream_index")
+    def stream_index(self, filename, output, M, r, hashtype="Xorhash", chunksize=10000):
+        import pandas as pd
+        hashfunctions = generate_hashfunctions(M, hashtype)
+        self.shinglehash = "mix64"
+        builder = IndexBuilder('./data/%s' % output, M, r, [hashfunc.store() for hashfunc in hashfunctions],
+                               shinglehash=self.shinglehash)
+        # at most two chunks per worker are in flight, so the csv is never read further ahead than that
+        pending = deque()
+        with Pool(usersettings["threads"], initializer=_init_stream_worker,
+                  initargs=(self._filter, hashfunctions, r)) as p:
+            for articles in pd.read_csv('./data/%s' % filename, chunksize=chunksize):
+                pending.append(p.apply_async(_stream_chunk, (articles['article'].to_list(),)))
+                if len(pending) >= 2 * usersettings["threads"]:
+                    builder.add(*pending.popleft().get())
+            while pending:
+                builder.add(*pending.popleft().get())
+        builder.finish()
+        self.load_index(output)
 
     # Compute (s1, p1, s2, p2)-sensitivity of the index, given s1 and s2
     # Parameters:
@@ -86,109 +437,377 @@ class LSH():
             return None
         return pow(1-pow(s1, self.r), self.M//self.r), 1-pow(1-pow(s2, self.r), self.M//self.r)
 
+    # Returns the probe keys of multi-probe lookups (see probe_signatures)
+    # Parameters:
+    # - shingles        list of shingle sets (or a ShingleStore) of the documents
+    # - signatures      their signature matrix
+    # - probes          number of probes per band
+    # Returns:
+    # - (keys, valid): (documents x probes x bands) arrays of the probe keys and of which probes exist
+    def probe_keys(self, shingles, signatures, probes):
+        rows, valid = probe_signatures(signatures, self.engine.runner_up_matrix(shingles), self.r, probes)
+        return band_keys(rows, self.r, self.bandkey).reshape(valid.shape), valid
+
     # Find documents with a similarity to the given query larger than sim
     # Parameters:
     # - query           input query for which near-duplicates should be searched
     # - sim             minimum similarity value
     # - info            determines whether to return the number of candidates (to be able to compute precision)
+    # - probes          number of neighbouring buckets probed per band (multi-probe LSH, see probe_signatures),
+    #                   which finds more similar documents with fewer bands. default: 0
     # Returns:
     # - a list of document IDs that have a Jaccard index to the query larger than the given similarity
-    def query(self, query, sim, info=False):
+    @timed("query")
+    def query(self, query, sim, info=False, probes=0):
         results = []
         if self.index is None:
             print('An index must be created/loaded before querying.')
             return results
         # first convert to 3-shingles (includes pre-processing), then convert to minhash signature
-        shingles = self._filter(query)
-        signature = shingles_to_signature(shingles, self.hashfunctions)
+        with self.stats.stage("pre_processing"):
+            shingles = self._filter(query)
+        self.stats.count("queries")
+        if self.cache is not None:
+            key = QueryCache.key(shingles, sim, probes)
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.stats.count("cache_hits")
+                results, candidate_count = cached
+                return (len(results), candidate_count) if info else list(results)
+        with self.stats.stage("minhash"):
+            signature = self.engine.signature(shingles)
 
         # candidates = union of candidates per band
-        candidates = set()
-        for i in range(0, len(signature) // self.r):
-            # find candidates for this band
-            h = self.hash_band(signature, self.r * i)
-            if h not in self.index[i].keys():
-                continue
-            for band_candidate in self.index[i][h]:
-                candidates.add(band_candidate)
-
-        for candidate in candidates:
-            # check actual near-duplicate for each candidate
-            if compute_jaccard(shingles, self.docs[candidate]) > sim:
-                results.append(candidate)
+        with self.stats.stage("lookup"):
+            candidates = set()
+            keys = band_keys(signature[None, :], self.r, self.bandkey)[0]
+            if probes:
+                extra, valid = self.probe_keys([shingles], signature[None, :], probes)
+            for i in range(0, len(keys)):
+                # find candidates for this band (and its probed neighbours)
+                lookup = keys[i:i+1] if not probes else np.concatenate([keys[i:i+1], extra[0, :, i][valid[0, :, i]]])
+                for bucket in self.index[i].lookup(lookup):
+                    candidates.update(bucket)
+            candidates -= self.deleted
+
+        # check actual near-duplicate for each candidate
+        with self.stats.stage("verification"):
+            candidates = np.array(sorted(candidates), dtype=np.int64)
+            # a single query is verified in this process, also when it has many candidates (in chunks of
+            # VERIFY_CHUNK candidates, like verify_pairs)
+            other = ShingleStore.from_sets([shingles])
+            for start in range(0, len(candidates), VERIFY_CHUNK):
+                chunk = candidates[start:start+VERIFY_CHUNK]
+                found, _, _, pruned_size, pruned_prefix = filter_pairs(
+                    self.docs, other, chunk, np.zeros(len(chunk), dtype=np.int64), sim, True)
+                self.stats.count("pruned_by_size", pruned_size)
+                self.stats.count("pruned_by_prefix", pruned_prefix)
+                results += found.tolist()
+        self.stats.count("query_candidates", len(candidates))
+        self.stats.count("query_results", len(results))
+        self.stats.observe("candidates_per_query", len(candidates))
+        if self.cache is not None:
+            self.cache.put(key, (tuple(results), len(candidates)))
 
         if info:
             return len(results), len(candidates)
         return results
 
+    # Runs a batch of queries at once: all queries are pre-processed and signed together, every distinct band
+    # hash of the batch is looked up only once and the candidates of all queries are verified in parallel
+    # Parameters:
+    # - queries         list of input queries
+    # - sim             minimum similarity value
+    # - info            determines whether to return the number of candidates per query (like query)
+    # - probes          number of neighbouring buckets probed per band (like query). default: 0
+    # Returns:
+    # - for every query, the list of document IDs with a Jaccard index to the query larger than sim
+    #   or (number of results, number of candidates) if info is set
+    @timed("query_batch")
+    def query_batch(self, queries, sim, info=False, probes=0):
+        if self.index is None:
+            print('An index must be created/loaded before querying.')
+            return []
+        with self.stats.stage("pre_processing"):
+            shingles = shingle_batch(queries, self._filter)
+        self.stats.count("queries", len(queries))
+        # only the queries without a cached result are looked up
+        cached = [None] * len(queries)
+        if self.cache is not None:
+            keys = [QueryCache.key(query_shingles, sim, probes) for query_shingles in shingles]
+            cached = [self.cache.get(key) for key in keys]
+        todo = [q for q in range(len(queries)) if cached[q] is None]
+        self.stats.count("cache_hits", len(queries) - len(todo))
+        results, candidates = self.query_shingles([shingles[q] for q in todo], sim, probes)
+        for q, query_results, query_candidates in zip(todo, results, candidates):
+            cached[q] = (tuple(query_results), len(query_candidates))
+            if self.cache is not None:
+                self.cache.put(keys[q], cached[q])
+
+        if info:
+            return [(len(query_results), candidate_count) for query_results, candidate_count in cached]
+        return [list(query_results) for query_results, _ in cached]
+
+    # Looks up and verifies a batch of pre-processed queries (see query_batch), bypassing the cache
+    # Parameters:
+    # - shingles        list of shingle arrays, as produced by self._filter
+    # - sim             minimum similarity value
+    # - probes          number of neighbouring buckets probed per band (see query). default: 0
+    # - signatures      signature matrix of the queries, e.g. computed once for several indexes with the same
+    #                   hash functions. default: computed here
+    # - keys            band keys of the signatures (see band_keys). default: computed here
+    # Returns:
+    # - (results, candidates): the list of resulting document IDs and the list of candidates of every query
+    def query_shingles(self, shingles, sim, probes=0, signatures=None, keys=None):
+        if len(shingles) == 0:
+            return [], []
+        if signatures is None:
+            with self.stats.stage("minhash"):
+                signatures = self.engine.signature_matrix(shingles, parallel=True)
+
+        # look up each distinct band key once for all queries that share it
+        with self.stats.stage("lookup"):
+            candidates = [set() for _ in shingles]
+            if keys is None:
+                keys = band_keys(signatures, self.r, self.bandkey)
+            owners = np.arange(len(shingles))
+            if probes:
+                extra, valid = self.probe_keys(shingles, signatures, probes)
+            for i in range(0, self.M // self.r):
+                band, band_owners = keys[:, i], owners
+                if probes:
+                    band = np.concatenate([band, extra[:, :, i][valid[:, :, i]]])
+                    band_owners = np.concatenate([owners, np.nonzero(valid[:, :, i])[0]])
+                distinct, inverse = np.unique(band, return_inverse=True)
+                buckets = self.index[i].lookup(distinct)
+                for q, key in zip(band_owners.tolist(), inverse.tolist()):
+                    candidates[q].update(buckets[key])
+            candidates = [sorted(query_candidates - self.deleted) for query_candidates in candidates]
+
+        # verify all (candidate, query) pairs at once
+        with self.stats.stage("verification"):
+            counts = [len(query_candidates) for query_candidates in candidates]
+            first = np.fromiter((c for query_candidates in candidates for c in query_candidates), dtype=np.int64,
+                                count=sum(counts))
+            second = np.repeat(np.arange(len(shingles)), counts)
+            first, second, _ = verify_pairs(self.docs, first, second, sim, ShingleStore.from_sets(shingles),
+                                          stats=self.stats)
+            results = [[] for _ in shingles]
+            for doc_id, q in zip(first.tolist(), second.tolist()):
+                results[q].append(doc_id)
+        self.stats.count("query_candidates", sum(counts))
+        self.stats.count("query_results", len(first))
+        self.stats.observe("candidates_per_query", counts)
+        return results, candidates
+
     # Hash a band of a signature: i denotes the starting index of the band
     # Parameters:
     # - sig             the full signature
     # - i               starting index of the band
     # Returns:
-    # - an MD5 hash of this band as a 32-character hexadecimal string
+    # - the key of this band: a 64-bit int (mix64 keys) or an MD5 hash as a 32-character hexadecimal string
     def hash_band(self, sig, i):
-        m = md5()
-        for value in tuple(sig[i:i+self.r]):
-            m.update(value.to_bytes(8, 'big', signed=False))
-        return m.hexdigest()
+        if self.bandkey == "md5":
+            # big-endian 8-byte values, identical to hashing value.to_bytes(8, 'big') one by one
+            return md5(np.asarray(sig[i:i+self.r], dtype='>u8').tobytes()).hexdigest()
+        return int(band_hashes(np.asarray(sig[i:i+self.r])[None, :], self.r)[0, 0])
 
     # Creates an index with populated buckets given the signature matrix
+    # The keys of all bands of all documents are computed at once, each band table is then built by sorting
     # Parameters:
-    # - siglist         list of columns in the signature matrix
+    # - siglist         (number of documents x M) signature matrix
+    # - start           document ID of the first row of siglist
+    # - index           existing index to add the documents to. default: a new index is created
     # Returns:
-    # - the generated buckets as a list of dictionaries, where the index into
-    #   the first list is the band number, and the key into the dictionary is
+    # - the generated buckets as a list of BandTables, where the index into
+    #   the list is the band number, and the key into the table is
     #   the hash of the band. the buckets are a list
-    def index_gen(self, siglist):
-        index = [defaultdict(list) for _ in range(self.M // self.r)]
-        doc_id = 0
-        lim = self.M // self.r * self.r
-        for doc in siglist:
-            for i in range(0, lim, self.r):
-                index[i // self.r][self.hash_band(doc, i)].append(doc_id)
-            doc_id += 1
+    def index_gen(self, siglist, start=0, index=None):
+        keys = band_keys(siglist, self.r, self.bandkey)
+        doc_ids = np.arange(start, start + len(keys))
+        if index is None:
+            return [BandTable.from_keys(keys[:, i], doc_ids) for i in range(self.M // self.r)]
+        for i, band in enumerate(index):
+            for key, doc_id in zip(keys[:, i], doc_ids.tolist()):
+                band.add(key, doc_id)
         return index
 
     # Returns all near-duplicate pairs with a similarity above the given threshold
-    # This function also writes the document IDs into a file result.csv
+    # This function also writes the document IDs into a csv file (result.csv by default)
     # Parameters:
     # - treshold        minimum similarity for near-duplicates
+    # - max_bucket      maximum bucket size used for candidate generation, larger buckets (e.g. boilerplate
+    #                   articles) are handled according to oversized. default: no limit
+    # - oversized       "skip" or "sample": skip oversized buckets or only pair a random sample of
+    #                   max_bucket of their documents. default: skip
+    # - output          name of the csv file the pairs are written to, None to not write them. default: result.csv
+    # - probes          number of neighbouring buckets probed per band and document (multi-probe LSH, see
+    #                   probe_signatures): pairs of which one document's probe hits the other's bucket are
+    #                   candidates too. default: 0
     # Returns:
     # - list of all candidate pairs and the Jaccard index [((doc1, doc2), sim), ...]
-    def get_all_similar_pairs(self, treshold):
-        # 1) loop over all buckets & find pairs (i, j) with i < j (so we don't do (i, j) and (j, i))
-        candidates = set()
-        for i in range(0, self.M // self.r):
-            for bucket in self.index[i].values():
-                for j in bucket:
-                    for k in bucket:
-                        if j < k:
-                            candidates.add((j, k))
-
-        print("Found", len(candidates), "candidate pairs")
+    @timed("get_all_similar_pairs")
+    def get_all_similar_pairs(self, treshold, max_bucket=None, oversized="skip", output='result.csv', probes=0):
+        # 1) find all pairs (i, j) with i < j sharing a bucket in at least one band (so we don't do (i, j) and (j, i))
+        with self.stats.stage("candidate_generation"):
+            first, second, skipped = candidate_pairs(self.index, max_bucket, oversized, deleted=self.deleted)
+            if probes:
+                first, second = self._probe_candidates(first, second, probes, max_bucket)
+        self.stats.count("candidate_pairs", len(first))
+        self.stats.count("skipped_pairs", skipped)
+
+        print("Found", len(first), "candidate pairs")
+        if skipped:
+            print("Skipped", skipped, "pairs in buckets larger than", max_bucket)
 
         # 2) calculate the Jaccard index on the shingles of these documents and only
         #    keep the pairs that are actually similar
-        results = set()
-        doc_ids1 = []
-        doc_ids2 = []
-        for pair in candidates:
-            sim = compute_jaccard(self.docs[pair[0]], self.docs[pair[1]])
-            if sim > treshold:
-                doc_ids1.append(pair[0])
-                doc_ids2.append(pair[1])
-                results.add((pair, sim))
+        with self.stats.stage("verification"):
+            first, second, sims = verify_pairs(self.docs, first, second, treshold, stats=self.stats)
+        self.stats.count("similar_pairs", len(first))
+        doc_ids1 = first.tolist()
+        doc_ids2 = second.tolist()
+        results = set(zip(zip(doc_ids1, doc_ids2), sims.tolist()))
 
         print("Found", len(results), "near-duplicate pairs")
 
         # write similar pairs to output csv
-        results_csv = pd.DataFrame({'doc_id1': doc_ids1, 'doc_id2': doc_ids2})
-        results_csv.sort_values(["doc_id1", "doc_id2"], inplace=True)
-        results_csv.to_csv('result.csv', index=False)
+        if output:
+            import pandas as pd
+            results_csv = pd.DataFrame({'doc_id1': doc_ids1, 'doc_id2': doc_ids2})
+            results_csv.sort_values(["doc_id1", "doc_id2"], inplace=True)
+            results_csv.to_csv(output, index=False)
+            self.stats.count("bytes_written", os.path.getsize(output))
 
         return results
 
+    # Groups the near-duplicate documents into clusters instead of listing every near-duplicate pair: documents
+    # are merged with a union-find structure while the buckets are scanned, and pairs of documents that are in
+    # the same cluster already are never verified (see clustering.py). A cluster of k copies of an article costs
+    # about k - 1 Jaccard computations and k rows of output, instead of k * (k - 1) / 2 of both.
+    # The clusters are the connected components of the near-duplicate pairs of get_all_similar_pairs.
+    # Parameters:
+    # - treshold        minimum similarity for near-duplicates
+    # - representative  verify candidates against the representative (smallest document ID) of every other
+    #                   cluster in their bucket only, which verifies fewer pairs but may split clusters. default: False
+    # - max_bucket, oversized: see get_all_similar_pairs
+    # - output          name of the csv file with the columns doc_id, cluster_id (the smallest document ID of the
+    #                   cluster) for every document, None to not write it. default: clusters.csv
+    # Returns:
+    # - array of the cluster ID of every document, -1 for removed documents
+    @timed("get_clusters")
+    def get_clusters(self, treshold, representative=False, max_bucket=None, oversized="skip", output='clusters.csv'):
+        with self.stats.stage("clustering"):
+            labels, verified = cluster_documents(self.index, self.docs, treshold, representative, max_bucket,
+                                                 oversized, deleted=self.deleted, stats=self.stats)
+        doc_ids = np.nonzero(labels >= 0)[0]
+        sizes = np.bincount(labels[doc_ids], minlength=len(labels))
+        print("Verified", verified, "candidate pairs")
+        print("Found", int((sizes > 1).sum()), "clusters of near-duplicates with", int(sizes[sizes > 1].sum()),
+              "documents")
+
+        if output:
+            import pandas as pd
+            pd.DataFrame({'doc_id': doc_ids, 'cluster_id': labels[doc_ids]}).to_csv(output, index=False)
+            self.stats.count("bytes_written", os.path.getsize(output))
+
+        return labels
+
+    # adds the candidate pairs found by probing the neighbouring buckets of every document to candidate pairs
+    def _probe_candidates(self, first, second, probes, max_bucket, chunk=10000):
+        docs = np.array([doc for doc in range(len(self.docs)) if doc not in self.deleted], dtype=np.int64)
+        pairs = [(first, second)]
+        for start in range(0, len(docs), chunk):
+            ids = docs[start:start+chunk]
+            shingles = [self.docs[doc] for doc in ids.tolist()]
+            signatures = self.signatures[ids] if self.signatures is not None else \
+                self.engine.signature_matrix(shingles)
+            extra, valid = self.probe_keys(shingles, signatures, probes)
+            pairs.append(probe_pairs(self.index, extra, valid, ids, max_bucket, self.deleted))
+        return union_pairs(*pairs)
+
+    # Generator of all near-duplicate pairs (see get_all_similar_pairs) using bounded memory: the candidate pairs
+    # are spilled to disk in partitions of first document ids, which are verified one at a time
+    # Parameters:
+    # - treshold, max_bucket, oversized: see get_all_similar_pairs
+    # - pairs_per_partition approximate number of candidate pairs verified at once. default: 2**22
+    # - progress            dictionary describing the run, which is updated before every partition is yielded
+    #                       (JSON serializable). Passing the progress of an interrupted run continues it with
+    #                       the partition after the last one that was handled. default: a new run
+    # - directory           directory for the partition files. default: a temporary directory
+    # Returns:
+    # - a generator of (first, second, similarities) arrays per partition, all pairs sorted by (first, second)
+    def iter_similar_pairs(self, treshold, max_bucket=None, oversized="skip", pairs_per_partition=2**22,
+                           progress=None, directory=None):
+        progress = {} if progress is None else progress
+        # removing another set of documents of the same size must not match, so the IDs themselves are compared
+        deleted = md5(np.array(sorted(self.deleted), dtype=np.int64).tobytes()).hexdigest()
+        if 'bounds' in progress:
+            assert (progress['treshold'], progress['max_bucket'], progress['oversized'], progress['documents'],
+                    progress['deleted']) == (treshold, max_bucket, oversized, len(self.docs), deleted), \
+                "the progress belongs to a run with other parameters or another index"
+        else:
+            progress.update({'treshold': treshold, 'max_bucket': max_bucket, 'oversized': oversized,
+                             'documents': len(self.docs), 'deleted': deleted,
+                             # sampled buckets must be sampled the same way when the run is continued
+                             'seed': random.getrandbits(63), 'partition': 0, 'pairs': 0})
+
+        with tempfile.TemporaryDirectory(dir=directory) as spill:
+            with self.stats.stage("candidate_generation"):
+                bounds, files, skipped = spill_candidate_pairs(self.index, spill, pairs_per_partition, max_bucket,
+                                                               oversized, seed=progress['seed'],
+                                                               deleted=self.deleted, bounds=progress.get('bounds'),
+                                                               start=progress['partition'])
+            if 'bounds' not in progress:
+                progress['bounds'] = bounds.tolist()
+                if skipped:
+                    print("Skipped", skipped, "pairs in buckets larger than", max_bucket)
+            for i in range(progress['partition'], len(files)):
+                first, second = read_partition(files[i])
+                os.remove(files[i])
+                self.stats.count("candidate_pairs", len(first))
+                with self.stats.stage("verification"):
+                    first, second, sims = verify_pairs(self.docs, first, second, treshold, stats=self.stats)
+                self.stats.count("similar_pairs", len(first))
+                progress['partition'] = i + 1
+                progress['pairs'] += len(first)
+                yield first, second, sims
+
+    # Writes all near-duplicate pairs to a sink (see sinks.py) as they are verified, using bounded memory
+    # (see iter_similar_pairs). With a checkpoint file, a run that was interrupted continues where it stopped.
+    # Parameters:
+    # - treshold, max_bucket, oversized: see get_all_similar_pairs
+    # - sink                a sink, e.g. CSVSink('result.csv'), ChunkSink(directory) or CallbackSink(callback)
+    # - checkpoint          name of the checkpoint file, written after every partition and removed when the
+    #                       run is finished. default: no checkpoints
+    # - options             passed on to iter_similar_pairs (pairs_per_partition, directory)
+    # Returns:
+    # - the number of near-duplicate pairs
+    @timed("stream_similar_pairs")
+    def stream_similar_pairs(self, treshold, sink, max_bucket=None, oversized="skip", checkpoint=None, **options):
+        progress = {}
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint, 'r') as checkpoint_file:
+                progress = json.load(checkpoint_file)
+            sink.restore(progress['sink'])
+            print("Continuing from partition", progress['partition'], "of", len(progress['bounds']) - 1)
+
+        for first, second, sims in self.iter_similar_pairs(treshold, max_bucket, oversized, progress=progress,
+                                                           **options):
+            sink.write(first, second, sims)
+            if checkpoint:
+                progress['sink'] = sink.checkpoint()
+                # replaced at once, so an interruption never leaves a partial checkpoint
+                with open(checkpoint + '.tmp', 'w') as checkpoint_file:
+                    json.dump(progress, checkpoint_file)
+                os.replace(checkpoint + '.tmp', checkpoint)
+        sink.close()
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+        print("Found", progress['pairs'], "near-duplicate pairs")
+        return progress['pairs']
+
 
 if __name__ == "__main__":
     lsh = LSH()
@@ -202,11 +821,11 @@ if __name__ == "__main__":
     print("The index is (%s, %s, %s, %s)-sensitive" % (s1, p1, s2, p2))
 
     t = time.time()
-    lsh.store_index('index_5.json')
+    lsh.store_index('index_5.lsh')
     print("Storing index took", time.time() - t, "sec")
 
     t = time.time()
-    lsh2 = LSH('index_5.json')
+    lsh2 = LSH('index_5.lsh')
     print("Loading index took", time.time() - t, "sec")
 
     t = time.time()
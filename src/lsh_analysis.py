@@ -1,10 +1,16 @@
+from artifacts import ArtifactCache
 from lsh import LSH
+from tuning import tune_collection
 import time
 import random
 import pandas as pd
 
+# Shingles and signatures of news_articles_small.csv are computed once for all settings through an ArtifactCache
+# (created in __main__ and passed to the tests, a test without one creates its own): every iteration of
+# test_precision uses its own family of hash functions, of which the signatures are shared by all M and r
+
 # determine index creation time, specificity and sensitivity for different similarity thresholds (0.7, 0.8 and 0.9)
-def perform_analysis(M, r, queries):
+def perform_analysis(M, r, queries, cache=None):
     lsh = LSH()
     t = time.time()
     lsh.create_index('news_articles_small.csv', M, r)
@@ -13,19 +19,19 @@ def perform_analysis(M, r, queries):
     for s2 in [0.7, 0.8, 0.9]:
         p1, p2 = lsh.compute_sensitivity(s1, s2)
         print("The index is (%s, %s, %s, %s)-sensitive" % (s1, p1, s2, p2))
-        print("Precision for similarity threshold %s:" % s2, test_precision(M, r, s2, queries, 10))
+        print("Precision for similarity threshold %s:" % s2, test_precision(M, r, s2, queries, 10, cache))
 
 # determine precision on set of queries
 # a query is an original document that has been mutated
-def test_precision(M, r, sim, queries, iterations):
+def test_precision(M, r, sim, queries, iterations, cache=None):
+    cache = ArtifactCache() if cache is None else cache
     precision_values = []
     for i in range(iterations):
         lsh = LSH()
-        lsh.create_index('news_articles_small.csv', M, r)
+        lsh.create_index('news_articles_small.csv', M, r, cache=cache, draw=i)
         result_amount = 0
         candidate_amount = 0
-        for query in queries:
-            results, candidates = lsh.query(query, sim, True)
+        for results, candidates in lsh.query_batch(queries, sim, True):
             result_amount += results
             candidate_amount += candidates
         precision_values.append(result_amount/candidate_amount)
@@ -33,6 +39,18 @@ def test_precision(M, r, sim, queries, iterations):
     # return average precision over all iterations
     return sum(precision_values)/iterations
 
+# determine the results, candidates and query time of multi-probe queries with different numbers of probes per band
+# (more probes find more of the similar documents with the same bands, at the cost of more lookups)
+def test_multiprobe(M, r, sim, queries, probe_counts=(0, 1, 2, 5, 10), cache=None):
+    lsh = LSH()
+    lsh.create_index('news_articles_small.csv', M, r, cache=ArtifactCache() if cache is None else cache)
+    for probes in probe_counts:
+        t = time.time()
+        counts = lsh.query_batch(queries, sim, True, probes=probes)
+        print('M=%s, r=%s, %s probes per band: %s results, %s candidates in %s seconds' % (
+            M, r, probes, sum(results for results, _ in counts), sum(candidates for _, candidates in counts),
+            time.time() - t))
+
 # generates n queries by mutating original documents
 def generate_mutated_queries(n):
     mutations = ['random', 'mutation', 'specificity', 'sensitivity', 'precision']
@@ -49,11 +67,22 @@ def generate_mutated_queries(n):
 if __name__ == "__main__":
     # use 100 queries for determining precision
     queries = generate_mutated_queries(100)
+    cache = ArtifactCache()
 
     # perform analysis for different combinations of signature length M and number of rows per band r
     for M in [20, 50, 100]:
             for r in [2, 4, 5, 10]:
-                perform_analysis(M, r, queries)
+                perform_analysis(M, r, queries, cache)
     
-    # determine for optimal parameters
-    perform_analysis(96, 6, queries)
+    # determine for the parameters chosen by the tuner (tolerance zone 0.3 - 0.8)
+    tuned = tune_collection('news_articles_small.csv', 0.3, 0.8)
+    if tuned is None:
+        print('No setting of M and r meets the error targets for the tolerance zone 0.3 - 0.8, '
+              'use a wider zone or larger max_fp/max_fn')
+    else:
+        print('Tuned parameters:', tuned)
+        perform_analysis(tuned['M'], tuned['r'], queries, cache)
+
+    # recall of a small index with multi-probe queries, compared to an index with four times as many bands
+    test_multiprobe(20, 5, 0.7, queries, cache=cache)
+    test_multiprobe(100, 5, 0.7, queries, [0], cache)
@@ -1,15 +1,49 @@
 import re
+from functools import lru_cache, partial
 from types import prepare_class
-from hashlib import md5
+from hashlib import blake2b, md5
+
+import numpy as np
+
+from usersettings import usersettings
+from workers import get_pool
 
 # List of stopwords comes from the "nltk" package
 STOPWORDS = ["ourselves", "hers", "between", "yourself", "but", "again", "there", "about", "once", "during", "out", "very", "having", "with", "they", "own", "an", "be", "some", "for", "do", "its", "yours", "such", "into", "of", "most", "itself", "other", "off", "is", "s", "am", "or", "who", "as", "from", "him", "each", "the", "themselves", "until", "below", "are", "we", "these", "your", "his", "through", "don", "nor", "me", "were", "her", "more", "himself", "this", "down", "should", "our", "their", "while",
              "above", "both", "up", "to", "ours", "had", "she", "all", "no", "when", "at", "any", "before", "them", "same", "and", "been", "have", "in", "will", "on", "does", "yourselves", "then", "that", "because", "what", "over", "why", "so", "can", "did", "not", "now", "under", "he", "you", "herself", "has", "just", "where", "too", "only", "myself", "which", "those", "i", "after", "few", "whom", "t", "being", "if", "theirs", "my", "against", "a", "by", "doing", "it", "how", "further", "was", "here", "than"]
+STOPWORD_SET = frozenset(STOPWORDS)
 # Regex for matching reference: https://stackoverflow.com/questions/19560498/faster-way-to-remove-stop-words-in-python
 STOPWORDS_REGEX = re.compile(r"\b(" + r"|".join(STOPWORDS) + r")\b\s*")
 # Matches everything that is not whitespace or alphanumerical
 PUNCTUATION_REGEX = re.compile(r"[^\w\s]")
 
+# hash functions for shingles
+# - "md5"           64 bits of the MD5 of the shingle text, one MD5 per shingle (indexes created before mix64)
+# - "mix64"         every token is hashed once (64-bit BLAKE2b), the hashes of the k tokens of all shingles of a
+#                   document are then combined at once with an fmix64 chain (like the band keys in lsh.py)
+SHINGLE_HASHES = ["mix64", "md5"]
+SHINGLE_SEED = np.uint64(0x2545f4914f6cdd1d)
+
+# multiplier constants of the MurmurHash3 64-bit finalizer
+FMIX_C1 = np.uint64(0xff51afd7ed558ccd)
+FMIX_C2 = np.uint64(0xc4ceb9fe1a85ec53)
+
+# maximum number of token hashes cached by _token_hash (per process, about 12 MB when full)
+TOKEN_CACHE_SIZE = 2**16
+
+# minimum number of documents for which shingle_batch uses a process pool
+POOL_MIN_DOCS = 256
+
+
+# MurmurHash3 64-bit finalizer: a bijective mixing function on uint64 arrays
+def fmix64(h):
+    h ^= h >> np.uint64(33)
+    h *= FMIX_C1
+    h ^= h >> np.uint64(33)
+    h *= FMIX_C2
+    h ^= h >> np.uint64(33)
+    return h
+
 
 # stopword removal, capitalization removal, punctuation removal
 def pre_processing(doc: str, **kwargs) -> str:
@@ -27,26 +61,118 @@ def pre_processing(doc: str, **kwargs) -> str:
 
 # hash function we use to hash shingles: simply take 64 bits of the MD5 (similar to the MD5Hash in signature.py)
 def shinglemd5(shingle):
-    bytestr = str.encode(" ".join(shingle))
-    m = md5()
-    m.update(bytestr)
-    return int(m.hexdigest()[0:16], 16)
+    return int.from_bytes(md5(" ".join(shingle).encode()).digest()[:8], 'big')
 
 
-# turns a document into a set of hashed shingles (different pre-processing filters possible, length of shingles adaptable by providing k)
-def to_shingles(doc, k=3, filter_punctuation=False, filter_stopwords=False, remove_capitalization=False, stopword_start=False):
+# 64-bit hash of a token
+# The hashes of the most frequent tokens are kept in a small per-process LRU cache: a short BLAKE2b is cheap,
+# so the cache only needs to hold the common vocabulary
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def _token_hash(token):
+    return int.from_bytes(blake2b(token.encode(), digest_size=8).digest(), 'little')
+
+
+# 64-bit hashes of a list of tokens
+def _token_hashes(tokens):
+    return np.fromiter(map(_token_hash, tokens), dtype=np.uint64, count=len(tokens))
+
+
+# pre-processes and tokenizes a document
+# Returns:
+# - (tokens, starts): the tokens of the document and the positions at which a shingle of k tokens starts
+def _shingle_starts(doc, k, filter_punctuation, filter_stopwords, remove_capitalization, stopword_start):
     assert (not (filter_stopwords and stopword_start))
-    shingles = set()
-    doc = pre_processing(doc, punctuation=filter_punctuation,
-                         stopwords=filter_stopwords, capitalization=remove_capitalization)
-    doc = doc.split()
-    for i in range(0, len(doc)-k+1):
-        # shingles.add(hash(tuple(doc[i:i+k])))
-        if not stopword_start or doc[i] in STOPWORDS:
-            shingles.add(shinglemd5(doc[i:i+k]))
+    tokens = pre_processing(doc, punctuation=filter_punctuation,
+                            stopwords=filter_stopwords, capitalization=remove_capitalization).split()
+    starts = range(0, len(tokens)-k+1)
+    if stopword_start:
+        starts = [i for i in starts if tokens[i] in STOPWORD_SET]
+    return tokens, starts
+
+
+# turns a document into a sorted uint64 array of hashed shingles (different pre-processing filters possible,
+# length of shingles adaptable by providing k, shinglehash is either "mix64" or "md5", see SHINGLE_HASHES)
+def shingle_hashes(doc, k=3, filter_punctuation=False, filter_stopwords=False, remove_capitalization=False,
+                   stopword_start=False, shinglehash="md5"):
+    assert shinglehash in SHINGLE_HASHES
+    tokens, starts = _shingle_starts(doc, k, filter_punctuation, filter_stopwords, remove_capitalization,
+                                     stopword_start)
+    if shinglehash == "md5":
+        return np.sort(np.fromiter({shinglemd5(tokens[i:i+k]) for i in starts}, dtype=np.uint64))
+    return np.unique(_mix_shingles(_token_hashes(tokens), np.asarray(starts, dtype=np.int64), k))
+
+
+# mix64 hashes of the shingles of k tokens starting at the given positions
+def _mix_shingles(token_hashes, starts, k):
+    shingles = np.full(len(starts), SHINGLE_SEED, dtype=np.uint64)
+    for j in range(k):
+        shingles = fmix64(shingles ^ token_hashes[starts + j])
     return shingles
 
 
+# Shingles a document with several pre-processing variants in a single pass (mix64 shingle hashes):
+# the document is normalized and tokenized once per distinct combination of filters, the shingles of all
+# positions are hashed once and variants which only differ in stopword_start take a subset of them
+# Parameters:
+# - doc             document text
+# - variants        list of dictionaries of shingle_hashes options (filter_punctuation, filter_stopwords,
+#                   remove_capitalization, stopword_start)
+# - k               length of the shingles
+# Returns:
+# - a sorted uint64 shingle array per variant
+def shingle_variants(doc, variants, k=3):
+    normalized = {}
+    out = []
+    for options in variants:
+        assert (not (options.get('filter_stopwords') and options.get('stopword_start')))
+        filters = (options.get('filter_punctuation', False), options.get('filter_stopwords', False),
+                   options.get('remove_capitalization', False))
+        if filters not in normalized:
+            tokens = pre_processing(doc, punctuation=filters[0], stopwords=filters[1],
+                                    capitalization=filters[2]).split()
+            shingles = _mix_shingles(_token_hashes(tokens), np.arange(max(0, len(tokens)-k+1)), k)
+            normalized[filters] = (tokens, shingles)
+        tokens, shingles = normalized[filters]
+        if options.get('stopword_start'):
+            shingles = shingles[[token in STOPWORD_SET for token in tokens[:len(shingles)]]]
+        out.append(np.unique(shingles))
+    return out
+
+
+# turns a document into a set of hashed shingles (different pre-processing filters possible, length of shingles adaptable by providing k)
+def to_shingles(doc, k=3, filter_punctuation=False, filter_stopwords=False, remove_capitalization=False,
+                stopword_start=False, shinglehash="md5"):
+    if shinglehash != "md5":
+        return set(shingle_hashes(doc, k, filter_punctuation, filter_stopwords, remove_capitalization,
+                                  stopword_start, shinglehash).tolist())
+    tokens, starts = _shingle_starts(doc, k, filter_punctuation, filter_stopwords, remove_capitalization,
+                                     stopword_start)
+    return {shinglemd5(tokens[i:i+k]) for i in starts}
+
+
+# turns a list of documents into sorted uint64 shingle arrays, spread over the persistent pool of workers.py
+# for large batches
+# Parameters:
+# - docs            list of document texts
+# - _filter         function turning a document into shingles. default: shingle_hashes without filters
+def shingle_batch(docs, _filter=shingle_hashes):
+    if len(docs) < POOL_MIN_DOCS or usersettings["threads"] <= 1:
+        return [shingle_array(_filter(doc)) for doc in docs]
+    return get_pool().map(partial(_shingle_one, _filter=_filter), docs,
+                          chunksize=max(1, len(docs) // (4 * usersettings["threads"])))
+
+
+def _shingle_one(doc, _filter):
+    return shingle_array(_filter(doc))
+
+
+# converts a set of hashed shingles into a sorted uint64 array (arrays are assumed to be sorted already)
+def shingle_array(shingles):
+    if isinstance(shingles, np.ndarray):
+        return shingles.astype(np.uint64, copy=False)
+    return np.sort(np.fromiter(shingles, dtype=np.uint64, count=len(shingles)))
+
+
 if __name__ == "__main__":
     # test for pre-processing filters
     teststring = "ThiS IS A test StR.Ing,, 5589.48q,"
@@ -0,0 +1,64 @@
+import time
+
+# started before any other import, so the startup report includes importing numpy and the LSH modules
+START = time.perf_counter()
+
+import argparse
+import sys
+
+# Fast-start query command line: answers queries on a stored index and reports where the startup time went
+# (importing, loading the index, first answer). Meant for short-lived checks and scripts, a long-running
+# process should use the query server (server.py) instead.
+# Startup stays small because:
+# - only numpy and the LSH modules are imported, pandas is only imported when csv files are read or written
+# - a binary index is memory-mapped (see storage.read_index): the band tables are only read from disk where a
+#   lookup touches them, and only the shingles of the candidates of a query are read for verification
+# A JSON index is parsed completely, so convert it once with LSH.store_index(filename, fmt="binary").
+# Usage:
+#   python query.py index.bin "text of the query" [--sim 0.8] [--probes 0] [--info]
+#   python query.py index.bin --file queries.txt    (one query per line, "-" reads them from stdin)
+
+
+# milliseconds since the given perf_counter time
+def _ms(since):
+    return (time.perf_counter() - since) * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Query a stored LSH index')
+    parser.add_argument('index', help='name of the index file in ./data')
+    parser.add_argument('query', nargs='*', help='query texts')
+    parser.add_argument('--file', help='file with one query per line ("-" for stdin)')
+    parser.add_argument('--sim', type=float, default=0.8, help='minimum similarity')
+    parser.add_argument('--probes', type=int, default=0, help='neighbouring buckets probed per band')
+    parser.add_argument('--info', action='store_true', help='print the number of results and candidates')
+    parser.add_argument('--quiet', action='store_true', help='only print the results')
+    args = parser.parse_args()
+
+    queries = list(args.query)
+    if args.file:
+        with (sys.stdin if args.file == '-' else open(args.file, 'r')) as query_file:
+            queries += [line.rstrip('\n') for line in query_file if line.strip()]
+
+    t = time.perf_counter()
+    from lsh import LSH
+    import_ms = _ms(t)
+    t = time.perf_counter()
+    lsh = LSH(args.index)
+    load_ms = _ms(t)
+
+    first_ms = None
+    for query in queries:
+        result = lsh.query(query, args.sim, args.info, args.probes)
+        if first_ms is None:
+            first_ms = _ms(START)
+        if args.info:
+            print(*result)
+        else:
+            print(' '.join(str(doc_id) for doc_id in result))
+
+    if not args.quiet:
+        print('Startup: importing took %.1f ms, loading the index %.1f ms' % (import_ms, load_ms), file=sys.stderr)
+        if first_ms is not None:
+            print('Time to first answer: %.1f ms (%s queries in %.1f ms)' % (first_ms, len(queries), _ms(START)),
+                  file=sys.stderr)
@@ -0,0 +1,266 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from lsh import LSH
+from usersettings import usersettings
+
+# Long-running query server: loads an index once and answers JSON queries over HTTP (TCP or a Unix socket)
+# Requests:
+# - POST /query     {"query": text, "sim": minimum similarity (default 0.8), "info": bool (default false)}
+#                   returns {"results": [document IDs]}, or {"results": n, "candidates": m} if info is set
+# - GET /stats      counters of the server
+# Concurrent queries are coalesced into micro-batches, which are answered with LSH.query_batch (one signature
+# matrix and one band lookup per batch) by a pool of worker processes that each hold the index, so the event
+# loop never blocks. When too many queries are pending, new ones are refused (503) instead of queueing
+# without bound, and queries that aren't answered within the timeout get a 504.
+
+# status lines of the responses the server sends
+STATUS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    503: "Service Unavailable",
+    504: "Gateway Timeout"
+}
+# largest accepted request body, in bytes
+MAX_BODY = 16 * 2**20
+
+
+# index of a server worker process, loaded once by the pool initializer
+_server_lsh = None
+
+
+def _init_worker(filename, cache_size):
+    global _server_lsh
+    # every server worker already runs in a process of its own, so it never starts a pool of its own
+    usersettings["threads"] = 1
+    _server_lsh = LSH(filename)
+    if cache_size:
+        _server_lsh.enable_cache(cache_size)
+
+
+# process ID of a server worker, which has loaded its index when it runs a task
+# The short sleep keeps the worker busy, so the other warm-up tasks go to the other workers
+def _worker_pid():
+    time.sleep(0.01)
+    return os.getpid()
+
+
+# answers a batch of queries with the same options in a server worker
+def _run_batch(queries, sim, info):
+    return _server_lsh.query_batch(queries, sim, info)
+
+
+class Overloaded(Exception):
+    pass
+
+
+# Coalesces concurrent queries into batches: a batch is dispatched as soon as it holds max_batch queries or
+# max_wait seconds after its first query arrived. At most one batch per worker is in flight at once.
+class MicroBatcher:
+    # Parameters:
+    # - executor        process pool of which the workers hold the index
+    # - workers         number of workers of the pool
+    # - max_batch       maximum number of queries per batch
+    # - max_wait        maximum number of seconds a query waits for others to join its batch
+    # - max_pending     maximum number of queries waiting for an answer, further queries are refused
+    def __init__(self, executor, workers, max_batch=32, max_wait=0.005, max_pending=1024):
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(workers)
+        self.pending = 0
+        self.stats = {'queries': 0, 'batches': 0, 'shed': 0, 'timeouts': 0, 'errors': 0}
+
+    # Answers a query, raises Overloaded if too many queries are pending and asyncio.TimeoutError on timeout
+    async def submit(self, query, sim, info, timeout=None):
+        if self.pending >= self.max_pending:
+            self.stats['shed'] += 1
+            raise Overloaded()
+        future = asyncio.get_running_loop().create_future()
+        self.pending += 1
+        self.stats['queries'] += 1
+        try:
+            self.queue.put_nowait((query, sim, info, future))
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            raise
+        finally:
+            self.pending -= 1
+
+    # collects batches from the queue until cancelled
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            # queries that timed out while waiting are dropped
+            batch = [item for item in batch if not item[3].done()]
+            if batch:
+                await self.slots.acquire()
+                asyncio.ensure_future(self._execute(batch))
+
+    async def _execute(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            self.stats['batches'] += 1
+            groups = {}
+            for item in batch:
+                groups.setdefault((item[1], item[2]), []).append(item)
+            for (sim, info), items in groups.items():
+                try:
+                    results = await loop.run_in_executor(self.executor, _run_batch,
+                                                         [item[0] for item in items], sim, info)
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    results = [e] * len(items)
+                for item, result in zip(items, results):
+                    if item[3].done():
+                        continue
+                    if isinstance(result, Exception):
+                        item[3].set_exception(result)
+                    else:
+                        item[3].set_result(result)
+        finally:
+            self.slots.release()
+
+
+class QueryServer:
+    # Parameters:
+    # - filename        name of the index file to load (binary indexes are memory-mapped, so every worker
+    #                   shares the same pages)
+    # - workers         number of worker processes. default: usersettings["threads"]
+    # - timeout         number of seconds after which an unanswered query gets a 504. default: 10
+    # - cache_size      number of cached query results per worker, 0 disables the cache. default: 0
+    # - batcher options passed on to MicroBatcher (max_batch, max_wait, max_pending)
+    def __init__(self, filename, workers=None, timeout=10.0, cache_size=0, **batcher_options):
+        self.workers = workers or usersettings["threads"]
+        self.timeout = timeout
+        self.executor = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(filename, cache_size))
+        self.batcher = MicroBatcher(self.executor, self.workers, **batcher_options)
+        self.started = time.time()
+
+    # Serves until cancelled (or terminated with SIGTERM), on a TCP port or on a Unix socket if path is given
+    async def serve(self, host="127.0.0.1", port=8000, path=None):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        # load the index in every worker before accepting requests: a worker only runs tasks after its
+        # initializer, so wait until every worker has answered one
+        loaded = set()
+        while len(loaded) < self.workers:
+            loaded.update(await asyncio.gather(*[loop.run_in_executor(self.executor, _worker_pid)
+                                                 for _ in range(self.workers)]))
+        batcher = asyncio.ensure_future(self.batcher.run())
+        if path:
+            server = await asyncio.start_unix_server(self.handle, path=path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        print('Serving on', path or '%s:%s' % (host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.executor.shutdown(cancel_futures=True)
+
+    # handles the requests of a connection (keep-alive) until the client closes it
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode('latin-1').split("\r\n")
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                try:
+                    method, target = lines[0].split(" ")[:2]
+                    length = int(headers.get('content-length', 0))
+                    assert length >= 0
+                except (ValueError, AssertionError):
+                    await self.respond(writer, 400, {'error': 'malformed request'}, False)
+                    break
+                if length > MAX_BODY:
+                    await self.respond(writer, 400, {'error': 'request body too large'}, False)
+                    break
+                try:
+                    body = await reader.readexactly(length) if length else b""
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                status, response = await self.dispatch(method, target, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self.respond(writer, status, response, keep_alive)
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, target, body):
+        if method == "GET" and target == "/stats":
+            return 200, dict(self.batcher.stats, pending=self.batcher.pending, uptime=time.time() - self.started)
+        if method != "POST" or target != "/query":
+            return 404, {'error': 'unknown endpoint %s %s' % (method, target)}
+        try:
+            request = json.loads(body)
+            query = request['query']
+            sim = float(request.get('sim', 0.8))
+            info = bool(request.get('info', False))
+            assert isinstance(query, str)
+        except (ValueError, KeyError, TypeError, AssertionError):
+            return 400, {'error': 'expected a JSON object with a "query" string'}
+        try:
+            result = await self.batcher.submit(query, sim, info, self.timeout)
+        except Overloaded:
+            return 503, {'error': 'too many pending queries'}
+        except asyncio.TimeoutError:
+            return 504, {'error': 'query timed out'}
+        if info:
+            return 200, {'results': result[0], 'candidates': result[1]}
+        return 200, {'results': result}
+
+    @staticmethod
+    async def respond(writer, status, response, keep_alive):
+        body = json.dumps(response).encode()
+        head = "HTTP/1.1 %s %s\r\nContent-Type: application/json\r\nContent-Length: %s\r\nConnection: %s\r\n\r\n" % (
+            status, STATUS[status], len(body), "keep-alive" if keep_alive else "close")
+        writer.write(head.encode() + body)
+        await writer.drain()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve queries on a LSH index')
+    parser.add_argument('index', help='name of the index file in ./data')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix', help='serve on this Unix socket instead of a TCP port')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--max-batch', type=int, default=32, help='maximum number of queries per batch')
+    parser.add_argument('--max-wait', type=float, default=5, help='milliseconds a query waits for a batch to fill')
+    parser.add_argument('--max-pending', type=int, default=1024, help='pending queries before new ones are refused')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds before a query times out')
+    parser.add_argument('--cache', type=int, default=0, help='number of cached query results per worker')
+    args = parser.parse_args()
+
+    server = QueryServer(args.index, args.workers, args.timeout, args.cache, max_batch=args.max_batch,
+                         max_wait=args.max_wait / 1000, max_pending=args.max_pending)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
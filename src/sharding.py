@@ -0,0 +1,307 @@
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from candidates import candidate_pairs, union_pairs
+from jaccard import verify_pairs
+from lsh import LSH, band_keys
+from signature import MinhashEngine, generate_hashfunctions, load_hash
+from storage import BandTable, ShingleStore
+from usersettings import usersettings
+
+# Sharded index: the documents are split into contiguous ranges of document IDs, every range (shard) is a full
+# LSH index owned by its own worker process. All shards share M, r and the hash functions, so a document lands
+# in the same buckets whatever shard it is in. A coordinator fans queries out to the shards and merges results.
+# A sharded index is stored as a manifest (JSON) and one binary index file per shard, which are written and
+# loaded independently by the shard workers.
+
+
+# index of a shard worker: (LSH, document ID of its first document)
+_shard = None
+
+
+def _init_shard(filename, start):
+    global _shard
+    # every shard already runs in a process of its own
+    usersettings["threads"] = 1
+    _shard = (LSH(filename) if filename else LSH(), start)
+
+
+def _build_shard(documents, M, r, hashfunctions):
+    lsh, _ = _shard
+    lsh.build_index(documents, M, r, [load_hash(hashfunc) for hashfunc in hashfunctions])
+    return len(lsh.docs)
+
+
+def _store_shard(filename):
+    _shard[0].store_index(filename, "binary")
+
+
+def _shard_size():
+    return len(_shard[0].docs)
+
+
+# answers queries of which the coordinator computed the signatures and band keys
+def _query_shard(shingles, signatures, keys, sim):
+    lsh, start = _shard
+    results, candidates = lsh.query_shingles(shingles, sim, signatures=signatures, keys=keys)
+    return [[doc + start for doc in query_results] for query_results in results], \
+        [len(query_candidates) for query_candidates in candidates]
+
+
+def _remove_from_shard(doc_ids):
+    lsh, start = _shard
+    lsh.remove_documents([doc - start for doc in doc_ids])
+
+
+# Returns band i of a shard as (sizes of the buckets, keys, postings with global document IDs)
+def _shard_band(i):
+    lsh, start = _shard
+    band = lsh.index[i]
+    keys, offsets, postings = band.arrays() if isinstance(band, BandTable) else BandTable.pack(band, lsh.bandkey)
+    return np.diff(offsets), np.asarray(keys), np.asarray(postings, dtype=np.int64) + start
+
+
+# global IDs of the removed documents of a shard
+def _shard_deleted():
+    lsh, start = _shard
+    return [doc + start for doc in lsh.deleted]
+
+
+# Generates the candidate pairs of one band of the whole collection, given the parts of that band of all
+# shards (see _shard_band)
+# Returns:
+# - (first, second, skipped), see candidates.candidate_pairs
+def _band_pairs(parts, max_bucket, oversized, deleted):
+    keys = np.concatenate([np.repeat(keys, sizes) for sizes, keys, _ in parts])
+    band = BandTable.from_keys(keys, np.concatenate([postings for _, _, postings in parts]))
+    return candidate_pairs([band], max_bucket, oversized, deleted=deleted)
+
+
+# verifies candidate pairs of which both documents are in this shard
+def _verify_shard_pairs(first, second, treshold):
+    lsh, start = _shard
+    first, second, sims = verify_pairs(lsh.docs, first - start, second - start, treshold)
+    return first + start, second + start, sims
+
+
+# shingles of some documents of the shard, as (shingles, offsets) of a ShingleStore
+def _shard_shingles(doc_ids):
+    lsh, start = _shard
+    store = ShingleStore.from_sets([lsh.docs[doc - start] for doc in doc_ids])
+    return np.array(store.shingles), np.array(store.offsets)
+
+
+# verifies pairs of a document of this shard (first) and a document of another shard, whose shingles are
+# passed as a ShingleStore (second refers to positions in it)
+def _verify_cross_pairs(first, second, shingles, offsets, treshold):
+    lsh, start = _shard
+    first, second, sims = verify_pairs(lsh.docs, first - start, second, treshold, ShingleStore(shingles, offsets))
+    return first + start, second, sims
+
+
+class ShardedLSH:
+    # Constructor: a filename of a previously stored sharded index (its manifest) may be passed to load it
+    def __init__(self, filename=None):
+        self.M = None
+        self.r = None
+        self.hashfunctions = None
+        self.engine = None
+        self.starts = None
+        self.shards = []
+        self.filter = LSH()._filter
+        if filename:
+            self.load_index(filename)
+
+    # starts one worker process per shard, optionally loading the shard index files
+    def _start(self, starts, filenames=None):
+        self.close()
+        self.starts = np.asarray(starts, dtype=np.int64)
+        filenames = filenames or [None] * (len(starts) - 1)
+        self.shards = [ProcessPoolExecutor(1, initializer=_init_shard, initargs=(filename, start))
+                       for filename, start in zip(filenames, starts[:-1])]
+
+    # stops the shard workers
+    def close(self):
+        for shard in self.shards:
+            shard.shutdown()
+        self.shards = []
+
+    # runs a function in every shard worker at once
+    # Returns:
+    # - the result of every shard
+    def _fan_out(self, function, *args):
+        futures = [shard.submit(function, *args) for shard in self.shards]
+        return [future.result() for future in futures]
+
+    # the shard of every document ID
+    def _shard_of(self, doc_ids):
+        return np.searchsorted(self.starts, doc_ids, side='right') - 1
+
+    # Creates a sharded index of a collection given a csv file containing the documents
+    # Parameters:
+    # - filename        name of the csv file containing the documents
+    # - M               length of each signature
+    # - r               minhashes per band
+    # - shards          number of shards (worker processes). default: usersettings["threads"]
+    # - hashtype        either "Xorhash" or "Linconhash" or "MD5hash" or "OPHhash". default: Xorhash
+    def create_index(self, filename, M, r, shards=None, hashtype="Xorhash"):
+        articles = pd.read_csv('./data/%s' % filename)['article'].to_list()
+        shards = min(shards or usersettings["threads"], max(1, len(articles)))
+        starts = [len(articles) * i // shards for i in range(shards + 1)]
+        self.M = M
+        self.r = r
+        self.hashfunctions = generate_hashfunctions(M, hashtype)
+        self.engine = MinhashEngine(self.hashfunctions)
+        self._start(starts)
+        stored = [hashfunc.store() for hashfunc in self.hashfunctions]
+        futures = [shard.submit(_build_shard, articles[start:end], M, r, stored)
+                   for shard, start, end in zip(self.shards, starts[:-1], starts[1:])]
+        for future in futures:
+            future.result()
+
+    # Stores the sharded index: the manifest in filename, and every shard in its own binary index file
+    # (filename.shard<i>) written by its worker
+    def store_index(self, filename):
+        files = ['%s.shard%s' % (filename, i) for i in range(len(self.shards))]
+        futures = [shard.submit(_store_shard, shard_file) for shard, shard_file in zip(self.shards, files)]
+        for future in futures:
+            future.result()
+        with open('./data/%s' % filename, 'w') as output:
+            json.dump({
+                'M': self.M,
+                'r': self.r,
+                'hashfunctions': [hashfunc.store() for hashfunc in self.hashfunctions],
+                'shards': [{'file': shard_file, 'start': int(start), 'count': int(end - start)}
+                           for shard_file, start, end in zip(files, self.starts[:-1], self.starts[1:])]
+            }, output)
+
+    # Loads a sharded index from its manifest, every shard worker loads (memory-maps) its own shard file
+    def load_index(self, filename):
+        with open('./data/%s' % filename, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+        self.M = manifest['M']
+        self.r = manifest['r']
+        self.hashfunctions = [load_hash(hashfunc) for hashfunc in manifest['hashfunctions']]
+        self.engine = MinhashEngine(self.hashfunctions)
+        shards = manifest['shards']
+        self._start([shard['start'] for shard in shards] + [shards[-1]['start'] + shards[-1]['count']],
+                    [shard['file'] for shard in shards])
+        assert self._fan_out(_shard_size) == [shard['count'] for shard in shards]
+
+    # Removes documents from the index (see LSH.remove_documents)
+    def remove_documents(self, doc_ids):
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        # checked before any shard removes its documents
+        unknown = doc_ids[(doc_ids < 0) | (doc_ids >= self.starts[-1])]
+        if len(unknown):
+            raise ValueError('document %s is not in the index' % unknown[0])
+        shards = self._shard_of(doc_ids)
+        futures = [shard.submit(_remove_from_shard, doc_ids[shards == i].tolist())
+                   for i, shard in enumerate(self.shards) if (shards == i).any()]
+        for future in futures:
+            future.result()
+
+    # Find documents with a similarity to the given query larger than sim, see LSH.query
+    def query(self, query, sim, info=False):
+        return self.query_batch([query], sim, info)[0]
+
+    # Runs a batch of queries on all shards at once, see LSH.query_batch
+    # Queries are pre-processed and signed once by the coordinator (all shards share their hash functions),
+    # every shard looks up and verifies its own candidates
+    def query_batch(self, queries, sim, info=False):
+        shingles = [self.filter(query) for query in queries]
+        signatures = self.engine.signature_matrix(shingles, parallel=True)
+        # the shards are built by LSH.build_index, which uses mix64 band keys
+        keys = band_keys(signatures, self.r, "mix64")
+        shard_results = self._fan_out(_query_shard, shingles, signatures, keys, sim)
+        results = [sorted(doc for results, _ in shard_results for doc in results[q]) for q in range(len(queries))]
+        if info:
+            candidates = [sum(counts[q] for _, counts in shard_results) for q in range(len(queries))]
+            return list(zip([len(query_results) for query_results in results], candidates))
+        return results
+
+    # Finds all near-duplicate pairs (see LSH.get_all_similar_pairs)
+    # Candidate pairs are generated per band: every band is owned by one shard, which receives that band of all
+    # shards (so bucket sizes and max_bucket apply to the whole collection) and sends back its candidate pairs
+    # only. The coordinator relays at most one band per shard at a time and only keeps the pairs.
+    # Pairs within a shard are verified by that shard, pairs across shards by the shard of the first document,
+    # which receives the shingles of the second document.
+    # Parameters:
+    # - treshold, max_bucket, oversized: see LSH.get_all_similar_pairs
+    # - output          name of the csv file the pairs are written to, None to not write them. default: result.csv
+    def get_all_similar_pairs(self, treshold, max_bucket=None, oversized="skip", output='result.csv'):
+        deleted = set(doc for shard_deleted in self._fan_out(_shard_deleted) for doc in shard_deleted)
+        pairs = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        skipped = 0
+        pending = []
+        for i in range(self.M // self.r):
+            pending.append(self.shards[i % len(self.shards)].submit(_band_pairs, self._fan_out(_shard_band, i),
+                                                                      max_bucket, oversized, deleted))
+            if len(pending) >= len(self.shards) or i == self.M // self.r - 1:
+                for future in pending:
+                    band_first, band_second, band_skipped = future.result()
+                    pairs = union_pairs(pairs, (band_first, band_second))
+                    skipped += band_skipped
+                pending = []
+        first, second = pairs
+
+        print("Found", len(first), "candidate pairs")
+        if skipped:
+            print("Skipped", skipped, "pairs in buckets larger than", max_bucket)
+
+        # verify the pairs, grouped by the shards of both documents
+        # the shingles of all cross-shard groups are requested at once, before waiting for any of them
+        first_shard, second_shard = self._shard_of(first), self._shard_of(second)
+        verifications = []
+        fetches = []
+        for a, b in set(zip(first_shard.tolist(), second_shard.tolist())):
+            group = (first_shard == a) & (second_shard == b)
+            if a == b:
+                future = self.shards[a].submit(_verify_shard_pairs, first[group], second[group], treshold)
+                verifications.append((None, future))
+                continue
+            ids, positions = np.unique(second[group], return_inverse=True)
+            fetches.append((a, group, ids, positions.ravel(), self.shards[b].submit(_shard_shingles, ids.tolist())))
+        for a, group, ids, positions, fetch in fetches:
+            shingles, offsets = fetch.result()
+            verifications.append((ids, self.shards[a].submit(_verify_cross_pairs, first[group], positions,
+                                                              shingles, offsets, treshold)))
+
+        results = set()
+        for ids, future in verifications:
+            pair_first, pair_second, sims = future.result()
+            if ids is not None:
+                pair_second = ids[pair_second]
+            results.update(zip(zip(pair_first.tolist(), pair_second.tolist()), sims.tolist()))
+
+        print("Found", len(results), "near-duplicate pairs")
+
+        # write similar pairs to output csv
+        if output:
+            results_csv = pd.DataFrame({'doc_id1': [pair[0] for pair, _ in results],
+                                        'doc_id2': [pair[1] for pair, _ in results]})
+            results_csv.sort_values(["doc_id1", "doc_id2"], inplace=True)
+            results_csv.to_csv(output, index=False)
+
+        return results
+
+
+if __name__ == "__main__":
+    lsh = ShardedLSH()
+
+    t = time.time()
+    lsh.create_index('news_articles_large.csv', 100, 5)
+    print("Creating sharded index took", time.time() - t, "sec")
+
+    t = time.time()
+    lsh.store_index('index_5.shards')
+    print("Storing sharded index took", time.time() - t, "sec")
+
+    t = time.time()
+    lsh.get_all_similar_pairs(0.8)
+    print("Finding all near-duplicates took", time.time() - t, "sec")
+    lsh.close()
@@ -1,13 +1,24 @@
-import pandas as pd
-from processing import to_shingles
+import numpy as np
+from processing import fmix64, shingle_array
 from jaccard import compute_jaccard
+from storage import ShingleStore
+from instrumentation import NULL_STATS
+import pickle
 import random
-from multiprocessing import Pool
+import uuid
+from multiprocessing.shared_memory import SharedMemory
 from usersettings import usersettings
-import functools
-import matplotlib.pyplot as plt
+from workers import get_pool, shared_array, shared_view
 from hashlib import md5
 
+# signature value of a document without any shingles: larger than every possible minhash
+EMPTY = np.iinfo(np.uint64).max
+
+# minimum number of documents for which signatures are computed by the worker pool
+POOL_MIN_DOCS = 256
+# number of chunks per worker a signature matrix is split into (balances uneven document lengths)
+CHUNKS_PER_WORKER = 4
+
 
 # Base class for hash functions, just has methods to be overridden
 class Basehash:
@@ -23,6 +34,22 @@ class Basehash:
     def store(self):
         raise NotImplementedError
 
+    # Collects the parameters of a list of hash functions of this type into arrays
+    @staticmethod
+    def parameters(hashfunctions):
+        raise NotImplementedError
+
+    # Vectorized calculate: hashes a uint64 array of values with every hash function at once,
+    # given the parameters returned by parameters()
+    # Returns a (number of hash functions x number of values) uint64 matrix
+    @staticmethod
+    def calculate_array(params, values):
+        raise NotImplementedError
+
+    # Hash types computing the whole signature in a single pass over the values (instead of one pass per
+    # hash function) set ONE_PASS and implement signature_array(params, values), which returns the signature
+    ONE_PASS = False
+
 
 # Takes a string as input as generated by .store() and returns the object
 def load_hash(s):
@@ -47,6 +74,9 @@ def load_hash(s):
         obj.a = int(split[1])
         return obj
 
+    if hashtype == "OPHhash":
+        return OPHhash(int(split[1]), int(split[2]), int(split[3]))
+
     assert False
 
 
@@ -54,7 +84,7 @@ def load_hash(s):
 class Xorhash(Basehash):
     def __init__(self):
         Basehash.__init__(self)
-        self.xor = random.randint(0, 2**64)
+        self.xor = random.randint(0, 2**64 - 1)
 
     def calculate(self, value):
         return value ^ self.xor
@@ -62,6 +92,14 @@ class Xorhash(Basehash):
     def store(self):
         return "Xorhash_"+str(self.xor)
 
+    @staticmethod
+    def parameters(hashfunctions):
+        return np.array([h.xor for h in hashfunctions], dtype=np.uint64)[:, None]
+
+    @staticmethod
+    def calculate_array(params, values):
+        return values[None, :] ^ params
+
 
 # Linear congruential generator-ish: (a*x + b) % c for a random a, b.
 # c is chosen as a large prime of around 59 bits: this ensures that the hash value fits in 64 bits
@@ -79,12 +117,32 @@ class Linconhash(Basehash):
     def store(self):
         return "Linconhash_"+str(self.a)+"_"+str(self.b)+"_"+str(self.c)
 
+    # a, b and c are reduced so that (a*x + b) % c == ((a % c)*(x % c) + b % c) % c can be evaluated in uint64
+    @staticmethod
+    def parameters(hashfunctions):
+        c = np.array([h.c for h in hashfunctions], dtype=np.uint64)[:, None]
+        a = np.array([h.a % h.c for h in hashfunctions], dtype=np.uint64)[:, None]
+        b = np.array([h.b % h.c for h in hashfunctions], dtype=np.uint64)[:, None]
+        return a, b, c
+
+    # a*x would need 118 bits, so the product is computed 4 bits of x at a time (Horner's scheme):
+    # with a, x < c < 2**59 every intermediate value stays below 2**64
+    @staticmethod
+    def calculate_array(params, values):
+        a, b, c = params
+        x = values[None, :] % c
+        out = np.zeros(x.shape, dtype=np.uint64)
+        for shift in range(56, -4, -4):
+            nibble = (x >> np.uint64(shift)) & np.uint64(15)
+            out = (out * np.uint64(16) + a * nibble) % c
+        return (out + b) % c
+
 
 # MD5Hash
 class MD5hash(Basehash):
     def __init__(self):
         Basehash.__init__(self)
-        self.a = random.randint(0, 2 ** 64)
+        self.a = random.randint(0, 2 ** 64 - 1)
 
     def calculate(self, value):
         m = md5()
@@ -95,54 +153,266 @@ class MD5hash(Basehash):
     def store(self):
         return "MD5hash_" + str(self.a)
 
+    @staticmethod
+    def parameters(hashfunctions):
+        return hashfunctions
+
+    # MD5 can't be vectorized: falls back to calculate for every value
+    @staticmethod
+    def calculate_array(params, values):
+        values = values.tolist()
+        return np.array([[h.calculate(value) for value in values] for h in params], dtype=np.uint64)
+
+
+# One-permutation hashing with densification: every shingle is hashed once (fmix64 of the shingle xored with
+# a random seed) and put in one of M bins, the signature holds the minimum hash of every bin. So a signature
+# costs a single pass over the shingles, whatever M is.
+# Bins without any shingle are filled by rotation densification: an empty bin takes the (remixed) value of the
+# next non-empty bin to the right, together with its distance, so two documents agree on an empty bin with
+# about the same probability as on a non-empty one.
+# The M bins of a signature are M OPHhash objects sharing the same seed, one per bin.
+class OPHhash(Basehash):
+    ONE_PASS = True
+
+    def __init__(self, seed=None, index=0, bins=1):
+        Basehash.__init__(self)
+        self.seed = random.randint(0, 2**64 - 1) if seed is None else seed
+        self.index = index
+        self.bins = bins
+
+    # the hash of a value if it falls in the bin of this hash function, EMPTY otherwise (no densification)
+    def calculate(self, value):
+        h = int(fmix64(np.array([value ^ self.seed], dtype=np.uint64))[0])
+        return h if h % self.bins == self.index else int(EMPTY)
+
+    def store(self):
+        return "OPHhash_" + str(self.seed) + "_" + str(self.index) + "_" + str(self.bins)
+
+    # returns the M hash functions of a one-permutation signature of length M
+    @staticmethod
+    def generate(M):
+        seed = random.randint(0, 2**64 - 1)
+        return [OPHhash(seed, i, M) for i in range(M)]
+
+    @staticmethod
+    def parameters(hashfunctions):
+        M = len(hashfunctions)
+        assert all(h.seed == hashfunctions[0].seed and h.bins == M and h.index == i
+                   for i, h in enumerate(hashfunctions))
+        return np.uint64(hashfunctions[0].seed), M
+
+    @staticmethod
+    def calculate_array(params, values):
+        seed, M = params
+        h = fmix64(values ^ seed)
+        out = np.full((M, len(values)), EMPTY, dtype=np.uint64)
+        out[(h % np.uint64(M)).astype(np.int64), np.arange(len(values))] = h
+        return out
+
+    @staticmethod
+    def signature_array(params, values):
+        seed, M = params
+        sig = np.full(M, EMPTY, dtype=np.uint64)
+        if len(values) == 0:
+            return sig
+        # after sorting the hashes, the first hash of every bin is its minimum
+        h = np.sort(fmix64(values ^ seed))
+        bins, first = np.unique((h % np.uint64(M)).astype(np.int64), return_index=True)
+        sig[bins] = h[first]
+        if len(bins) < M:
+            empty = np.ones(M, dtype=bool)
+            empty[bins] = False
+            missing = np.flatnonzero(empty)
+            source = bins[np.searchsorted(bins, missing) % len(bins)]
+            distance = ((source - missing) % M).astype(np.uint64)
+            sig[missing] = fmix64(sig[source] ^ distance)
+        return sig
+
+    # second smallest hash of every bin, EMPTY for bins with less than two shingles (densified bins aren't probed)
+    @staticmethod
+    def runner_up_array(params, values):
+        seed, M = params
+        alt = np.full(M, EMPTY, dtype=np.uint64)
+        h = np.sort(fmix64(values ^ seed))
+        # group the sorted hashes by bin, keeping them sorted within every bin
+        bins = (h % np.uint64(M)).astype(np.int64)
+        order = np.argsort(bins, kind='stable')
+        bins, first, counts = np.unique(bins[order], return_index=True, return_counts=True)
+        alt[bins[counts > 1]] = h[order][first[counts > 1] + 1]
+        return alt
+
+
+# Batched minhash engine: keeps the parameters of all M hash functions as arrays, so that a full signature
+# is computed in one vectorized pass (hash with every function, then take the minimum per function)
+# All hash functions must be of the same type
+class MinhashEngine:
+    # maximum number of hash values computed at once, bounds the memory used for large documents
+    BLOCK = 2**20
+
+    def __init__(self, hashfunctions):
+        assert len(hashfunctions) > 0
+        self.hashfunctions = hashfunctions
+        self.M = len(hashfunctions)
+        self.hashclass = type(hashfunctions[0])
+        assert all(type(h) == self.hashclass for h in hashfunctions)
+        self.params = self.hashclass.parameters(hashfunctions)
+        # identifies the engine in the workers of the signature pool, which keep it between calls
+        self.key = uuid.uuid4().hex
+
+    # Computes the signature of a single set (or uint64 array) of shingles
+    # Returns:
+    # - a uint64 array of length M, all EMPTY if there are no shingles
+    def signature(self, shingles):
+        values = shingle_array(shingles)
+        if self.hashclass.ONE_PASS:
+            return self.hashclass.signature_array(self.params, values)
+        sig = np.full(self.M, EMPTY, dtype=np.uint64)
+        step = max(1, self.BLOCK // self.M)
+        for start in range(0, len(values), step):
+            hashed = self.hashclass.calculate_array(self.params, values[start:start+step])
+            np.minimum(sig, hashed.min(axis=1), out=sig)
+        return sig
+
+    # Computes the second smallest hash value of every hash function: the minhash a similar document gets if it
+    # lacks the shingle holding the minimum, which is what multi-probe queries probe (see lsh.probe_signatures)
+    # Returns:
+    # - a uint64 array of length M, EMPTY where there is no second value
+    def runner_up(self, shingles):
+        values = shingle_array(shingles)
+        if self.hashclass.ONE_PASS:
+            return self.hashclass.runner_up_array(self.params, values)
+        best = np.full((self.M, 2), EMPTY, dtype=np.uint64)
+        step = max(1, self.BLOCK // self.M)
+        for start in range(0, len(values), step):
+            hashed = self.hashclass.calculate_array(self.params, values[start:start+step])
+            if hashed.shape[1] > 2:
+                hashed = np.partition(hashed, 1, axis=1)[:, :2]
+            best = np.sort(np.hstack([best, hashed]), axis=1)[:, :2]
+        return best[:, 1]
+
+    # Computes the runner-up values (see runner_up) of a list of shingle sets (or a ShingleStore)
+    # Returns:
+    # - a (number of documents x M) uint64 matrix
+    def runner_up_matrix(self, docs):
+        out = np.empty((len(docs), self.M), dtype=np.uint64)
+        for i, doc in enumerate(docs):
+            out[i] = self.runner_up(doc)
+        return out
+
+    # Computes the signatures of a list of shingle sets (or a ShingleStore)
+    # Parameters:
+    # - parallel        use the persistent worker pool for large collections (not from within pool workers)
+    # Returns:
+    # - a (number of documents x M) uint64 signature matrix
+    def signature_matrix(self, docs, parallel=False):
+        if parallel and len(docs) >= POOL_MIN_DOCS and usersettings["threads"] > 1:
+            return _pooled_signature_matrix(self, docs)
+        out = np.empty((len(docs), self.M), dtype=np.uint64)
+        for i, doc in enumerate(docs):
+            out[i] = self.signature(doc)
+        return out
+
+
+# Signature matrices of large collections are computed on the persistent pool of workers.py
+# No hash functions or shingle sets are pickled per task: the shingles (as a ShingleStore), the pickled hash
+# parameters and the output matrix are placed in shared memory, a task only holds their names and a range of
+# rows. Every worker unpickles the hash parameters once per engine and writes its signatures straight into the
+# shared output matrix.
+# engine of a pool worker: (key, MinhashEngine)
+_worker_engine = (None, None)
+
+
+def _signature_task(task):
+    global _worker_engine
+    key, names, count, M, start, stop = task
+    blocks = {name: SharedMemory(name=shm) for name, shm in names.items()}
+    try:
+        if _worker_engine[0] != key:
+            hashclass, params = pickle.loads(bytes(blocks['params'].buf))
+            engine = MinhashEngine.__new__(MinhashEngine)
+            engine.M, engine.hashclass, engine.params = M, hashclass, params
+            _worker_engine = (key, engine)
+        _sign_rows(_worker_engine[1], blocks, count, start, stop)
+    finally:
+        for shm in blocks.values():
+            shm.close()
+
+
+def _sign_rows(engine, blocks, count, start, stop):
+    offsets = shared_view(blocks['offsets'], count + 1, np.int64)
+    shingles = shared_view(blocks['shingles'], offsets[-1], np.uint64)
+    out = shared_view(blocks['out'], (count, engine.M), np.uint64)
+    for i in range(start, stop):
+        out[i] = engine.signature(shingles[offsets[i]:offsets[i+1]])
+
+
+# Computes a signature matrix on the persistent signature pool
+def _pooled_signature_matrix(engine, docs):
+    if not isinstance(docs, ShingleStore):
+        docs = ShingleStore.from_sets(docs)
+    count = len(docs)
+    blocks = {}
+    try:
+        blocks['params'] = shared_array(np.frombuffer(pickle.dumps((engine.hashclass, engine.params)), dtype=np.uint8))
+        blocks['offsets'] = shared_array(docs.offsets)
+        blocks['shingles'] = shared_array(docs.shingles)
+        blocks['out'] = SharedMemory(create=True, size=max(1, count * engine.M * 8))
+        names = {name: shm.name for name, shm in blocks.items()}
+        step = max(1, -(-count // (CHUNKS_PER_WORKER * usersettings["threads"])))
+        tasks = [(engine.key, names, count, engine.M, start, min(start + step, count))
+                 for start in range(0, count, step)]
+        get_pool().map(_signature_task, tasks, chunksize=1)
+        return shared_view(blocks['out'], (count, engine.M), np.uint64).copy()
+    finally:
+        for shm in blocks.values():
+            shm.close()
+            shm.unlink()
 
 
 # takes a set of shingles and a list of k hash functions, returns a signature of length k
-# using minhash
+# using minhash (uint64 array). Use a MinhashEngine directly when signing many documents.
 def shingles_to_signature(shingleset, hashfunctions):
-    out = []
-    for hashfunc in hashfunctions:
-        lowest = min({hashfunc.calculate(shingle) for shingle in shingleset})
-        out.append(lowest)
-    return out
+    return MinhashEngine(hashfunctions).signature(shingleset)
 
 
-# given a list of shinglesets, returns a new list of signatures + the hash functions
-# parameter n determines the amount of hashes being used -> the size of the signatures
-# parameter hashfunc is a string that should either be "Xorhash" or "Linconhash" or "MD5hash"
-def generate_signature_matrix(docs, n, hashfunc):
-    assert type(docs) == list
-
+# returns a list of n new hash functions of the given type: "Xorhash" or "Linconhash" or "MD5hash" or "OPHhash"
+def generate_hashfunctions(n, hashfunc):
     hashfunc_map = {
         "Xorhash": Xorhash,
         "Linconhash": Linconhash,
-        "MD5hash": MD5hash
+        "MD5hash": MD5hash,
+        "OPHhash": OPHhash
     }
 
     assert hashfunc in hashfunc_map.keys()
+    if hashfunc == "OPHhash":
+        return OPHhash.generate(n)
     hashfunc = hashfunc_map[hashfunc]
+    return [hashfunc() for _ in range(n)]
+
+
+# given a list of shinglesets (or a ShingleStore), returns a (len(docs) x n) uint64 signature matrix + the hash functions
+# parameter n determines the amount of hashes being used -> the size of the signatures
+# parameter hashfunc is a string that should either be "Xorhash" or "Linconhash" or "MD5hash" or "OPHhash"
+# parameter stats is a Stats object (see instrumentation.py) the minhashing is recorded in, by default nothing is recorded
+def generate_signature_matrix(docs, n, hashfunc, stats=NULL_STATS):
+    assert type(docs) == list or isinstance(docs, ShingleStore)
 
     # generate n new hash functions
-    hashfunctions = [hashfunc() for _ in range(n)]
+    hashfunctions = generate_hashfunctions(n, hashfunc)
 
     # calculate signatures for each document
-    partialfunc = functools.partial(shingles_to_signature, hashfunctions=hashfunctions)
-    with Pool(usersettings["threads"]) as p:
-        out = p.map(partialfunc, docs)
-
-    return out, hashfunctions
+    engine = MinhashEngine(hashfunctions)
+    with stats.stage("minhash"):
+        signatures = engine.signature_matrix(docs, parallel=True)
+    stats.count("signatures", len(signatures))
+    return signatures, hashfunctions
 
 
+# fraction of positions in which two signatures agree (estimates the Jaccard similarity)
 def signature_similarity(sig1, sig2):
-    assert type(sig1) == list
-    assert type(sig2) == list
     assert len(sig1) == len(sig2)
-
-    count = 0
-    for i in range(len(sig1)):
-        if sig1[i] == sig2[i]:
-            count += 1
-    return count / len(sig1)
+    return np.count_nonzero(np.asarray(sig1) == np.asarray(sig2)) / len(sig1)
 
 
 def example_simple():
@@ -1,29 +1,73 @@
 import pandas as pd
-from processing import to_shingles
+import numpy as np
+from processing import shingle_array, shingle_variants
 from jaccard import pairwise_jaccard
+from signature import MinhashEngine, generate_hashfunctions
+from tuning import similarity_histogram
 from functools import partial
+from multiprocessing import Pool
+from usersettings import usersettings
 import matplotlib.pyplot as plt
 import time
 
+# collections of at most this many documents have their similarity distribution computed exactly,
+# for larger collections it is estimated from sampled pairs and minhash signatures
+EXACT_MAX_DOCS = 2000
+# signature length used to estimate similarities
+ESTIMATE_M = 256
+
+# pre-processing variants of which the similarity distribution is plotted (suffix of the plot, shingle options)
+VARIANTS = [
+    ('base', {}),
+    ('filter_punctuation', {'filter_punctuation': True}),
+    ('filter_stopwords', {'filter_stopwords': True}),
+    ('remove_capitalization', {'remove_capitalization': True}),
+    ('stopword_start', {'stopword_start': True}),
+    ('stopword_start_filters', {'stopword_start': True, 'filter_punctuation': True, 'remove_capitalization': True})
+]
+
 # computes probability of sharing a bucket for a given similarity, based on a given signature length M and number of rows per band r
 # number of bands b is derived from the number of rows per band (M//r)
 def compute_sensitivity(s2, M, r):
     return 1-pow(1-pow(s2, r), M//r)
 
-# plots Jaccard similarity distribution, given a dictionarity of buckets/bins (with counts)
-# optionally plots a set of S-curves on top of the distribution
-def plot_jaccard_distribution(docs, suffix, plot_sensitivity=False):
-    docs = docs.to_dict()['article']
-    buckets = {i/10: 0 for i in range(0, 10)}
+# computes the number of document pairs per similarity range [0.0, 0.1), ..., [0.9, 1.0]
+# Parameters:
+# - docs            list of shingle sets/arrays
+# - mode            "exact" (Jaccard of every pair), "estimate" (sampled pairs, minhash signatures) or "auto":
+#                   exact for at most EXACT_MAX_DOCS documents
+# - sample_pairs    number of sampled pairs in estimate mode
+# - confidence      level of the confidence intervals in estimate mode
+# Returns:
+# - (buckets, errors): {range: number of pairs} and {range: (lower, upper) bound} (equal to the count if exact)
+def jaccard_distribution(docs, mode="auto", sample_pairs=200000, confidence=0.95):
+    assert mode in ["auto", "exact", "estimate"]
+    if mode == "exact" or (mode == "auto" and len(docs) <= EXACT_MAX_DOCS):
+        buckets = {i/10: 0 for i in range(0, 10)}
+        pairwise_jaccard({i: set(shingle_array(doc).tolist()) for i, doc in enumerate(docs)}, buckets)
+        return buckets, {key: (count, count) for key, count in buckets.items()}
+
+    engine = MinhashEngine(generate_hashfunctions(ESTIMATE_M, "OPHhash"))
+    signatures = engine.signature_matrix(docs, parallel=True)
+    sims, counts, low, high = similarity_histogram(signatures, sample_pairs, bins=10, floor=True,
+                                                   confidence=confidence)
+    buckets = {i/10: int(round(count)) for i, count in enumerate(counts)}
+    return buckets, {i/10: (l, h) for i, (l, h) in enumerate(zip(low, high))}
 
-    # compute Jaccard similarity for each article pair
-    pairwise_jaccard(docs, buckets)
+# plots Jaccard similarity distribution, given a list of shingle sets/arrays (or a DataFrame with an article column)
+# optionally plots a set of S-curves on top of the distribution
+# the distribution is exact for small collections and estimated with confidence intervals otherwise (see mode)
+def plot_jaccard_distribution(docs, suffix, plot_sensitivity=False, mode="auto"):
+    if isinstance(docs, pd.DataFrame):
+        docs = docs['article'].to_list()
+    buckets, errors = jaccard_distribution(docs, mode)
 
     # plot similarity range counts
     lists = buckets.items()
     x, y = zip(*lists)
     x_pos = [i for i, _ in enumerate(x)]
-    rects = plt.bar(x_pos, y, align='edge', width=1)
+    yerr = np.array([[count - errors[key][0], errors[key][1] - count] for key, count in lists]).T
+    rects = plt.bar(x_pos, y, align='edge', width=1, yerr=np.maximum(yerr, 0) if yerr.any() else None)
     for rect in rects:
         # add amount in bucket as a label of the bar
         height = rect.get_height()
@@ -64,45 +108,14 @@ if __name__ == "__main__":
     articles = pd.read_csv('./data/news_articles_small.csv')
     articles.set_index('News_ID', inplace=True)
 
-    articles_original = articles.copy()
-
-    # convert articles to sets of shingles
-    t = time.time()
-    articles['article'] = articles['article'].apply(to_shingles)
-    plot_jaccard_distribution(articles, 'base')
-    print('Plotting similarity distribution without pre-processing took', time.time() - t, 'seconds')
-
-    # convert articles to sets of shingles using punctuation filtering
+    # convert articles to sets of shingles for all pre-processing variants in a single pass
     t = time.time()
-    _filter = partial(to_shingles, filter_punctuation=True)
-    articles['article'] = articles_original['article'].apply(_filter)
-    plot_jaccard_distribution(articles, 'filter_punctuation')
-    print('Plotting similarity distribution with punctuation filtering took', time.time() - t, 'seconds')
+    _filter = partial(shingle_variants, variants=[options for _, options in VARIANTS])
+    with Pool(usersettings["threads"]) as p:
+        shingled = p.map(_filter, articles['article'].to_list())
+    print('Shingling all pre-processing variants took', time.time() - t, 'seconds')
 
-    # convert articles to sets of shingles using stopword filtering
-    t = time.time()
-    _filter = partial(to_shingles, filter_stopwords=True)
-    articles['article'] = articles_original['article'].apply(_filter)
-    plot_jaccard_distribution(articles, 'filter_stopwords')
-    print('Plotting similarity distribution with stopword filtering took', time.time() - t, 'seconds')
-
-    # convert articles to sets of shingles using capitalizaition removal
-    t = time.time()
-    _filter = partial(to_shingles, remove_capitalization=True)
-    articles['article'] = articles_original['article'].apply(_filter)
-    plot_jaccard_distribution(articles, 'remove_capitalization')
-    print('Plotting similarity distribution with capitalization removal took', time.time() - t, 'seconds')
-
-    # convert articles to sets of shingles using only 3-grams that start with a stopword
-    t = time.time()
-    _filter = partial(to_shingles, stopword_start=True)
-    articles['article'] = articles_original['article'].apply(_filter)
-    plot_jaccard_distribution(articles, 'stopword_start')
-    print('Plotting similarity distribution with only using 3-grams that start with a stopword took', time.time() - t, 'seconds')
-
-    # convert articles to sets of shingles using only 3-grams that start with a stopword and all other possible filters
-    t = time.time()
-    _filter = partial(to_shingles, stopword_start=True, filter_punctuation=True, remove_capitalization=True)
-    articles['article'] = articles_original['article'].apply(_filter)
-    plot_jaccard_distribution(articles, 'stopword_start_filters', True)
-    print('Plotting similarity distribution with only using 3-grams that start with a stopword and all other possible filters took', time.time() - t, 'seconds')
+    for i, (suffix, options) in enumerate(VARIANTS):
+        t = time.time()
+        plot_jaccard_distribution([doc[i] for doc in shingled], suffix, suffix == 'stopword_start_filters')
+        print('Plotting similarity distribution with pre-processing %s took' % suffix, time.time() - t, 'seconds')
@@ -0,0 +1,122 @@
+import glob
+import os
+
+import numpy as np
+
+# Sinks for the near-duplicate pairs of LSH.stream_similar_pairs, which writes the pairs in chunks
+# (sorted by document ids) instead of gathering all of them in memory.
+# A sink has the methods:
+# - write(first, second, sims)  writes a chunk of pairs (document id arrays and their similarities)
+# - checkpoint()                makes everything written so far durable, returns the state to resume from
+# - restore(state)              continues an interrupted run: drops everything written after the checkpoint
+#                               that returned state, instead of starting over
+# - close()
+
+
+# Writes the pairs to a csv file with the columns doc_id1, doc_id2 (like result.csv) and optionally similarity
+class CSVSink:
+    # Parameters:
+    # - filename        name of the csv file
+    # - similarity      also write the similarity of every pair. default: False
+    def __init__(self, filename, similarity=False):
+        self.filename = filename
+        self.similarity = similarity
+        self.output = None
+
+    # starts a new file, unless a run is continued
+    def _open(self):
+        if self.output is None:
+            self.output = open(self.filename, 'wb')
+            self.output.write(b"doc_id1,doc_id2,similarity\n" if self.similarity else b"doc_id1,doc_id2\n")
+
+    def write(self, first, second, sims):
+        self._open()
+        if len(first) == 0:
+            return
+        if self.similarity:
+            np.savetxt(self.output, np.column_stack([first, second, sims]), fmt=['%d', '%d', '%.6f'], delimiter=',')
+        else:
+            np.savetxt(self.output, np.column_stack([first, second]), fmt='%d', delimiter=',')
+
+    def checkpoint(self):
+        self._open()
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        return {'offset': self.output.tell()}
+
+    def restore(self, state):
+        self.output = open(self.filename, 'r+b')
+        self.output.truncate(state['offset'])
+        self.output.seek(state['offset'])
+
+    def close(self):
+        self._open()
+        self.output.close()
+
+
+# Writes every chunk of pairs to a numbered .npz file (arrays doc_id1, doc_id2, similarity) in a directory,
+# so the pairs can be read back one chunk at a time (see read_chunks)
+class ChunkSink:
+    def __init__(self, directory):
+        self.directory = directory
+        self.chunks = None
+
+    # removes the chunks of an earlier run, unless it is continued
+    def _open(self):
+        if self.chunks is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._remove_chunks(0)
+            self.chunks = 0
+
+    def _remove_chunks(self, start):
+        for name in glob.glob(os.path.join(self.directory, 'pairs*.npz')):
+            if int(os.path.basename(name)[5:-4]) >= start:
+                os.remove(name)
+
+    def write(self, first, second, sims):
+        self._open()
+        if len(first) == 0:
+            return
+        np.savez(os.path.join(self.directory, 'pairs%06d.npz' % self.chunks),
+                 doc_id1=np.asarray(first, dtype=np.int64), doc_id2=np.asarray(second, dtype=np.int64),
+                 similarity=np.asarray(sims, dtype=np.float64))
+        self.chunks += 1
+
+    def checkpoint(self):
+        self._open()
+        return {'chunks': self.chunks}
+
+    def restore(self, state):
+        self.chunks = state['chunks']
+        self._remove_chunks(self.chunks)
+
+    def close(self):
+        self._open()
+
+
+# Reads the chunks written by a ChunkSink in order
+# Returns:
+# - a generator of (doc_id1, doc_id2, similarity) arrays
+def read_chunks(directory):
+    for name in sorted(glob.glob(os.path.join(directory, 'pairs*.npz'))):
+        with np.load(name) as chunk:
+            yield chunk['doc_id1'], chunk['doc_id2'], chunk['similarity']
+
+
+# Passes every chunk of pairs to a callback(first, second, sims)
+# Chunks after the last checkpoint are passed again when a run is resumed
+class CallbackSink:
+    def __init__(self, callback):
+        self.callback = callback
+
+    def write(self, first, second, sims):
+        self.callback(first, second, sims)
+
+    def checkpoint(self):
+        return {}
+
+    def restore(self, state):
+        pass
+
+    def close(self):
+        pass
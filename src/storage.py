@@ -0,0 +1,461 @@
+import json
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+from collections.abc import Mapping
+
+import numpy as np
+
+from processing import shingle_array
+
+# Binary index format (all numbers little-endian):
+# - 8 bytes magic MAGIC, uint32 format version, uint32 length of the header
+# - JSON header: M, r, hash functions (as stored by .store()), type of the band keys and
+#   the location (offset, dtype, shape) of every data block
+# - data blocks, each aligned to ALIGNMENT bytes so they can be opened with numpy.memmap:
+#   - signatures            (number of documents x M) uint64 signature matrix
+#   - shingles              sorted uint64 shingles of all documents, concatenated
+#   - shingle_offsets       document i owns shingles[shingle_offsets[i]:shingle_offsets[i+1]]
+#   - band_offsets          band i owns keys[band_offsets[i]:band_offsets[i+1]]
+#   - keys                  sorted bucket keys of every band, concatenated
+#   - bucket_offsets        bucket j owns postings[bucket_offsets[j]:bucket_offsets[j+1]]
+#   - postings              document ids of every bucket, concatenated
+#   - deleted               ids of removed documents (tombstones), since version 2
+# Version 3 introduced "mix64" band keys (header field bandkey), older files always use "md5" keys
+# Version 4 introduced "mix64" shingle hashes (header field shinglehash), older files always use "md5" shingles
+MAGIC = b"LSHINDEX"
+FORMAT_VERSION = 4
+SUPPORTED_VERSIONS = [1, 2, 3, 4]
+ALIGNMENT = 64
+
+# dtype used to store MD5 band keys: the raw 16-byte digest instead of its 32-character hex string
+MD5_KEY = np.dtype("S16")
+# types of band keys and the dtype they are stored with
+# - "mix64"         64-bit integers computed by a mixing hash over the minhashes of the band (lsh.band_hashes)
+# - "md5"           MD5 digests of the band, used by indexes created before mix64 keys were introduced
+BAND_KEYS = {
+    "mix64": np.dtype('<u8'),
+    "md5": MD5_KEY
+}
+
+
+# Returns whether the given file is stored in the binary index format
+def is_binary_index(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+# Documents as sorted uint64 shingle arrays, stored as one flat array + offsets
+# Documents can be appended: the arrays then grow geometrically (a memory-mapped store is copied into memory once)
+class ShingleStore:
+    def __init__(self, shingles, offsets):
+        self._shingles = shingles
+        self._offsets = offsets
+        self._count = len(offsets) - 1
+
+    # Builds a store from a list of shingle sets (or sorted arrays)
+    @classmethod
+    def from_sets(cls, docs):
+        offsets = np.zeros(len(docs) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(doc) for doc in docs])
+        shingles = np.empty(offsets[-1], dtype=np.uint64)
+        for i, doc in enumerate(docs):
+            shingles[offsets[i]:offsets[i+1]] = shingle_array(doc)
+        return cls(shingles, offsets)
+
+    @property
+    def shingles(self):
+        return self._shingles[:self._offsets[self._count]]
+
+    @property
+    def offsets(self):
+        return self._offsets[:self._count + 1]
+
+    # Appends documents (shingle sets or sorted arrays)
+    def extend(self, docs):
+        arrays = [shingle_array(doc) for doc in docs]
+        sizes = np.array([len(array) for array in arrays], dtype=np.int64)
+        end = self._offsets[self._count]
+        self._offsets = _grow(self._offsets, self._count + 1 + len(arrays))
+        self._offsets[self._count + 1:self._count + 1 + len(arrays)] = end + np.cumsum(sizes)
+        self._shingles = _grow(self._shingles, end + sizes.sum())
+        self._shingles[end:end + sizes.sum()] = np.concatenate(arrays + [np.empty(0, dtype=np.uint64)])
+        self._count += len(arrays)
+
+    def __len__(self):
+        return self._count
+
+    # Returns the sorted shingle array of document i
+    def __getitem__(self, i):
+        return self._shingles[self._offsets[i]:self._offsets[i+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+# Returns an in-memory copy of array with room for at least size elements, or array itself if it is large enough
+def _grow(array, size):
+    if len(array) >= size and not isinstance(array, np.memmap):
+        return array
+    grown = np.empty(max(size, 2 * len(array)), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+# Bucket table of one band, stored as sorted keys + postings
+# Behaves like a dictionary {band key: [doc ids]}, keys are ints for "mix64" band keys and hex strings
+# for "md5" band keys (see BAND_KEYS)
+# The arrays are read-only: documents added with add() are kept in a separate dictionary, which is merged into
+# (in-memory copies of) the arrays by merge(), e.g. as soon as the arrays are needed (see arrays())
+class BandTable(Mapping):
+    def __init__(self, keys, offsets, postings):
+        self.keys_ = keys
+        self.offsets = offsets
+        self.postings = postings
+        self.bandkey = "md5" if keys.dtype == MD5_KEY else "mix64"
+        self.added = defaultdict(list)
+
+    # Creates a table from the band keys of a list of documents
+    # Parameters:
+    # - keys            array of band keys (BAND_KEYS dtype), one per document
+    # - docs            document ids, in increasing order. default: 0, 1, 2, ...
+    @classmethod
+    def from_keys(cls, keys, docs=None):
+        return cls(*bucket_arrays(keys, docs))
+
+    # Builds the sorted arrays of a {band key: [doc ids]} dictionary
+    # Returns:
+    # - (keys, bucket offsets, postings) arrays
+    @staticmethod
+    def pack(buckets, bandkey):
+        encoded = {_encode(key, bandkey): bucket for key, bucket in buckets.items()}
+        raw = sorted(encoded.keys())
+        keys = np.array(raw, dtype=BAND_KEYS[bandkey])
+        offsets = np.zeros(len(raw) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(encoded[key]) for key in raw])
+        postings = np.fromiter((doc for key in raw for doc in encoded[key]),
+                               dtype=np.uint32, count=offsets[-1])
+        return keys, offsets, postings
+
+    # Returns the (keys, bucket offsets, postings) arrays of this band, like pack()
+    def arrays(self):
+        self.merge()
+        start, end = self.offsets[0], self.offsets[-1]
+        return self.keys_, self.offsets - start, self.postings[start:end]
+
+    # Merges the documents added with add() into the sorted arrays, without looking up any key in Python
+    def merge(self):
+        if not self.added:
+            return
+        start, end = self.offsets[0], self.offsets[-1]
+        sizes = np.diff(self.offsets)
+        added_sizes = [len(bucket) for bucket in self.added.values()]
+        added_keys = np.array([_encode(key, self.bandkey) for key in self.added], dtype=self.keys_.dtype)
+        keys = np.concatenate([np.repeat(self.keys_, sizes), np.repeat(added_keys, added_sizes)])
+        docs = np.concatenate([self.postings[start:end],
+                               np.fromiter((doc for bucket in self.added.values() for doc in bucket),
+                                           dtype=np.uint32, count=sum(added_sizes))])
+        order = np.argsort(docs, kind='stable')
+        self.keys_, self.offsets, self.postings = bucket_arrays(keys[order], docs[order])
+        self.added = defaultdict(list)
+
+    # Adds a document to the bucket with the given key
+    def add(self, key, doc):
+        self.added[_decode(_encode(key, self.bandkey), self.bandkey)].append(doc)
+
+    # Looks up many encoded keys at once
+    # Parameters:
+    # - keys            array of band keys (BAND_KEYS dtype)
+    # Returns:
+    # - the bucket of every key as a list of doc ids (empty if the key is not present)
+    def lookup(self, keys):
+        keys = np.asarray(keys, dtype=self.keys_.dtype)
+        pos = np.minimum(np.searchsorted(self.keys_, keys), max(len(self.keys_) - 1, 0))
+        found = self.keys_[pos] == keys if len(self.keys_) else np.zeros(len(keys), dtype=bool)
+        buckets = [self.postings[self.offsets[p]:self.offsets[p+1]].tolist() if f else []
+                   for p, f in zip(pos.tolist(), found.tolist())]
+        if self.added:
+            for bucket, key in zip(buckets, keys):
+                bucket.extend(self.added.get(_decode(key, self.bandkey), []))
+        return buckets
+
+    # position of the given key in the sorted keys, or -1 if it is not present
+    def _find(self, key):
+        encoded = _encode(key, self.bandkey)
+        if encoded is None:
+            return -1
+        # compare as arrays: numpy strips trailing zero bytes of S16 values
+        encoded = np.array([encoded], dtype=self.keys_.dtype)
+        pos = np.searchsorted(self.keys_, encoded[0])
+        if pos < len(self.keys_) and self.keys_[pos:pos+1] == encoded:
+            return pos
+        return -1
+
+    def __getitem__(self, key):
+        pos = self._find(key)
+        if pos < 0:
+            if key in self.added:
+                return self.added[key]
+            raise KeyError(key)
+        return self.postings[self.offsets[pos]:self.offsets[pos+1]].tolist() + self.added.get(key, [])
+
+    def __contains__(self, key):
+        return key in self.added or self._find(key) >= 0
+
+    def __iter__(self):
+        for key in self.keys_:
+            yield _decode(key, self.bandkey)
+        for key in self.added:
+            if self._find(key) < 0:
+                yield key
+
+    def __len__(self):
+        return len(self.keys_) + sum(1 for key in self.added if self._find(key) < 0)
+
+    # Iterates over all buckets without looking up their keys
+    def values(self):
+        self.merge()
+        for j in range(len(self.keys_)):
+            yield self.postings[self.offsets[j]:self.offsets[j+1]].tolist()
+
+
+# converts a band key as used in dictionaries (int or hex string) to its stored value, None if it is invalid
+def _encode(key, bandkey):
+    if bandkey == "md5":
+        if isinstance(key, bytes):
+            return key
+        if not isinstance(key, str) or len(key) != 2 * MD5_KEY.itemsize:
+            return None
+        return bytes.fromhex(key)
+    if isinstance(key, (str, bytes)):
+        return None
+    return int(key)
+
+
+# converts a stored band key back to its dictionary form
+def _decode(key, bandkey):
+    if bandkey == "md5":
+        # numpy strips trailing zero bytes of S16 values: pad them back
+        return bytes(key).ljust(MD5_KEY.itemsize, b"\0").hex()
+    return int(key)
+
+
+# Groups documents by band key: sorts the keys and lists the documents of each distinct key
+# Parameters:
+# - keys            array of band keys, one per document
+# - docs            document ids, in increasing order. default: 0, 1, 2, ...
+# Returns:
+# - (distinct keys, bucket offsets, postings) arrays as stored in a BandTable
+def bucket_arrays(keys, docs=None):
+    # a stable sort keeps the (increasing) document ids sorted within each bucket
+    order = np.argsort(keys, kind='stable')
+    postings = (order if docs is None else np.asarray(docs)[order]).astype(np.uint32)
+    keys = keys[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    offsets = np.append(np.nonzero(first)[0], len(keys)).astype(np.int64)
+    return keys[first], offsets, postings
+
+
+# Writes an index to a binary file
+# Parameters:
+# - path            file to write
+# - M, r            signature length and rows per band
+# - hashfunctions   list of stored hash functions (strings produced by .store())
+# - signatures      (number of documents x M) signature matrix
+# - docs            list of shingle sets or a ShingleStore
+# - index           list of band tables (dictionaries or BandTables)
+# - deleted         ids of removed documents
+# - bandkey         type of the band keys, see BAND_KEYS
+# - shinglehash     hash function of the shingles, see processing.SHINGLE_HASHES
+def write_index(path, M, r, hashfunctions, signatures, docs, index, deleted=(), bandkey="mix64", shinglehash="md5"):
+    if not isinstance(docs, ShingleStore):
+        docs = ShingleStore.from_sets(docs)
+    if signatures is None:
+        signatures = np.empty((0, M), dtype=np.uint64)
+
+    packed = [band.arrays() if isinstance(band, BandTable) else BandTable.pack(band, bandkey) for band in index]
+    band_offsets = np.zeros(len(packed) + 1, dtype=np.int64)
+    band_offsets[1:] = np.cumsum([len(keys) for keys, _, _ in packed])
+    # bucket offsets of each band are relative to its own postings: shift them to the concatenated postings
+    posting_starts = np.cumsum([0] + [len(postings) for _, _, postings in packed])
+    bucket_offsets = np.concatenate([offsets[:-1] + start for (_, offsets, _), start in zip(packed, posting_starts)]
+                                    + [posting_starts[-1:]])
+
+    blocks = {
+        'signatures': np.asarray(signatures, dtype='<u8').reshape(-1, M),
+        'shingles': np.asarray(docs.shingles, dtype='<u8'),
+        'shingle_offsets': np.asarray(docs.offsets, dtype='<i8'),
+        'band_offsets': band_offsets.astype('<i8'),
+        'keys': np.concatenate([keys for keys, _, _ in packed] + [np.empty(0, BAND_KEYS[bandkey])]).astype(BAND_KEYS[bandkey]),
+        'bucket_offsets': bucket_offsets.astype('<i8'),
+        'postings': np.concatenate([postings for _, _, postings in packed] + [np.empty(0, '<u4')]).astype('<u4'),
+        'deleted': np.array(sorted(deleted), dtype='<i8'),
+    }
+
+    _write_file(path, M, r, hashfunctions, bandkey, shinglehash, blocks)
+
+
+# Writes the header and data blocks of a binary index file
+# Blocks are either arrays or _FileBlocks, which are copied from a temporary file
+def _write_file(path, M, r, hashfunctions, bandkey, shinglehash, blocks):
+    # block offsets are relative to the start of the data section, which follows the header
+    header = {
+        'M': M,
+        'r': r,
+        'hashfunctions': hashfunctions,
+        'bandkey': bandkey,
+        'shinglehash': shinglehash,
+        'blocks': {}
+    }
+    offset = 0
+    for name, block in blocks.items():
+        header['blocks'][name] = {'offset': offset, 'dtype': block.dtype.str, 'shape': list(block.shape)}
+        offset = _align(offset + block.nbytes)
+    encoded = json.dumps(header).encode()
+    start = _align(len(MAGIC) + 8 + len(encoded))
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array([FORMAT_VERSION, len(encoded)], dtype='<u4').tobytes())
+        f.write(encoded)
+        for name, block in blocks.items():
+            f.seek(start + header['blocks'][name]['offset'])
+            if isinstance(block, _FileBlock):
+                with open(block.path, 'rb') as data:
+                    shutil.copyfileobj(data, f)
+            else:
+                block.tofile(f)
+
+
+# Data block stored in a (temporary) file
+class _FileBlock:
+    def __init__(self, path, dtype, shape):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.shape = shape
+        self.nbytes = int(np.prod(shape)) * self.dtype.itemsize
+
+
+# Builds a binary index on disk from batches of documents, without keeping the index in memory
+# Signatures, shingles and band entries are appended to temporary files next to the index. When all documents
+# have been added, the entries of each band are sorted one band at a time, so peak memory is bounded by
+# the size of one band (8 bytes per document + keys) instead of the whole index
+class IndexBuilder:
+    # Parameters:
+    # - path            index file to create
+    # - M, r            signature length and rows per band
+    # - hashfunctions   list of stored hash functions (strings produced by .store())
+    # - bandkey         type of the band keys, see BAND_KEYS
+    # - shinglehash     hash function of the shingles, see processing.SHINGLE_HASHES
+    def __init__(self, path, M, r, hashfunctions, bandkey="mix64", shinglehash="md5"):
+        self.path = path
+        self.bandkey = bandkey
+        self.shinglehash = shinglehash
+        self.M = M
+        self.r = r
+        self.hashfunctions = hashfunctions
+        self.bands = M // r
+        self.count = 0
+        self.shingle_count = 0
+        self.tmp = tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path)))
+        self.files = {name: open(self._tmp(name), 'wb') for name in ['signatures', 'shingles', 'shingle_offsets']}
+        for i in range(self.bands):
+            self.files['keys_%s' % i] = open(self._tmp('keys_%s' % i), 'wb')
+        np.zeros(1, dtype='<i8').tofile(self.files['shingle_offsets'])
+
+    def _tmp(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    # Appends a batch of documents
+    # Parameters:
+    # - signatures      (number of documents x M) signature matrix
+    # - shingles        list of sorted uint64 shingle arrays
+    # - keys            (number of documents x number of bands) array of band keys
+    def add(self, signatures, shingles, keys):
+        np.asarray(signatures, dtype='<u8').tofile(self.files['signatures'])
+        sizes = np.array([len(doc) for doc in shingles], dtype=np.int64)
+        for doc in shingles:
+            np.asarray(doc, dtype='<u8').tofile(self.files['shingles'])
+        (self.shingle_count + np.cumsum(sizes)).astype('<i8').tofile(self.files['shingle_offsets'])
+        for i in range(self.bands):
+            keys[:, i].astype(BAND_KEYS[self.bandkey]).tofile(self.files['keys_%s' % i])
+        self.count += len(shingles)
+        self.shingle_count += int(sizes.sum())
+
+    # Sorts the band entries and writes the index file
+    def finish(self):
+        for f in self.files.values():
+            f.close()
+
+        band_offsets = np.zeros(self.bands + 1, dtype=np.int64)
+        posting_start = 0
+        with open(self._tmp('keys'), 'wb') as keys_file, open(self._tmp('bucket_offsets'), 'wb') as offsets_file, \
+                open(self._tmp('postings'), 'wb') as postings_file:
+            for i in range(self.bands):
+                keys, offsets, postings = bucket_arrays(np.fromfile(self._tmp('keys_%s' % i),
+                                                                    dtype=BAND_KEYS[self.bandkey]))
+                os.remove(self._tmp('keys_%s' % i))
+                keys.tofile(keys_file)
+                (posting_start + offsets[:-1]).astype('<i8').tofile(offsets_file)
+                postings.astype('<u4').tofile(postings_file)
+                band_offsets[i+1] = band_offsets[i] + len(keys)
+                posting_start += len(postings)
+            np.array([posting_start], dtype='<i8').tofile(offsets_file)
+
+        blocks = {
+            'signatures': _FileBlock(self._tmp('signatures'), '<u8', (self.count, self.M)),
+            'shingles': _FileBlock(self._tmp('shingles'), '<u8', (self.shingle_count,)),
+            'shingle_offsets': _FileBlock(self._tmp('shingle_offsets'), '<i8', (self.count + 1,)),
+            'band_offsets': band_offsets.astype('<i8'),
+            'keys': _FileBlock(self._tmp('keys'), BAND_KEYS[self.bandkey], (int(band_offsets[-1]),)),
+            'bucket_offsets': _FileBlock(self._tmp('bucket_offsets'), '<i8', (int(band_offsets[-1]) + 1,)),
+            'postings': _FileBlock(self._tmp('postings'), '<u4', (posting_start,)),
+            'deleted': np.empty(0, dtype='<i8'),
+        }
+        _write_file(self.path, self.M, self.r, self.hashfunctions, self.bandkey, self.shinglehash, blocks)
+        self.tmp.cleanup()
+
+
+# rounds up to a multiple of ALIGNMENT
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+# Opens a binary index file, data blocks are memory-mapped and only read from disk when accessed
+# Returns:
+# - the header dictionary and a dictionary of arrays {block name: numpy.memmap}
+def read_index(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a binary index file' % path)
+        version, length = np.frombuffer(f.read(8), dtype='<u4')
+        if version not in SUPPORTED_VERSIONS:
+            raise ValueError('Unsupported index format version %s' % version)
+        header = json.loads(f.read(length).decode())
+    start = _align(len(MAGIC) + 8 + int(length))
+
+    blocks = {}
+    for name, block in header['blocks'].items():
+        dtype = np.dtype(block['dtype'])
+        shape = tuple(block['shape'])
+        if np.prod(shape) == 0:
+            # empty arrays can't be memory-mapped
+            blocks[name] = np.empty(shape, dtype=dtype)
+        else:
+            blocks[name] = np.memmap(path, dtype=dtype, mode='r', offset=start + block['offset'], shape=shape)
+    return header, blocks
+
+
+# Builds the band tables of an opened binary index
+def band_tables(blocks):
+    band_offsets = blocks['band_offsets']
+    tables = []
+    for i in range(len(band_offsets) - 1):
+        start, end = band_offsets[i], band_offsets[i+1]
+        tables.append(BandTable(blocks['keys'][start:end],
+                                blocks['bucket_offsets'][start:end+1],
+                                blocks['postings']))
+    return tables
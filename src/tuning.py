@@ -0,0 +1,206 @@
+import time
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+from candidates import candidate_pairs
+from lsh import LSH, band_hashes
+from signature import EMPTY, MinhashEngine, generate_hashfunctions
+from storage import BandTable
+
+# Picks the signature length M, rows per band r and number of bands b of an index from target thresholds,
+# instead of building indexes for a grid of settings.
+# The pair-similarity distribution of the collection is estimated from the signatures of a sample of documents,
+# after which the expected number of candidates, false positives and false negatives of every (r, b) follows
+# from the S-curve P(s) = 1 - (1 - s^r)^b without building anything.
+
+
+# probability that a pair with similarity s shares a bucket in at least one of b bands of r rows
+def s_curve(s, r, b):
+    return 1 - np.power(1 - np.power(s, r), b)
+
+
+# Estimates the pair-similarity distribution of a collection from a signature matrix (stratified sampling)
+# Pairs that share a bucket of a permissive banding (tail_r rows per band) are all counted, as those contain
+# nearly every pair of high similarity. All other pairs are estimated from a uniform sample of pairs.
+# The similarity of every pair is estimated by comparing signatures, vectorized over blocks of pairs.
+# Parameters:
+# - signatures      (number of documents x M) signature matrix of (a sample of) the collection
+# - sample_pairs    number of pairs sampled outside the permissive banding
+# - bins            number of similarity bins
+# - tail_r          rows per band of the permissive banding
+# - total_docs      number of documents in the full collection, if signatures only holds a sample of it
+# - seed            seed for sampling pairs
+# - floor           put similarity s in bin floor(s * bins) (similarity 1 in the last bin, bins bins in total)
+#                   instead of rounding it to a multiple of 1/bins (bins + 1 bins)
+# - confidence      if set, also return confidence intervals of the counts at this level (e.g. 0.95)
+#                   the intervals cover the sampling of pairs, not the error of the signature estimates
+# Returns:
+# - (similarities, counts): the similarity of every bin (its lower bound if floor is set) and the estimated
+#   number of pairs in every bin, followed by the lower and upper bounds of the counts if confidence is set
+def similarity_histogram(signatures, sample_pairs=200000, bins=100, tail_r=4, total_docs=None, seed=None,
+                         floor=False, confidence=None):
+    signatures = np.asarray(signatures, dtype=np.uint64)
+    n = len(signatures)
+    size = bins if floor else bins + 1
+    exact = np.zeros(size)
+    sampled = np.zeros(size)
+    total = n * (n - 1) // 2
+
+    keys = band_hashes(signatures, tail_r)
+    first, second, _ = candidate_pairs([BandTable.from_keys(keys[:, i]) for i in range(keys.shape[1])])
+    exact += _count_pairs(signatures, first, second, bins, floor)
+    tail_keys = _pair_keys(first, second)
+
+    rest = total - len(first)
+    weight = 0
+    if rest > 0:
+        if rest <= sample_pairs:
+            first, second = np.triu_indices(n, 1)
+        else:
+            rng = np.random.default_rng(seed)
+            pairs = rng.integers(0, n, size=(sample_pairs, 2))
+            pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+            first, second = pairs.min(axis=1), pairs.max(axis=1)
+        # pairs of the permissive banding are already counted
+        tail = np.isin(_pair_keys(first, second), tail_keys)
+        first, second = first[~tail], second[~tail]
+        if len(first):
+            sampled = _count_pairs(signatures, first, second, bins, floor)
+            weight = rest / len(first)
+
+    scale = (total_docs * (total_docs - 1) / 2) / total if total_docs is not None and total > 0 else 1
+    counts = (exact + sampled * weight) * scale
+    sims = np.arange(size) / bins
+    if confidence is None:
+        return sims, counts
+    if weight == 1 or len(first) == 0:
+        # every pair was counted
+        return sims, counts, counts.copy(), counts.copy()
+    low, high = _wilson_interval(sampled, len(first), confidence)
+    return sims, counts, (exact + low * rest) * scale, (exact + high * rest) * scale
+
+
+def _pair_keys(first, second):
+    return first.astype(np.uint64) << np.uint64(32) | second.astype(np.uint64)
+
+
+# histogram of the estimated similarities of pairs
+# documents without shingles (all EMPTY signatures) have similarity 0 to every other document
+def _count_pairs(signatures, first, second, bins, floor, chunk_size=2**16):
+    counts = np.zeros(bins if floor else bins + 1)
+    empty = signatures[:, 0] == EMPTY
+    for start in range(0, len(first), chunk_size):
+        a, b = first[start:start+chunk_size], second[start:start+chunk_size]
+        sims = np.mean(signatures[a] == signatures[b], axis=1)
+        sims[empty[a] | empty[b]] = 0
+        if floor:
+            positions = np.minimum(np.floor(sims * bins), bins - 1).astype(np.int64)
+        else:
+            positions = np.rint(sims * bins).astype(np.int64)
+        counts += np.bincount(positions, minlength=len(counts))
+    return counts
+
+
+# Wilson score interval of binomial proportions (successes out of n trials)
+def _wilson_interval(successes, n, confidence):
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    p = successes / n
+    center = (p + z * z / (2 * n)) / (1 + z * z / n)
+    margin = z * np.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return np.maximum(center - margin, 0), np.minimum(center + margin, 1)
+
+
+# Finds the cheapest (M, r, b) for a pair-similarity distribution
+# A setting meets the targets if a pair of similarity s1 becomes a candidate with probability at most max_fp
+# and a pair of similarity s2 is missed with probability at most max_fn. Of those settings, the one with
+# the lowest expected cost is returned:
+#   cost = hash_cost * M * docs                   (computing the signatures)
+#        + verify_cost * expected candidates      (Jaccard verification)
+#        + fp_weight * expected candidates with a similarity below s1
+#        + fn_weight * expected missed pairs with a similarity of at least s2
+# Costs are in arbitrary units, the defaults are about microseconds on a single core
+# Parameters:
+# - histogram       (similarities, counts) as returned by similarity_histogram
+# - docs            number of documents in the collection
+# - s1, s2          lower and upper bound of the tolerance zone
+# - max_fp, max_fn  maximum probability of a candidate at s1 and of a missed pair at s2
+# - fp_weight       cost of a false positive (candidate below s1), on top of its verification
+# - fn_weight       cost of a missed pair with a similarity of at least s2
+# - max_M           largest signature length considered
+# - hash_cost       cost of one minhash of one document
+# - verify_cost     cost of verifying one candidate pair
+# Returns:
+# - a dictionary with M, r, b, p1, p2 (the probabilities at s1 and s2), the expected number of candidates,
+#   false positives and false negatives, the verification cost and the total cost,
+#   or None if no setting up to max_M meets the targets
+def tune(histogram, docs, s1, s2, max_fp=0.05, max_fn=0.05, fp_weight=1.0, fn_weight=1000.0, max_M=512,
+         hash_cost=0.5, verify_cost=2.0):
+    assert 0 < s1 < s2 <= 1
+    sims, counts = histogram
+    below, above = sims < s1, sims >= s2
+    best = None
+    for r in range(1, max_M + 1):
+        b = np.arange(1, max_M // r + 1)
+        p1, p2 = s_curve(s1, r, b), s_curve(s2, r, b)
+        feasible = (p1 <= max_fp) & (1 - p2 <= max_fn)
+        if not feasible.any():
+            continue
+        b = b[feasible]
+        p = s_curve(sims[None, :], r, b[:, None])
+        candidates = p @ counts
+        false_positives = p[:, below] @ counts[below]
+        false_negatives = (1 - p[:, above]) @ counts[above]
+        cost = hash_cost * r * b * docs + verify_cost * candidates + fp_weight * false_positives \
+            + fn_weight * false_negatives
+        i = int(np.argmin(cost))
+        if best is None or cost[i] < best['cost']:
+            best = {
+                'M': int(r * b[i]),
+                'r': r,
+                'b': int(b[i]),
+                'p1': float(p1[feasible][i]),
+                'p2': float(p2[feasible][i]),
+                'candidates': float(candidates[i]),
+                'false_positives': float(false_positives[i]),
+                'false_negatives': float(false_negatives[i]),
+                'verification_cost': float(verify_cost * candidates[i]),
+                'cost': float(cost[i])
+            }
+    return best
+
+
+# Tunes (M, r, b) for a csv file of documents: a sample of the documents is pre-processed like LSH does
+# and signed with a one-permutation hash of length M, from which the similarity distribution is estimated
+# Parameters:
+# - filename        name of the csv file containing the documents
+# - s1, s2          lower and upper bound of the tolerance zone
+# - sample          number of sampled documents. default: 2000
+# - M               signature length used to estimate similarities. default: 128
+# - seed            seed for sampling documents and pairs
+# - options         passed on to tune
+# Returns:
+# - the result of tune
+def tune_collection(filename, s1, s2, sample=2000, M=128, seed=None, **options):
+    t = time.time()
+    articles = pd.read_csv('./data/%s' % filename)['article']
+    docs = len(articles)
+    if docs > sample:
+        articles = articles.sample(sample, random_state=seed)
+
+    lsh = LSH()
+    engine = MinhashEngine(generate_hashfunctions(M, "OPHhash"))
+    signatures = engine.signature_matrix([lsh._filter(article) for article in articles])
+    histogram = similarity_histogram(signatures, total_docs=docs, seed=seed)
+    result = tune(histogram, docs, s1, s2, **options)
+    print('Tuning on %s sampled documents took' % len(articles), time.time() - t, 'seconds')
+    return result
+
+
+if __name__ == "__main__":
+    result = tune_collection('news_articles_small.csv', 0.3, 0.8)
+    if result is None:
+        print('No setting of M and r meets the error targets for the tolerance zone 0.3 - 0.8')
+    else:
+        print(result)
@@ -0,0 +1,99 @@
+import atexit
+import mmap
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from usersettings import usersettings
+
+# Persistent process pool shared by the parallel stages (shingling in processing.py, signature matrices in
+# signature.py, verification of candidate pairs in jaccard.py). The pool is started on first use and reused by
+# every later call, so a run starts usersettings["threads"] workers once instead of a pool per call.
+# Large arrays are never pickled per task: a task holds handles of its arrays (see array_handle). Memory-mapped
+# arrays are reopened from their file by the workers, other arrays are copied into shared memory.
+_pool = None
+
+# memory-mapped arrays opened by a pool worker: {(filename, offset, dtype, shape): numpy.memmap}
+_worker_files = {}
+# number of memory-mapped arrays a worker keeps open
+MAX_WORKER_FILES = 8
+
+
+def get_pool():
+    global _pool
+    # restart the pool if usersettings["threads"] changed since it was started
+    if _pool is not None and _pool._processes != usersettings["threads"]:
+        close_pool()
+    if _pool is None:
+        _pool = Pool(usersettings["threads"])
+        atexit.register(close_pool)
+    return _pool
+
+
+def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.terminate()
+        _pool = None
+
+
+# Copies an array into a new shared memory block
+def shared_array(values):
+    values = np.ascontiguousarray(values)
+    shm = SharedMemory(create=True, size=max(1, values.nbytes))
+    np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[...] = values
+    return shm
+
+
+# array view of a shared memory block, views must be released before the block is closed
+def shared_view(shm, shape, dtype):
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+# Returns the (filename, byte offset) of a contiguous memory-mapped array (or a slice of one) in its file,
+# None for any other array
+def file_location(values):
+    if not isinstance(values, np.memmap) or values.filename is None or getattr(values, '_mmap', None) is None \
+            or not values.flags.c_contiguous:
+        return None
+    # the offset attribute of a slice is the one of the array it was sliced from: use the address in the mapping
+    mapped = np.frombuffer(values._mmap, dtype=np.uint8).ctypes.data
+    start = values.offset - values.offset % mmap.ALLOCATIONGRANULARITY
+    return values.filename, start + values.ctypes.data - mapped
+
+
+# Returns a picklable handle of an array for pool workers (see open_array)
+# Parameters:
+# - values          numpy array
+# - blocks          list to which a created shared memory block is added, the caller closes and unlinks them
+#                   once the workers are done
+def array_handle(values, blocks):
+    location = file_location(values)
+    if location is not None:
+        return ('file', location[0], location[1], values.dtype.str, values.shape)
+    shm = shared_array(values)
+    blocks.append(shm)
+    return ('shm', shm.name, values.dtype.str, values.shape)
+
+
+# Opens the array of a handle in a pool worker
+# Parameters:
+# - handle          handle returned by array_handle
+# - blocks          list to which an attached shared memory block is added, the caller closes them once all
+#                   views of the array are released
+def open_array(handle, blocks):
+    if handle[0] == 'file':
+        _, filename, offset, dtype, shape = handle
+        if handle not in _worker_files:
+            if len(_worker_files) >= MAX_WORKER_FILES:
+                _worker_files.pop(next(iter(_worker_files)))
+            if np.prod(shape) == 0:
+                _worker_files[handle] = np.empty(shape, dtype=dtype)
+            else:
+                _worker_files[handle] = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+        return _worker_files[handle]
+    _, name, dtype, shape = handle
+    shm = SharedMemory(name=name)
+    blocks.append(shm)
+    return shared_view(shm, shape, np.dtype(dtype))
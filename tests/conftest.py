@@ -0,0 +1,63 @@
+import os
+import random
+import sys
+
+import pytest
+
+# the modules of src/ import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from usersettings import usersettings  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def single_thread():
+    # the tests run everything in-process, tests of the process pool set the threads themselves
+    threads = usersettings["threads"]
+    usersettings["threads"] = 1
+    yield
+    usersettings["threads"] = threads
+
+
+# Small synthetic collection: originals of random words and near-duplicates of some of them (a few words
+# replaced), so there are similar pairs at a range of similarities
+@pytest.fixture(scope="session")
+def corpus():
+    rng = random.Random(7)
+    # shingles start at stopwords
+    vocabulary = ["word%d" % i for i in range(2000)] + ["the", "of", "and", "to", "in", "a"] * 150
+    docs = [" ".join(rng.choice(vocabulary) for _ in range(rng.randint(20, 60))) for _ in range(150)]
+    for _ in range(100):
+        words = rng.choice(docs).split()
+        for _ in range(rng.randint(0, 6)):
+            words[rng.randrange(len(words))] = rng.choice(vocabulary)
+        docs.append(" ".join(words))
+    return docs
+
+
+# Index of the corpus (M = 40, r = 4), shared by the tests that don't change it
+@pytest.fixture(scope="session")
+def lsh(corpus):
+    from lsh import LSH
+    from signature import generate_hashfunctions
+    random.seed(1)
+    lsh = LSH()
+    lsh.build_index(corpus, 40, 4, generate_hashfunctions(40, "Xorhash"))
+    return lsh
+
+
+# Temporary working directory with an empty data directory: indexes and csv files are read from and written
+# to ./data
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    (tmp_path / "data").mkdir()
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+# csv file data/corpus.csv of the corpus in the working directory (see workdir)
+@pytest.fixture
+def corpus_csv(corpus, workdir):
+    import pandas as pd
+    pd.DataFrame({'article': corpus}).to_csv(workdir / "data" / "corpus.csv", index=False)
+    return "corpus.csv"
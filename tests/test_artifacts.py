@@ -0,0 +1,45 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from artifacts import ArtifactCache
+from lsh import LSH
+from processing import shingle_batch
+from signature import MinhashEngine
+
+
+def test_signatures_are_sliced_and_extended(corpus, corpus_csv, workdir):
+    cache = ArtifactCache(str(workdir / "cache"))
+    _filter = LSH()._filter
+    hashfunctions = cache.hashfunctions(16)
+    # the first functions of a family never change
+    assert [h.store() for h in cache.hashfunctions(8)] == [h.store() for h in hashfunctions[:8]]
+    assert [h.store() for h in cache.hashfunctions(24)[:16]] == [h.store() for h in hashfunctions]
+
+    shingles = cache.shingles(corpus_csv, _filter)
+    assert [doc.tolist() for doc in shingles] == [doc.tolist() for doc in shingle_batch(corpus, _filter)]
+    expected = MinhashEngine(cache.hashfunctions(24)).signature_matrix(shingles)
+    assert np.array_equal(cache.signatures(corpus_csv, _filter, hashfunctions), expected[:, :16])
+    assert np.array_equal(cache.signatures(corpus_csv, _filter, cache.hashfunctions(8)), expected[:, :8])
+    assert np.array_equal(cache.signatures(corpus_csv, _filter, cache.hashfunctions(24)), expected)
+    # one signature file per family and shingles
+    assert len(os.listdir(workdir / "cache" / "signatures")) == 2
+
+
+def test_cached_index_equals_built_index(corpus, corpus_csv, workdir):
+    cache = ArtifactCache(str(workdir / "cache"))
+    cached = LSH()
+    cached.create_index(corpus_csv, 20, 4, cache=cache)
+    lsh = LSH()
+    lsh.build_index(corpus, 20, 4, cache.hashfunctions(20))
+    assert np.array_equal(cached.signatures, lsh.signatures)
+    assert cached.get_all_similar_pairs(0.5, output=None) == lsh.get_all_similar_pairs(0.5, output=None)
+
+
+def test_changed_file_is_shingled_again(corpus, corpus_csv, workdir):
+    cache = ArtifactCache(str(workdir / "cache"))
+    _filter = LSH()._filter
+    assert len(cache.shingles(corpus_csv, _filter)) == len(corpus)
+    pd.DataFrame({'article': corpus[:10]}).to_csv(workdir / "data" / corpus_csv, index=False)
+    assert len(cache.shingles(corpus_csv, _filter)) == 10
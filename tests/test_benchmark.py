@@ -0,0 +1,18 @@
+import random
+
+from benchmark import run_stages
+from lsh import LSH
+from signature import generate_hashfunctions
+
+
+def test_run_stages_builds_the_same_index(corpus, workdir):
+    random.seed(4)
+    seconds, pairs = run_stages(corpus, corpus[:10], 40, 4, "Xorhash", 0.5, "benchmark.bin")
+    assert set(seconds) == {"to_shingles", "shingle_batch", "generate_signature_matrix", "index_gen", "store_index",
+                            "load_index", "query", "query_batch", "get_all_similar_pairs"}
+    random.seed(4)
+    lsh = LSH()
+    lsh.build_index(corpus, 40, 4, generate_hashfunctions(40, "Xorhash"))
+    assert pairs == len(lsh.get_all_similar_pairs(0.5, output=None))
+    stored = LSH("benchmark.bin")
+    assert (stored.M, stored.r, stored.bandkey, stored.shinglehash, stored.deleted) == (40, 4, "mix64", "mix64", set())
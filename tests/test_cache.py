@@ -0,0 +1,68 @@
+import cache
+from cache import QueryCache
+from lsh import LSH
+
+
+def test_lru_eviction():
+    query_cache = QueryCache(maxsize=2)
+    a, b, c = (QueryCache.key({i}, 0.8) for i in range(3))
+    query_cache.put(a, [1])
+    query_cache.put(b, [2])
+    assert query_cache.get(a) == [1]
+    query_cache.put(c, [3])
+    assert query_cache.get(b) is None and query_cache.get(a) == [1] and query_cache.get(c) == [3]
+    assert len(query_cache) == 2 and query_cache.evictions == 1
+
+
+def test_key_depends_on_shingles_and_options():
+    assert QueryCache.key({1, 2}, 0.8) == QueryCache.key({2, 1}, 0.8)
+    assert QueryCache.key({1, 2}, 0.8) != QueryCache.key({1, 2}, 0.9)
+    assert QueryCache.key({1, 2}, 0.8) != QueryCache.key({1, 3}, 0.8)
+
+
+def test_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    query_cache = QueryCache(ttl=10)
+    key = QueryCache.key({1}, 0.8)
+    query_cache.put(key, [1])
+    now[0] += 10
+    assert query_cache.get(key) == [1]
+    now[0] += 0.5
+    assert query_cache.get(key) is None
+    assert len(query_cache) == 0
+    assert (query_cache.hits, query_cache.misses) == (1, 1)
+
+
+def test_index_changes_invalidate_cached_results(lsh, corpus):
+    index = LSH()
+    index.build_index(corpus[:150], lsh.M, lsh.r, lsh.hashfunctions)
+    index.enable_cache()
+    query = corpus[10]
+    first = index.query(query, 0.5)
+    assert index.query(query, 0.5) == first and index.cache.hits == 1
+    assert index.query_batch([query], 0.5) == [first] and index.cache.hits == 2
+
+    new = index.add_documents([query])[0]
+    assert index.query(query, 0.5) == sorted(first + [new])
+    expected = [doc for doc in sorted(first + [new]) if doc != 10]
+    index.remove_documents([10])
+    assert index.query_batch([query], 0.5) == [expected]
+    index.compact()
+    assert len(index.cache) == 0
+    assert index.query(query, 0.5) == expected
+
+
+def test_memory_bound():
+    key = lambda i: QueryCache.key({i}, 0.8)
+    size = cache._result_bytes((tuple(range(1000, 2000)), 5))
+    query_cache = QueryCache(maxsize=100, maxbytes=int(2.5 * size))
+    for i in range(3):
+        query_cache.put(key(i), (tuple(range(1000, 2000)), 5))
+    assert len(query_cache) == 2 and query_cache.get(key(0)) is None and query_cache.evictions == 1
+    assert query_cache.bytes == 2 * size == query_cache.stats()['bytes']
+    # a result larger than the bound is not cached, and replaces no cached result
+    query_cache.put(key(1), (tuple(range(10000)), 5))
+    assert query_cache.get(key(1)) is None and len(query_cache) == 1 and query_cache.bytes == size
+    query_cache.clear()
+    assert query_cache.bytes == 0
@@ -0,0 +1,78 @@
+from itertools import combinations
+
+import numpy as np
+import pytest
+
+from candidates import _bucket_pairs, bucket_members, candidate_pairs
+from storage import BandTable
+
+
+# the candidate pairs of an index of dictionaries, computed with sets
+def brute_force(index, deleted=()):
+    pairs = set()
+    for band in index:
+        for bucket in band.values():
+            pairs.update(combinations(sorted(set(bucket) - set(deleted)), 2))
+    return sorted(pairs)
+
+
+def random_index(seed, bands=4, docs=300, keys=40):
+    rng = np.random.default_rng(seed)
+    index = []
+    for _ in range(bands):
+        band = {}
+        for doc, key in enumerate(rng.integers(0, keys, docs).tolist()):
+            band.setdefault(key, []).append(doc)
+        index.append(band)
+    return index
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 100, 2**20])
+def test_bucket_pairs_cover_every_bucket_pair_once(chunk_size):
+    sizes = np.array([2, 3, 1, 40, 5], dtype=np.int64)
+    members = np.arange(sizes.sum(), dtype=np.int64)
+    pairs = [pair for first, second in _bucket_pairs(sizes[sizes >= 2], members[np.repeat(sizes >= 2, sizes)],
+                                                     chunk_size)
+             for pair in zip(first.tolist(), second.tolist())]
+    starts = np.cumsum(sizes) - sizes
+    expected = [pair for start, size in zip(starts.tolist(), sizes.tolist())
+                for pair in combinations(range(start, start + size), 2)]
+    assert sorted(pairs) == expected
+
+
+@pytest.mark.parametrize("chunk_size", [5, 2**20])
+def test_candidate_pairs_equal_brute_force(chunk_size):
+    index = random_index(1)
+    first, second, skipped = candidate_pairs(index, chunk_size=chunk_size)
+    assert list(zip(first.tolist(), second.tolist())) == brute_force(index)
+    assert skipped == 0
+
+
+def test_candidate_pairs_of_band_tables_and_dictionaries_agree():
+    index = random_index(2)
+    tables = [BandTable(*BandTable.pack(band, "mix64")) for band in index]
+    assert [a.tolist() for a in candidate_pairs(tables)[:2]] == [a.tolist() for a in candidate_pairs(index)[:2]]
+
+
+def test_candidate_pairs_leave_out_deleted_documents():
+    index = random_index(3)
+    deleted = {0, 5, 17, 299}
+    first, second, _ = candidate_pairs(index, deleted=deleted)
+    assert list(zip(first.tolist(), second.tolist())) == brute_force(index, deleted)
+
+
+def test_oversized_buckets():
+    index = [{1: list(range(10)), 2: [10, 11]}]
+    first, second, skipped = candidate_pairs(index, max_bucket=5)
+    assert list(zip(first.tolist(), second.tolist())) == [(10, 11)]
+    assert skipped == 45
+    first, second, skipped = candidate_pairs(index, max_bucket=5, oversized="sample", seed=1)
+    # a sample of 5 documents of the large bucket is paired
+    assert len(first) == 10 + 1 and skipped == 45 - 10
+    assert (first < second).all()
+
+
+def test_bucket_members_are_sorted_per_bucket():
+    sizes, members = bucket_members([{1: [4, 2, 9], 2: [3], 3: [8, 1]}])
+    assert sizes.tolist() == [3, 2]
+    assert members.tolist() == [2, 4, 9, 1, 8]
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from clustering import UnionFind
+from lsh import LSH
+
+
+# clusters as sets of document ids, without the documents that are on their own
+def clusters_of(labels):
+    clusters = {}
+    for doc, label in enumerate(labels.tolist()):
+        clusters.setdefault(label, set()).add(doc)
+    return sorted(sorted(cluster) for label, cluster in clusters.items() if label >= 0 and len(cluster) > 1)
+
+
+# connected components of pairs, see clusters_of
+def components(pairs, n):
+    union_find = UnionFind(n)
+    union_find.union([a for a, _ in pairs], [b for _, b in pairs])
+    return clusters_of(union_find.labels())
+
+
+def test_union_find():
+    union_find = UnionFind(8)
+    union_find.union([5, 1, 6], [3, 5, 7])
+    union_find.union([3], [1])
+    assert union_find.labels().tolist() == [0, 1, 2, 1, 4, 1, 6, 6]
+    assert union_find.components == 5
+    assert union_find.find(np.array([5, 7])).tolist() == [1, 6]
+
+
+@pytest.mark.parametrize("treshold", [0.5, 0.8])
+def test_clusters_are_components_of_similar_pairs(lsh, treshold):
+    pairs = [pair for pair, _ in lsh.get_all_similar_pairs(treshold, output=None)]
+    labels = lsh.get_clusters(treshold, output=None)
+    assert len(pairs) > 0
+    assert clusters_of(labels) == components(pairs, len(lsh.docs))
+    # the label of a cluster is its smallest document id
+    assert all(labels[doc] <= doc for doc in range(len(labels)))
+
+
+def test_representative_clusters_are_finer(lsh):
+    exact = {doc: label for doc, label in enumerate(lsh.get_clusters(0.5, output=None).tolist())}
+    finer = lsh.get_clusters(0.5, representative=True, output=None)
+    for doc, label in enumerate(finer.tolist()):
+        assert exact[doc] == exact[label]
+
+
+def test_removed_documents_are_not_clustered(lsh, corpus):
+    index = LSH()
+    index.build_index(corpus, lsh.M, lsh.r, lsh.hashfunctions)
+    index.remove_documents([0, 150])
+    labels = index.get_clusters(0.5, output=None)
+    assert labels[0] == labels[150] == -1
+    pairs = [pair for pair, _ in index.get_all_similar_pairs(0.5, output=None)]
+    assert clusters_of(labels) == components(pairs, len(corpus))
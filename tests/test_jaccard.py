@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+import jaccard
+import lsh as lsh_module
+from jaccard import compute_jaccard, pairs_jaccard, prefilter_pairs, verify_pairs
+from storage import ShingleStore
+from usersettings import usersettings
+from workers import close_pool
+
+
+@pytest.fixture(scope="module")
+def sets():
+    rng = np.random.default_rng(11)
+    # shingles are 64-bit hashes
+    vocabulary = rng.integers(0, 2**63, 200, dtype=np.uint64)
+    docs = [set(rng.choice(vocabulary, rng.integers(0, 60)).tolist()) for _ in range(120)]
+    # near-duplicates, so there are pairs above every treshold
+    docs += [set(list(doc)[:len(doc) - len(doc) // 10]) | {i} for i, doc in enumerate(docs[:40])]
+    return docs
+
+
+@pytest.fixture(scope="module")
+def pairs(sets):
+    first, second = np.triu_indices(len(sets), 1)
+    return first.astype(np.int64), second.astype(np.int64)
+
+
+def test_pairs_jaccard_equal_compute_jaccard(sets, pairs):
+    first, second = pairs
+    sims = pairs_jaccard(ShingleStore.from_sets(sets), first, second)
+    expected = [compute_jaccard(sets[a], sets[b]) if sets[a] | sets[b] else 0
+                for a, b in zip(first.tolist(), second.tolist())]
+    assert np.allclose(sims, expected)
+
+
+def test_overlaps_of_shingles_sharing_their_top_bits():
+    # shingles below 2**24 all share their top 40 bits
+    store = ShingleStore.from_sets([{1, 2, 3, 5}, {2, 3, 4}, set(), {5}])
+    sims = pairs_jaccard(store, np.array([0, 0, 0, 1]), np.array([1, 2, 3, 3]))
+    assert np.allclose(sims, [2 / 5, 0, 1 / 4, 0])
+
+
+def test_verify_pairs_equal_brute_force(sets, pairs):
+    first, second = pairs
+    found_first, found_second, sims = verify_pairs(sets, first, second, 0.5)
+    expected = [(a, b) for a, b in zip(first.tolist(), second.tolist())
+                if sets[a] | sets[b] and compute_jaccard(sets[a], sets[b]) > 0.5]
+    assert list(zip(found_first.tolist(), found_second.tolist())) == expected
+    assert np.all(sims > 0.5)
+
+
+def test_verify_pairs_of_sets_and_other_store(sets):
+    first = np.arange(len(sets), dtype=np.int64)
+    second = np.zeros(len(sets), dtype=np.int64)
+    query = ShingleStore.from_sets([sets[3]])
+    found, _, sims = verify_pairs(sets, first, second, 0.5, other=query)
+    assert 3 in found.tolist() and np.all(sims > 0.5)
+    expected = [doc for doc in range(len(sets)) if sets[doc] | sets[3]
+                and compute_jaccard(sets[doc], sets[3]) > 0.5]
+    assert found.tolist() == expected
+
+
+def test_chunked_and_pooled_verification_equal_inline(sets, pairs, monkeypatch):
+    store = ShingleStore.from_sets(sets)
+    inline = verify_pairs(store, *pairs, 0.3)
+    monkeypatch.setattr(jaccard, "VERIFY_CHUNK", 1000)
+    chunked = verify_pairs(store, *pairs, 0.3)
+    usersettings["threads"] = 2
+    try:
+        pooled = verify_pairs(store, *pairs, 0.3)
+    finally:
+        close_pool()
+    for a, b, c in zip(inline, chunked, pooled):
+        assert np.array_equal(a, b) and np.array_equal(a, c)
+
+
+@pytest.mark.parametrize("treshold", [0.1, 0.5, 0.8, 0.95])
+def test_prefilter_keeps_every_similar_pair(sets, pairs, treshold):
+    store = ShingleStore.from_sets(sets)
+    first, second = pairs
+    kept_first, kept_second, pruned_size, pruned_prefix = prefilter_pairs(store, first, second, treshold)
+    assert len(kept_first) + pruned_size + pruned_prefix == len(first)
+    sims = pairs_jaccard(store, first, second)
+    kept = set(zip(kept_first.tolist(), kept_second.tolist()))
+    assert {pair for pair, sim in zip(zip(first.tolist(), second.tolist()), sims) if sim > treshold} <= kept
+
+
+@pytest.mark.parametrize("treshold", [0.1, 0.5, 0.8])
+def test_verify_pairs_with_and_without_prefilter_agree(sets, pairs, treshold):
+    store = ShingleStore.from_sets(sets)
+    with_filter = verify_pairs(store, *pairs, treshold, prefilter=True)
+    without = verify_pairs(store, *pairs, treshold, prefilter=False)
+    for a, b in zip(with_filter, without):
+        assert np.array_equal(a, b)
+    assert len(with_filter[0]) > 0
+
+
+def test_single_queries_are_verified_in_chunks(lsh, corpus, monkeypatch):
+    expected = [lsh.query(query, 0.3) for query in corpus]
+    assert any(len(results) > 1 for results in expected)
+    monkeypatch.setattr(lsh_module, "VERIFY_CHUNK", 1)
+    assert [lsh.query(query, 0.3) for query in corpus] == expected
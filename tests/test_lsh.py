@@ -0,0 +1,106 @@
+import random
+
+import numpy as np
+import pytest
+
+from lsh import LSH, perturbations
+
+
+# a new index of the first documents of the corpus, with the hash functions of the shared index
+def partial_index(lsh, corpus, count):
+    index = LSH()
+    index.build_index(corpus[:count], lsh.M, lsh.r, lsh.hashfunctions)
+    return index
+
+
+def test_added_documents_are_indexed_like_built_ones(lsh, corpus):
+    index = partial_index(lsh, corpus, 150)
+    assert index.add_documents(corpus[150:]) == list(range(150, len(corpus)))
+    assert np.array_equal(index.signatures, lsh.signatures)
+    assert [index.query(doc, 0.5) for doc in corpus[140:160]] == [lsh.query(doc, 0.5) for doc in corpus[140:160]]
+    assert index.get_all_similar_pairs(0.5, output=None) == lsh.get_all_similar_pairs(0.5, output=None)
+
+
+def test_removed_documents_are_never_returned(lsh, corpus):
+    index = partial_index(lsh, corpus, len(corpus))
+    removed = set(range(0, len(corpus), 3))
+    index.remove_documents(sorted(removed))
+    for doc in corpus[:30]:
+        assert index.query(doc, 0.5) == [doc_id for doc_id in lsh.query(doc, 0.5) if doc_id not in removed]
+    assert index.get_all_similar_pairs(0.5, output=None) == \
+        {(pair, sim) for pair, sim in lsh.get_all_similar_pairs(0.5, output=None) if not set(pair) & removed}
+
+
+def test_removing_unknown_documents_fails_without_changes(lsh, corpus):
+    index = partial_index(lsh, corpus, 20)
+    for doc_ids in ([3, 20], [-1], [5, 4, 100]):
+        with pytest.raises(ValueError):
+            index.remove_documents(doc_ids)
+    assert index.deleted == set()
+    index.remove_documents(iter([3, 19]))
+    assert index.deleted == {3, 19}
+
+
+def test_compact_keeps_the_results(lsh, corpus):
+    index = partial_index(lsh, corpus, 150)
+    index.add_documents(corpus[150:])
+    index.remove_documents([1, 2, 160])
+    queries = [index.query(doc, 0.5) for doc in corpus[:30]]
+    pairs = index.get_all_similar_pairs(0.5, output=None)
+    index.compact()
+    assert all(not band.added for band in index.index)
+    assert not any(np.isin([1, 2, 160], band.arrays()[2]).any() for band in index.index)
+    assert len(index.docs[1]) == 0 and len(index.docs[160]) == 0
+    assert [index.query(doc, 0.5) for doc in corpus[:30]] == queries
+    assert index.get_all_similar_pairs(0.5, output=None) == pairs
+    # added documents are folded in also without removed documents
+    index = partial_index(lsh, corpus, 150)
+    index.add_documents(corpus[150:])
+    index.compact()
+    assert index.get_all_similar_pairs(0.5, output=None) == lsh.get_all_similar_pairs(0.5, output=None)
+
+
+@pytest.mark.parametrize("sim", [0.3, 0.8])
+def test_query_batch_equals_query(lsh, corpus, sim):
+    queries = corpus[::5] + ["the word1 and word2 of word3", ""]
+    assert lsh.query_batch(queries, sim) == [lsh.query(query, sim) for query in queries]
+    assert lsh.query_batch(queries, sim, True) == [lsh.query(query, sim, True) for query in queries]
+    assert lsh.query_batch([], sim) == []
+
+
+@pytest.mark.parametrize("hashtype", ["Xorhash", "Linconhash", "OPHhash"])
+def test_stream_index_equals_create_index(corpus_csv, hashtype):
+    random.seed(3)
+    created = LSH()
+    created.create_index(corpus_csv, 40, 4, hashtype)
+    random.seed(3)
+    streamed = LSH()
+    streamed.stream_index(corpus_csv, "streamed.bin", 40, 4, hashtype, chunksize=60)
+    assert np.array_equal(streamed.signatures, created.signatures)
+    assert np.array_equal(streamed.docs.shingles, created.docs.shingles)
+    assert np.array_equal(streamed.docs.offsets, created.docs.offsets)
+    for band, other in zip(streamed.index, created.index):
+        for a, b in zip(band.arrays(), other.arrays()):
+            assert np.array_equal(a, b)
+
+
+def test_perturbations():
+    masks = perturbations(4)
+    assert masks.shape == (4 + 6, 4)
+    assert masks.sum(axis=1).tolist() == [1] * 4 + [2] * 6
+    assert len({tuple(mask) for mask in masks.tolist()}) == len(masks)
+
+
+def test_probes_find_a_superset(lsh, corpus):
+    queries = corpus[100:250:5]
+    plain = lsh.query_batch(queries, 0.3, True)
+    probed = lsh.query_batch(queries, 0.3, True, probes=4)
+    assert all(p[0] >= q[0] and p[1] >= q[1] for p, q in zip(probed, plain))
+    assert sum(c for _, c in probed) > sum(c for _, c in plain)
+    results = lsh.query_batch(queries, 0.3, probes=4)
+    assert results == [lsh.query(query, 0.3, probes=4) for query in queries]
+    assert all(set(q) <= set(p) for q, p in zip(lsh.query_batch(queries, 0.3), results))
+
+    pairs = lsh.get_all_similar_pairs(0.3, output=None)
+    probed_pairs = lsh.get_all_similar_pairs(0.3, output=None, probes=4)
+    assert pairs <= probed_pairs and all(sim > 0.3 for _, sim in probed_pairs)
@@ -0,0 +1,68 @@
+from hashlib import md5
+
+import numpy as np
+import pytest
+
+import processing
+from processing import (STOPWORDS, TOKEN_CACHE_SIZE, _token_hash, pre_processing, shingle_batch, shingle_hashes,
+                        shingle_variants, to_shingles)
+from usersettings import usersettings
+from workers import close_pool, get_pool
+
+OPTIONS = [{}, {'filter_punctuation': True, 'remove_capitalization': True, 'stopword_start': True},
+           {'filter_stopwords': True}, {'filter_punctuation': True, 'filter_stopwords': True}]
+
+
+# the shingles of the original implementation: 64 bits of the MD5 of every shingle text
+def reference_shingles(doc, k=3, filter_punctuation=False, filter_stopwords=False, remove_capitalization=False,
+                       stopword_start=False):
+    tokens = pre_processing(doc, punctuation=filter_punctuation, stopwords=filter_stopwords,
+                            capitalization=remove_capitalization).split()
+    return {int(md5(" ".join(tokens[i:i+k]).encode()).hexdigest()[0:16], 16) for i in range(0, len(tokens)-k+1)
+            if not stopword_start or tokens[i] in STOPWORDS}
+
+
+@pytest.mark.parametrize("options", OPTIONS)
+def test_md5_shingles_are_bit_for_bit_the_original_ones(corpus, options):
+    for doc in corpus[:50] + ["The, the THE: of a. b", "", "one two"]:
+        expected = reference_shingles(doc, **options)
+        assert to_shingles(doc, **options) == expected
+        assert shingle_hashes(doc, **options).tolist() == sorted(expected)
+
+
+def test_mix64_shingles_of_equal_token_sequences_are_equal():
+    a = shingle_hashes("the cat of the hat", shinglehash="mix64")
+    assert np.array_equal(a, shingle_hashes("the  cat of\nthe hat", shinglehash="mix64"))
+    assert len(a) == 3 and a.dtype == np.uint64 and (a[1:] > a[:-1]).all()
+    assert not np.array_equal(a, shingle_hashes("the cat of a hat", shinglehash="mix64"))
+
+
+def test_shingle_variants_equal_shingle_hashes(corpus):
+    for doc in corpus[:30]:
+        for options, shingles in zip(OPTIONS, shingle_variants(doc, OPTIONS)):
+            assert np.array_equal(shingles, shingle_hashes(doc, shinglehash="mix64", **options))
+
+
+def test_shingle_batch(corpus):
+    assert [shingles.tolist() for shingles in shingle_batch(corpus[:20])] == \
+        [sorted(to_shingles(doc)) for doc in corpus[:20]]
+
+
+def test_token_cache_is_bounded():
+    for i in range(TOKEN_CACHE_SIZE + 10):
+        _token_hash("token%d" % i)
+    assert _token_hash.cache_info().currsize == TOKEN_CACHE_SIZE
+
+
+def test_pooled_shingle_batch(corpus, monkeypatch):
+    expected = shingle_batch(corpus)
+    monkeypatch.setattr(processing, "POOL_MIN_DOCS", 10)
+    usersettings["threads"] = 2
+    try:
+        pool = get_pool()
+        assert [doc.tolist() for doc in shingle_batch(corpus)] == [doc.tolist() for doc in expected]
+        # the persistent pool is reused
+        shingle_batch(corpus[:20])
+        assert get_pool() is pool
+    finally:
+        close_pool()
@@ -0,0 +1,52 @@
+import pytest
+
+from lsh import LSH
+from sharding import ShardedLSH
+
+
+@pytest.fixture
+def sharded(corpus_csv):
+    sharded = ShardedLSH()
+    sharded.create_index(corpus_csv, 40, 4, shards=3)
+    yield sharded
+    sharded.close()
+
+
+# the unsharded index with the hash functions of a sharded index
+def unsharded(sharded, corpus):
+    lsh = LSH()
+    lsh.build_index(corpus, sharded.M, sharded.r, sharded.hashfunctions)
+    return lsh
+
+
+def test_sharded_equals_unsharded(sharded, corpus):
+    lsh = unsharded(sharded, corpus)
+    queries = corpus[::7] + ["the word1 of word2 and word3"]
+    assert sharded.query_batch(queries, 0.5) == lsh.query_batch(queries, 0.5)
+    assert sharded.query_batch(queries, 0.5, True) == lsh.query_batch(queries, 0.5, True)
+    assert sharded.query(queries[0], 0.5) == lsh.query(queries[0], 0.5)
+    assert sharded.query_batch([], 0.5) == []
+    pairs = lsh.get_all_similar_pairs(0.5, output=None)
+    assert len(pairs) > 0
+    assert sharded.get_all_similar_pairs(0.5, output=None) == pairs
+    assert sharded.get_all_similar_pairs(0.5, max_bucket=3, output=None) == \
+        lsh.get_all_similar_pairs(0.5, max_bucket=3, output=None)
+
+
+def test_removed_documents_and_stored_shards(sharded, corpus, workdir):
+    lsh = unsharded(sharded, corpus)
+    removed = list(range(0, len(corpus), 4))
+    # nothing is removed when one of the documents is unknown
+    with pytest.raises(ValueError):
+        sharded.remove_documents([1, len(corpus)])
+    sharded.remove_documents(removed)
+    lsh.remove_documents(removed)
+    sharded.store_index("index.shards")
+    sharded.close()
+    loaded = ShardedLSH("index.shards")
+    try:
+        assert loaded.query_batch(corpus[:40], 0.5) == lsh.query_batch(corpus[:40], 0.5)
+        assert loaded.get_all_similar_pairs(0.5, output="pairs.csv") == lsh.get_all_similar_pairs(0.5, output=None)
+        assert (workdir / "pairs.csv").exists()
+    finally:
+        loaded.close()
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from signature import EMPTY, MinhashEngine, generate_hashfunctions, load_hash, shingles_to_signature
+
+
+@pytest.fixture(scope="module")
+def shingles():
+    rng = np.random.default_rng(5)
+    return [set(rng.integers(0, 2**64, size, dtype=np.uint64).tolist()) for size in [1, 2, 17, 300]]
+
+
+@pytest.mark.parametrize("hashtype", ["Xorhash", "Linconhash", "MD5hash"])
+def test_engine_equals_scalar_calculate(hashtype, shingles):
+    hashfunctions = generate_hashfunctions(12, hashtype)
+    engine = MinhashEngine(hashfunctions)
+    for doc in shingles:
+        expected = [min(hashfunc.calculate(shingle) for shingle in doc) for hashfunc in hashfunctions]
+        assert engine.signature(doc).tolist() == expected
+    assert engine.signature_matrix(shingles).tolist() == [engine.signature(doc).tolist() for doc in shingles]
+
+
+def test_signature_is_computed_in_blocks(shingles):
+    engine = MinhashEngine(generate_hashfunctions(12, "Xorhash"))
+    expected = engine.signature(shingles[-1])
+    # every block holds the hashes of 4 shingles only
+    engine.BLOCK = 4 * 12
+    assert np.array_equal(engine.signature(shingles[-1]), expected)
+
+
+def test_signature_of_empty_document():
+    assert shingles_to_signature(set(), generate_hashfunctions(5, "Xorhash")).tolist() == [int(EMPTY)] * 5
+
+
+@pytest.mark.parametrize("hashtype", ["Xorhash", "Linconhash", "MD5hash", "OPHhash"])
+def test_stored_hash_functions_give_the_same_signatures(hashtype, shingles):
+    hashfunctions = generate_hashfunctions(6, hashtype)
+    loaded = [load_hash(hashfunc.store()) for hashfunc in hashfunctions]
+    assert np.array_equal(MinhashEngine(loaded).signature_matrix(shingles),
+                          MinhashEngine(hashfunctions).signature_matrix(shingles))
+
+
+def test_one_permutation_hashing(shingles):
+    hashfunctions = generate_hashfunctions(16, "OPHhash")
+    engine = MinhashEngine(hashfunctions)
+    for doc in shingles:
+        signature = engine.signature(doc)
+        # the minimum hash of every non-empty bin, as calculate puts every value in one bin only
+        minima = np.array([min(hashfunc.calculate(shingle) for shingle in doc) for hashfunc in hashfunctions],
+                          dtype=np.uint64)
+        filled = minima != EMPTY
+        assert np.array_equal(signature[filled], minima[filled])
+        # empty bins are densified
+        assert (signature != EMPTY).all()
+    assert (engine.signature(set()) == EMPTY).all()
+
+
+def test_one_permutation_similarity_estimate():
+    rng = np.random.default_rng(9)
+    values = rng.integers(0, 2**64, 500, dtype=np.uint64).tolist()
+    engine = MinhashEngine(generate_hashfunctions(256, "OPHhash"))
+    a = set(values[:300])
+    for start in [100, 200, 250]:
+        b = set(values[start:])
+        estimate = np.mean(engine.signature(a) == engine.signature(b))
+        assert abs(estimate - len(a & b) / len(a | b)) < 0.1
+
+
+@pytest.mark.parametrize("hashtype", ["Xorhash", "Linconhash"])
+def test_runner_up_is_the_second_smallest_hash(hashtype, shingles):
+    hashfunctions = generate_hashfunctions(12, hashtype)
+    engine = MinhashEngine(hashfunctions)
+    engine.BLOCK = 5 * 12
+    for doc in shingles:
+        hashes = [sorted(hashfunc.calculate(shingle) for shingle in doc) for hashfunc in hashfunctions]
+        assert engine.runner_up(doc).tolist() == [h[1] if len(h) > 1 else int(EMPTY) for h in hashes]
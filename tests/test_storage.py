@@ -0,0 +1,147 @@
+import json
+from collections import defaultdict
+from hashlib import md5
+from itertools import combinations
+
+import numpy as np
+import pytest
+
+from jaccard import compute_jaccard
+from lsh import LSH
+from processing import to_shingles
+from signature import generate_hashfunctions
+from storage import BAND_KEYS, BandTable, ShingleStore, bucket_arrays, is_binary_index
+
+
+# asserts that two indexes hold the same documents, signatures, hash functions and band tables
+def assert_same_index(index, other):
+    assert (index.M, index.r, index.bandkey, index.shinglehash) == (other.M, other.r, other.bandkey, other.shinglehash)
+    assert [hashfunc.store() for hashfunc in index.hashfunctions] == \
+        [hashfunc.store() for hashfunc in other.hashfunctions]
+    assert np.array_equal(index.docs.shingles, other.docs.shingles)
+    assert np.array_equal(index.docs.offsets, other.docs.offsets)
+    assert np.array_equal(index.signatures, other.signatures)
+    assert index.deleted == other.deleted
+    for band, other_band in zip(index.index, other.index):
+        for a, b in zip(band.arrays(), other_band.arrays()):
+            assert np.array_equal(a, b)
+
+
+@pytest.mark.parametrize("filename", ["index.bin", "index.json"])
+def test_store_and_load(lsh, corpus, workdir, filename):
+    lsh.store_index(filename)
+    assert is_binary_index('./data/%s' % filename) == filename.endswith('.bin')
+    loaded = LSH(filename)
+    assert_same_index(lsh, loaded)
+    assert [loaded.query(doc, 0.5) for doc in corpus[:20]] == [lsh.query(doc, 0.5) for doc in corpus[:20]]
+    assert loaded.get_all_similar_pairs(0.5, output=None) == lsh.get_all_similar_pairs(0.5, output=None)
+
+
+def test_binary_index_is_memory_mapped(lsh, workdir):
+    lsh.store_index("index.bin")
+    loaded = LSH("index.bin")
+    assert isinstance(loaded.docs.shingles, np.memmap)
+    assert all(isinstance(band, BandTable) and isinstance(band.postings, np.memmap) for band in loaded.index)
+
+
+def random_band(seed, docs=200, keys=30):
+    rng = np.random.default_rng(seed)
+    band = {}
+    for doc, key in enumerate(rng.integers(1, keys, docs).tolist()):
+        band.setdefault(key * 2**40 + 7, []).append(doc)
+    return band
+
+
+@pytest.mark.parametrize("bandkey", ["mix64", "md5"])
+def test_added_documents_are_found_before_and_after_merge(bandkey):
+    band = random_band(3)
+    if bandkey == "md5":
+        band = {("%032x" % key): bucket for key, bucket in band.items()}
+    table = BandTable(*BandTable.pack(band, bandkey))
+    new_key = "ab" * 16 if bandkey == "md5" else 99
+    existing = next(iter(band))
+    table.add(existing, 200)
+    table.add(new_key, 201)
+    table.add(new_key, 202)
+    expected = dict(band)
+    expected[existing] = band[existing] + [200]
+    expected[new_key] = [201, 202]
+
+    assert len(table) == len(expected)
+    assert table[existing] == expected[existing] and table[new_key] == [201, 202]
+    assert table.lookup(np.array([BandTable.pack({new_key: []}, bandkey)[0][0]]))[0] == [201, 202]
+    table.merge()
+    assert not table.added
+    assert {key: table[key] for key in table} == expected
+    for a, b in zip(table.arrays(), BandTable.pack(expected, bandkey)):
+        assert np.array_equal(a, b)
+
+
+def test_from_keys_equals_pack():
+    band = random_band(1)
+    keys = np.zeros(200, dtype=BAND_KEYS["mix64"])
+    for key, bucket in band.items():
+        keys[bucket] = key
+    for a, b in zip(BandTable.from_keys(keys).arrays(), BandTable.pack(band, "mix64")):
+        assert np.array_equal(a, b)
+
+
+def test_lookup_and_mapping():
+    band = random_band(2)
+    table = BandTable(*BandTable.pack(band, "mix64"))
+    assert len(table) == len(band)
+    assert {key: table[key] for key in table} == band
+    assert table.lookup(np.array(list(band) + [12345], dtype=BAND_KEYS["mix64"])) == list(band.values()) + [[]]
+    assert 12345 not in table
+    with pytest.raises(KeyError):
+        table[12345]
+
+
+def test_bucket_arrays_keep_documents_sorted():
+    keys, offsets, postings = bucket_arrays(np.array([5, 3, 5, 3, 1], dtype=np.uint64), np.array([2, 4, 6, 8, 9]))
+    assert keys.tolist() == [1, 3, 5]
+    assert offsets.tolist() == [0, 1, 3, 5]
+    assert postings.tolist() == [9, 4, 8, 2, 6]
+
+
+# Writes a JSON index as it was stored before the 64-bit band keys: MD5 shingles, MD5 hex band keys, signatures
+# of the scalar hash functions and no bandkey or shinglehash fields
+def write_legacy_index(path, corpus, M, r):
+    docs = [to_shingles(doc, filter_punctuation=True, remove_capitalization=True, stopword_start=True)
+            for doc in corpus]
+    hashfunctions = generate_hashfunctions(M, "Xorhash")
+    index = [defaultdict(list) for _ in range(M // r)]
+    for doc_id, doc in enumerate(docs):
+        signature = [min(hashfunc.calculate(shingle) for shingle in doc) if doc else 2**64 - 1
+                     for hashfunc in hashfunctions]
+        for i in range(0, M, r):
+            digest = md5()
+            for value in signature[i:i+r]:
+                digest.update(value.to_bytes(8, 'big', signed=False))
+            index[i // r][digest.hexdigest()].append(doc_id)
+    with open(path, 'w') as output:
+        json.dump({'M': M, 'r': r, 'index': index, 'docs': [list(doc) for doc in docs],
+                   'hashfunctions': [hashfunc.store() for hashfunc in hashfunctions]}, output)
+    return docs, index
+
+
+def test_legacy_md5_json_index(corpus, workdir):
+    docs, index = write_legacy_index('./data/legacy.json', corpus, 20, 4)
+    lsh = LSH('legacy.json')
+    assert (lsh.bandkey, lsh.shinglehash) == ("md5", "md5")
+    expected = {(a, b) for band in index for bucket in band.values() for a, b in combinations(bucket, 2)
+                if docs[a] | docs[b] and compute_jaccard(docs[a], docs[b]) > 0.5}
+    assert {pair for pair, _ in lsh.get_all_similar_pairs(0.5, output=None)} == expected
+    for doc_id in range(0, len(corpus), 10):
+        assert doc_id in lsh.query(corpus[doc_id], 0.5)
+    # documents added to a legacy index get MD5 band keys as well
+    new = lsh.add_documents([corpus[7]])[0]
+    assert {7, new} <= set(lsh.query(corpus[7], 0.9))
+
+
+def test_shingle_store():
+    docs = [{3, 1, 2}, set(), {7}]
+    store = ShingleStore.from_sets(docs)
+    assert len(store) == 3 and [set(doc) for doc in store] == docs
+    store.extend([{9, 8}])
+    assert list(store[3]) == [8, 9]
@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+import pytest
+
+from lsh import LSH
+from sinks import CSVSink, ChunkSink, read_chunks
+
+
+# Sink that stops the run (like a crash) when a given chunk is written
+class InterruptedSink(ChunkSink):
+    def __init__(self, directory, stop):
+        super().__init__(directory)
+        self.stop = stop
+
+    def write(self, first, second, sims):
+        if self.chunks == self.stop:
+            raise KeyboardInterrupt
+        super().write(first, second, sims)
+
+
+@pytest.fixture(scope="module")
+def expected(lsh):
+    return sorted((pair, sim) for pair, sim in lsh.get_all_similar_pairs(0.5, output=None))
+
+
+def chunk_pairs(directory):
+    return [((a, b), sim) for first, second, sims in read_chunks(directory)
+            for a, b, sim in zip(first.tolist(), second.tolist(), sims.tolist())]
+
+
+def test_stream_equals_get_all_similar_pairs(lsh, expected, tmp_path):
+    pairs = lsh.stream_similar_pairs(0.5, ChunkSink(str(tmp_path / "chunks")), pairs_per_partition=200,
+                                     directory=str(tmp_path))
+    assert pairs == len(expected)
+    # the pairs come out sorted, in several partitions
+    assert chunk_pairs(str(tmp_path / "chunks")) == expected
+    assert len(os.listdir(str(tmp_path / "chunks"))) > 1
+
+
+def test_interrupted_run_continues_from_its_checkpoint(lsh, expected, tmp_path):
+    directory, checkpoint = str(tmp_path / "chunks"), str(tmp_path / "checkpoint.json")
+    with pytest.raises(KeyboardInterrupt):
+        lsh.stream_similar_pairs(0.5, InterruptedSink(directory, 2), checkpoint=checkpoint, pairs_per_partition=200)
+    assert os.path.exists(checkpoint)
+    assert len(os.listdir(directory)) == 2
+
+    pairs = lsh.stream_similar_pairs(0.5, ChunkSink(directory), checkpoint=checkpoint, pairs_per_partition=200)
+    assert not os.path.exists(checkpoint)
+    assert pairs == len(expected)
+    assert chunk_pairs(directory) == expected
+
+
+def test_interrupted_csv_run(lsh, expected, tmp_path):
+    output, checkpoint = str(tmp_path / "result.csv"), str(tmp_path / "checkpoint.json")
+
+    class InterruptedCSVSink(CSVSink):
+        written = 0
+
+        def write(self, first, second, sims):
+            if self.written == 1:
+                raise KeyboardInterrupt
+            self.written += 1
+            super().write(first, second, sims)
+
+    with pytest.raises(KeyboardInterrupt):
+        lsh.stream_similar_pairs(0.5, InterruptedCSVSink(output), checkpoint=checkpoint, pairs_per_partition=200)
+    lsh.stream_similar_pairs(0.5, CSVSink(output), checkpoint=checkpoint, pairs_per_partition=200)
+    rows = np.loadtxt(output, delimiter=',', skiprows=1, dtype=np.int64, ndmin=2)
+    assert [tuple(row) for row in rows.tolist()] == [pair for pair, _ in expected]
+
+
+def test_checkpoint_of_another_index_is_refused(lsh, corpus, tmp_path):
+    directory, checkpoint = str(tmp_path / "chunks"), str(tmp_path / "checkpoint.json")
+    index = LSH()
+    index.build_index(corpus, lsh.M, lsh.r, lsh.hashfunctions)
+    index.remove_documents([1])
+    with pytest.raises(KeyboardInterrupt):
+        index.stream_similar_pairs(0.5, InterruptedSink(directory, 1), checkpoint=checkpoint,
+                                   pairs_per_partition=200)
+    # the same number of documents, but other ones, is removed from the index
+    index.deleted = {2}
+    with pytest.raises(AssertionError):
+        index.stream_similar_pairs(0.5, ChunkSink(directory), checkpoint=checkpoint, pairs_per_partition=200)
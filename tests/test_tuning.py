@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from tuning import s_curve, tune
+
+
+# similarity distribution of a typical collection: mostly dissimilar pairs and a few near-duplicates
+HISTOGRAM = (np.linspace(0.005, 0.995, 100), np.concatenate([np.full(30, 1e6), np.full(60, 10.0), np.full(10, 500.0)]))
+
+
+def test_tune_meets_the_targets():
+    best = tune(HISTOGRAM, 10000, 0.3, 0.8)
+    assert best is not None
+    assert best['M'] == best['r'] * best['b'] <= 512
+    assert best['p1'] <= 0.05 and 1 - best['p2'] <= 0.05
+    assert best['p1'] == pytest.approx(s_curve(0.3, best['r'], best['b']))
+    assert best['p2'] == pytest.approx(s_curve(0.8, best['r'], best['b']))
+
+
+def test_stricter_targets_cost_more():
+    assert tune(HISTOGRAM, 10000, 0.3, 0.8, max_fp=0.01, max_fn=0.01)['cost'] >= tune(HISTOGRAM, 10000, 0.3, 0.8)['cost']
+
+
+def test_tune_returns_none_when_the_targets_are_unreachable():
+    assert tune(HISTOGRAM, 10000, 0.5, 0.6) is None
+    assert tune(HISTOGRAM, 10000, 0.3, 0.8, max_M=4) is None